@@ -0,0 +1,231 @@
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+from aiohttp import web
+from telebot import apihelper, types
+
+import metrics
+from updates import RecentUpdates, update_chat_id
+
+DEFAULT_API_URL = "https://api.telegram.org/bot{0}/{1}"
+
+
+class ApiResponse:
+    """The parts of a requests.Response that are read from ApiException.result."""
+
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class AsyncBotApi:
+    """Bot API client on a single pooled aiohttp session, taking the same arguments as telebot.TeleBot."""
+    # method -> (Bot API method, positional parameter names)
+    METHODS = {
+        "send_message": ("sendMessage", ["chat_id", "text", "disable_web_page_preview", "reply_to_message_id",
+                                         "reply_markup", "parse_mode", "disable_notification"]),
+        "edit_message_text": ("editMessageText", ["text", "chat_id", "message_id", "inline_message_id",
+                                                  "parse_mode", "disable_web_page_preview", "reply_markup"]),
+        "pin_chat_message": ("pinChatMessage", ["chat_id", "message_id", "disable_notification"]),
+        "delete_message": ("deleteMessage", ["chat_id", "message_id"]),
+        "answer_callback_query": ("answerCallbackQuery", ["callback_query_id", "text", "show_alert", "url",
+                                                          "cache_time"]),
+        "set_webhook": ("setWebhook", ["url"]),
+        "remove_webhook": ("deleteWebhook", []),
+    }
+    RETURNS_MESSAGE = ["sendMessage", "editMessageText"]
+
+    def __init__(self, token, url=None, connections=100, timeout=10):
+        self.token = token
+        self.url = url or apihelper.API_URL or DEFAULT_API_URL
+        self.connections = connections
+        self.timeout = timeout
+        self.session = None
+
+    async def start(self):
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.connections),
+                                             timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+    async def close(self):
+        await self.session.close()
+
+    async def request(self, method_name, params):
+        params = {k: v for k, v in params.items() if v is not None}
+        if "reply_markup" in params:
+            params["reply_markup"] = params["reply_markup"].to_json()
+        async with self.session.post(self.url.format(self.token, method_name), data=params) as response:
+            text = await response.text()
+        result = ApiResponse(response.status, text)
+        if response.status != 200:
+            raise apihelper.ApiException("The server returned HTTP {} {}. Response body:\n[{}]".format(
+                response.status, response.reason, text), method_name, result)
+        body = result.json()
+        if not body["ok"]:
+            raise apihelper.ApiException("Error code: {} Description: {}".format(
+                body["error_code"], body["description"]), method_name, result)
+        return body["result"]
+
+    async def call(self, method, *args, **kwargs):
+        method_name, names = self.METHODS[method]
+        params = dict(zip(names, args))
+        params.update(kwargs)
+        result = await self.request(method_name, params)
+        if method_name in self.RETURNS_MESSAGE and isinstance(result, dict):
+            return types.Message.de_json(result)
+        return result
+
+
+class AsyncSender:
+    """Drains an outbound.Outbound (started with no worker threads) with concurrent async requests."""
+
+    def __init__(self, outbound, api, concurrency=30):
+        self.outbound = outbound
+        self.api = api
+        self.concurrency = concurrency
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        wake = asyncio.Event()
+        slots = asyncio.Semaphore(self.concurrency)
+        self.outbound.wakeup = lambda: loop.call_soon_threadsafe(wake.set)
+        while True:
+            wake.clear()
+            task, at = self.outbound.take()
+            if task is None:
+                timeout = None if at is None else max(at - self.outbound.clock(), 0.001)
+                try:
+                    await asyncio.wait_for(wake.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await slots.acquire()
+            asyncio.ensure_future(self.send(task, slots))
+
+    async def send(self, task, slots):
+        try:
+            result = await self.api.call(task.method, *task.args, **task.kwargs)
+        except Exception:
+            self.outbound.settle(task, error=sys.exc_info())
+        else:
+            self.outbound.settle(task, result)
+        finally:
+            slots.release()
+
+
+class GuildLocks:
+    """One asyncio.Lock per chat, dropped once nothing holds or waits on it."""
+
+    def __init__(self):
+        self.locks = weakref.WeakValueDictionary()
+
+    def get(self, chat_id):
+        lock = self.locks.get(chat_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self.locks[chat_id] = lock
+        return lock
+
+
+class AsyncRuntime:
+    """Webhook server on the event loop. The existing synchronous handlers run in a thread pool,
+    one update at a time per guild, so they never wait on each other's guild lock.
+
+    Updates are acknowledged as soon as they are parsed, duplicates are dropped, and new ones are
+    refused with a 503 while `backlog` are pending so Telegram delivers them again later.
+    """
+
+    def __init__(self, bot, token, outbound, workers=32, backlog=10000):
+        if bot.threaded:
+            raise ValueError("handlers run in the executor threads, bot must be a TeleBot with threaded=False")
+        self.bot = bot
+        self.token = token
+        self.outbound = outbound
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.api = AsyncBotApi(token)
+        self.locks = GuildLocks()
+        self.recent = RecentUpdates()
+        self.backlog = backlog
+        self.pending = 0
+        metrics.Gauge("ascentbot_updates_pending", "Updates received and not processed yet", collect=lambda: self.pending)
+
+    async def handle_update(self, request):
+        update = types.Update.de_json(await request.text())
+        if self.recent.seen(update.update_id):
+            return web.Response(text="!")
+        if self.pending >= self.backlog:
+            self.recent.forget(update.update_id)
+            return web.Response(status=503)
+        self.pending += 1
+        asyncio.ensure_future(self.dispatch(update))
+        return web.Response(text="!")
+
+    async def dispatch(self, update):
+        loop = asyncio.get_event_loop()
+        try:
+            # asyncio locks are fair, so updates of a chat are processed in the order they came in
+            async with self.locks.get(update_chat_id(update)):
+                await loop.run_in_executor(self.executor, self.process, update)
+        finally:
+            self.pending -= 1
+
+    def process(self, update):
+        try:
+            self.bot.process_new_updates([update])
+        except Exception as e:
+            logging.exception(e)
+
+    async def set_webhook(self, request):
+        await self.api.call("remove_webhook")
+        await self.api.call("set_webhook", "{}/{}".format(os.environ.get('WEBHOOK_HOST', 'localhost:5000'), self.token))
+        return web.Response(text="!")
+
+    async def metrics(self, request):
+        return web.Response(body=metrics.registry.render().encode("utf-8"),
+                            headers={"Content-Type": metrics.CONTENT_TYPE})
+
+    async def watch_loop_lag(self, interval=1):
+        """Records how much later than asked the event loop wakes up, blocking calls on the loop show up here."""
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(interval)
+            metrics.scheduler_lag.observe(max(time.monotonic() - started - interval, 0), "event_loop")
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/" + self.token, self.handle_update)
+        app.router.add_get("/", self.set_webhook)
+        app.router.add_get("/{}/metrics".format(self.token), self.metrics)
+        return app
+
+    async def start(self, host, port):
+        await self.api.start()
+        self.sender = asyncio.ensure_future(AsyncSender(self.outbound, self.api).run())
+        self.lag_watcher = asyncio.ensure_future(self.watch_loop_lag())
+        self.runner = web.AppRunner(self.app())
+        await self.runner.setup()
+        self.site = web.TCPSite(self.runner, host, port)
+        await self.site.start()
+
+    async def stop(self):
+        await self.runner.cleanup()
+        self.sender.cancel()
+        self.lag_watcher.cancel()
+        await self.api.close()
+
+
+def run(bot, token, outbound, automation, host="0.0.0.0", port=5000):
+    loop = asyncio.get_event_loop()
+    runtime = AsyncRuntime(bot, token, outbound, workers=int(os.getenv("ASYNC_WORKERS", 32)))
+    loop.run_until_complete(runtime.start(host, port))
+    automation.start_tasks(runtime.executor)
+    loop.run_forever()
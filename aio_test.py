@@ -0,0 +1,109 @@
+import asyncio
+import json
+import unittest
+
+import aiohttp
+import telebot
+from telebot import apihelper
+
+import aio
+import outbound as o
+from fakebotapi import FakeBotApi, use_api_url
+
+
+class TestAsyncRuntime(unittest.TestCase):
+    def setUp(self):
+        self.api = FakeBotApi().start()
+        use_api_url(self.api.url)
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        self.api.stop()
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(asyncio.wait_for(coroutine, 10))
+
+    def test_api(self):
+        async def calls():
+            api = aio.AsyncBotApi("TOKEN")
+            await api.start()
+            try:
+                sent = await api.call("send_message", -1, "hello", parse_mode="Markdown")
+                self.assertEqual(sent.text, "hello")
+                self.api.fail("sendMessage", 429, retry_after=3)
+                with self.assertRaises(apihelper.ApiException) as e:
+                    await api.call("send_message", -1, "hello")
+                self.assertEqual(e.exception.result.status_code, 429)
+                self.assertEqual(e.exception.result.json()["parameters"]["retry_after"], 3)
+            finally:
+                await api.close()
+        self.run_async(calls())
+        self.assertEqual(self.api.calls_to("sendMessage")[0][2]["parse_mode"], "Markdown")
+
+    def test_sender(self):
+        out = o.Outbound(None, workers=0)
+        self.api.fail("sendMessage", 502)
+
+        async def send():
+            api = aio.AsyncBotApi("TOKEN")
+            await api.start()
+            sender = asyncio.ensure_future(aio.AsyncSender(out, api).run())
+            loop = asyncio.get_event_loop()
+            try:
+                task = out.send_message(-1, "hello")
+                return await loop.run_in_executor(None, task.wait, 5)
+            finally:
+                sender.cancel()
+                await api.close()
+        out.backoff = 0.05
+        self.assertEqual(self.run_async(send()).text, "hello")
+        self.assertEqual(out.stats()["retried"], 1)
+
+    def test_webhook(self):
+        bot = telebot.TeleBot("TOKEN", threaded=False)
+        out = o.Outbound(None, workers=0)
+        seen = []
+
+        @bot.message_handler(commands=['exped'])
+        def exped(message):
+            seen.append(message.text)
+            out.send_message(message.chat.id, "reply to " + message.text).wait(5)
+
+        runtime = aio.AsyncRuntime(bot, "TOKEN", out, workers=4)
+
+        async def post():
+            await runtime.start("127.0.0.1", 0)
+            port = runtime.site._server.sockets[0].getsockname()[1]
+            async with aiohttp.ClientSession() as session:
+                for i in [0, 1, 1, 2]:  # Update 1 is delivered twice
+                    update = {"update_id": i, "message": {
+                        "message_id": i, "date": 0, "text": "/exped view {}".format(i),
+                        "chat": {"id": -1, "type": "group"}, "from": {"id": 1, "is_bot": False, "first_name": "a"},
+                        "entities": [{"type": "bot_command", "offset": 0, "length": 6}]}}
+                    async with session.post("http://127.0.0.1:{}/TOKEN".format(port), data=json.dumps(update)) as r:
+                        self.assertEqual(r.status, 200)
+                # Metrics are only served under the token, like the webhook
+                async with session.get("http://127.0.0.1:{}/metrics".format(port)) as r:
+                    self.assertEqual(r.status, 404)
+                async with session.get("http://127.0.0.1:{}/TOKEN/metrics".format(port)) as r:
+                    self.assertEqual(r.status, 200)
+            while runtime.pending > 0:
+                await asyncio.sleep(0.01)
+            await runtime.stop()
+        self.run_async(post())
+        self.assertEqual(seen, ["/exped view 0", "/exped view 1", "/exped view 2"])
+        self.assertEqual(runtime.recent.duplicates, 1)
+        self.assertEqual([c[2]["text"] for c in self.api.calls_to("sendMessage")],
+                         ["reply to /exped view 0", "reply to /exped view 1", "reply to /exped view 2"])
+
+    def test_refuses_threaded_bot(self):
+        bot = telebot.TeleBot("TOKEN")
+        with self.assertRaises(ValueError):
+            aio.AsyncRuntime(bot, "TOKEN", o.Outbound(None, workers=0))
+        self.assertTrue(bot.threaded)
+
+
+if __name__ == '__main__':
+    unittest.main()
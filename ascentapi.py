@@ -1,12 +1,80 @@
+import logging
+import os
+import threading
+import time
+
 import requests
 
-url = "https://script.google.com/macros/s/AKfycbybFe3g9Kf8fjFz-DDQCsaGURhRSnjc0jtiM-2MVXY2W6raox8/exec"
+url = os.getenv("ASCENT_API_URL", "https://script.google.com/macros/s/AKfycbybFe3g9Kf8fjFz-DDQCsaGURhRSnjc0jtiM-2MVXY2W6raox8/exec")
+timeout = (5, 30)  # Apps Script is slow to start, (connect, read) seconds
+session = requests.Session()
 
 
 def url_with_action(action):
     return "{}?action={}".format(url, action)
 
 
+def fetch_fort_roster():
+    r = session.get(url=url_with_action("getFortRoster"), timeout=timeout)
+    r.raise_for_status()
+    return r.json()
+
+
+class RosterCache:
+    """Last good fort roster, refreshed in the background once it is older than ttl seconds.
+
+    Only the very first get() waits for the API. After that a stale roster is returned right away
+    while a refresh runs, and a failed refresh keeps the last good roster.
+    """
+
+    def __init__(self, fetch, ttl=600, clock=time.monotonic):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.clock = clock
+        self.roster = None
+        self.fetched_at = None
+        self.refreshing = False
+        self.lock = threading.Lock()
+        self.fetch_lock = threading.Lock()  # one fetch at a time
+        self.failures = 0
+
+    def get(self):
+        with self.lock:
+            roster = self.roster
+            stale = roster is not None and self.clock() - self.fetched_at > self.ttl and not self.refreshing
+            if stale:
+                self.refreshing = True
+        if roster is None:
+            with self.fetch_lock:
+                if self.roster is None:
+                    self.store(self.fetch())  # Nothing to fall back to, let the error through
+                return self.roster
+        if stale:
+            threading.Thread(target=self.refresh, daemon=True).start()
+        return roster
+
+    def refresh(self):
+        """Fetches the roster now, returns False and keeps the last good one if that fails."""
+        try:
+            with self.fetch_lock:
+                self.store(self.fetch())
+            return True
+        except Exception as e:
+            self.failures += 1
+            logging.warning("Could not refresh fort roster, keeping the last one: {}".format(e))
+            return False
+        finally:
+            with self.lock:
+                self.refreshing = False
+
+    def store(self, roster):
+        with self.lock:
+            self.roster = roster
+            self.fetched_at = self.clock()
+
+
+roster_cache = RosterCache(fetch_fort_roster)
+
+
 def get_fort_roster():
-    r = requests.get(url=url_with_action("getFortRoster"))
-    return r.json()
\ No newline at end of file
+    return roster_cache.get()
@@ -0,0 +1,87 @@
+import json
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import ascentapi
+
+
+class StubAppsScript:
+    """Serves the roster in `roster` for getFortRoster, or `status` if it isn't 200."""
+
+    def __init__(self):
+        self.roster = [{"name": "a", "telegram": "", "role": ""}]
+        self.status = 200
+        self.hits = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.hits += 1
+                body = json.dumps(stub.roster).encode("utf-8")
+                self.send_response(stub.status)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = HTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:{}/exec".format(self.server.server_address[1])
+
+
+class TestRosterCache(unittest.TestCase):
+    def setUp(self):
+        self.stub = StubAppsScript()
+        self.url = ascentapi.url
+        ascentapi.url = self.stub.url
+        self.now = 0
+        self.cache = ascentapi.RosterCache(ascentapi.fetch_fort_roster, ttl=60, clock=lambda: self.now)
+
+    def tearDown(self):
+        ascentapi.url = self.url
+        self.stub.server.shutdown()
+        self.stub.server.server_close()
+
+    def wait_refreshed(self):
+        for _ in range(100):
+            if not self.cache.refreshing:
+                return
+            time.sleep(0.01)
+
+    def test_ttl(self):
+        self.assertEqual(self.cache.get()[0]["name"], "a")
+        self.now = 30
+        self.cache.get()
+        self.assertEqual(self.stub.hits, 1)
+
+    def test_stale_while_revalidate(self):
+        self.cache.get()
+        self.stub.roster = [{"name": "b", "telegram": "", "role": ""}]
+        self.now = 61
+        self.assertEqual(self.cache.get()[0]["name"], "a")  # Stale one right away
+        self.wait_refreshed()
+        self.assertEqual(self.cache.get()[0]["name"], "b")
+        self.assertEqual(self.stub.hits, 2)
+
+    def test_keeps_last_good(self):
+        self.cache.get()
+        self.stub.status = 500
+        self.assertFalse(self.cache.refresh())
+        self.now = 61
+        self.assertEqual(self.cache.get()[0]["name"], "a")
+        self.wait_refreshed()
+        self.assertEqual(self.cache.get()[0]["name"], "a")
+        self.assertEqual(self.cache.failures, 2)
+
+    def test_first_fetch_fails(self):
+        self.stub.status = 500
+        with self.assertRaises(Exception):
+            self.cache.get()
+
+
+if __name__ == '__main__':
+    unittest.main()
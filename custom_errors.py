@@ -53,3 +53,8 @@ class WrongCommandError(GuildError):
 class FeatureForbidden(GuildError):
     def __init__(self, id):
         self.message = "Feature forbidden in chat {}".format(id)
+
+
+class OperatorOnlyError(GuildError):
+    def __init__(self):
+        self.message = "Only bot operators can do that."
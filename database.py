@@ -2,12 +2,21 @@ import boto3
 import os
 import pickle
 import json
+import sqlite3
+import tempfile
+import threading
+import time
 from botocore.exceptions import ClientError
+from contextlib import contextmanager
+import metrics
+import profiler
 from dotenv import load_dotenv
 load_dotenv()
 
 
 def obj_to_json(o):
+    if hasattr(o, "to_json"):
+        return o.to_json()
     try:
         return o.__dict__
     except AttributeError:
@@ -33,11 +42,228 @@ class MODJson:
         return json.loads(d, **kwargs)
 
 
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (filename TEXT PRIMARY KEY, data BLOB);
+CREATE TABLE IF NOT EXISTS journal (filename TEXT, data TEXT);
+CREATE INDEX IF NOT EXISTS journal_filename ON journal (filename);
+
+CREATE TABLE IF NOT EXISTS guilds (
+    chat_id PRIMARY KEY,
+    title TEXT,
+    members TEXT,
+    pinned_message_id INTEGER,
+    daily_reset_time INTEGER,
+    stopped INTEGER,
+    fort_roster TEXT,
+    last_reset TEXT
+);
+CREATE TABLE IF NOT EXISTS expeditions (
+    chat_id,
+    slug TEXT,
+    title TEXT,
+    time TEXT,
+    description TEXT,
+    PRIMARY KEY (chat_id, slug)
+);
+CREATE TABLE IF NOT EXISTS expedition_members (chat_id, slug TEXT, tg_id, tg_handle TEXT, label TEXT);
+CREATE INDEX IF NOT EXISTS expedition_members_player ON expedition_members (chat_id, slug, tg_id, label);
+CREATE TABLE IF NOT EXISTS expedition_ready (chat_id, slug TEXT, tg_id, tg_handle TEXT, label TEXT);
+CREATE INDEX IF NOT EXISTS expedition_ready_player ON expedition_ready (chat_id, slug, tg_id, label);
+CREATE TABLE IF NOT EXISTS expedition_daily (chat_id, slug TEXT, tg_id, tg_handle TEXT, label TEXT);
+CREATE INDEX IF NOT EXISTS expedition_daily_player ON expedition_daily (chat_id, slug, tg_id, label);
+CREATE TABLE IF NOT EXISTS fort_attendance (chat_id, tg_id, tg_handle TEXT, label TEXT);
+CREATE INDEX IF NOT EXISTS fort_attendance_player ON fort_attendance (chat_id, tg_id, label);
+CREATE TABLE IF NOT EXISTS fort_history (
+    chat_id,
+    tg_id TEXT,
+    label TEXT,
+    tg_handle TEXT,
+    count INTEGER,
+    PRIMARY KEY (chat_id, tg_id, label)
+);
+"""
+
+# Expedition attribute holding each roster, and the table it is stored in
+SQLITE_ROSTERS = {
+    "members": "expedition_members",
+    "ready": "expedition_ready",
+    "daily": "expedition_daily",
+}
+# Columns added after the first release of the schema, as (table, column, definition)
+SQLITE_ADDED_COLUMNS = [
+    ("guilds", "last_reset", "TEXT"),
+]
+SQLITE_GUILD_TABLES = ["guilds", "expeditions", "fort_attendance", "fort_history"] + list(SQLITE_ROSTERS.values())
+
+
+# Row level equivalents of the journaled Guild mutations, called with the same arguments as the Guild methods.
+# They only run for mutations that succeeded in memory, so they do not re-validate.
+def _sqlite_insert_player(c, table, chat_id, slug, tg_id, handle, label):
+    c.execute("INSERT INTO {} (chat_id, slug, tg_id, tg_handle, label) VALUES (?, ?, ?, ?, ?)".format(table),
+              (chat_id, slug, tg_id, handle, label))
+
+
+def _sqlite_delete_player(c, table, chat_id, slug, tg_id, handle, label):
+    # Players are identified by (tg_id, label) like Player.key
+    c.execute("DELETE FROM {0} WHERE rowid = (SELECT rowid FROM {0} WHERE chat_id = ? AND slug = ? "
+              "AND tg_id = ? AND label = ? LIMIT 1)".format(table),
+              (chat_id, slug, tg_id, label))
+    return c.rowcount > 0
+
+
+def _sqlite_toggle_player(c, table, chat_id, title, tg_id, handle, label=""):
+    if not _sqlite_delete_player(c, table, chat_id, title.lower(), tg_id, handle, label):
+        _sqlite_insert_player(c, table, chat_id, title.lower(), tg_id, handle, label)
+
+
+def _sqlite_new_expedition(c, chat_id, title, time, description=""):
+    c.execute("INSERT INTO expeditions (chat_id, slug, title, time, description) VALUES (?, ?, ?, ?, ?)",
+              (chat_id, title.lower(), title, time, description))
+
+
+def _sqlite_set_expedition_time(c, chat_id, title, time):
+    c.execute("UPDATE expeditions SET time = ? WHERE chat_id = ? AND slug = ?", (time, chat_id, title.lower()))
+
+
+def _sqlite_set_expedition_title(c, chat_id, oldtitle, newtitle):
+    for table in ["expeditions"] + list(SQLITE_ROSTERS.values()):
+        c.execute("UPDATE {} SET slug = ? WHERE chat_id = ? AND slug = ?".format(table),
+                  (newtitle.lower(), chat_id, oldtitle.lower()))
+    c.execute("UPDATE expeditions SET title = ? WHERE chat_id = ? AND slug = ?", (newtitle, chat_id, newtitle.lower()))
+
+
+def _sqlite_set_expedition_description(c, chat_id, title, description=""):
+    c.execute("UPDATE expeditions SET description = ? WHERE chat_id = ? AND slug = ?",
+              (description, chat_id, title.lower()))
+
+
+def _sqlite_delete_expedition(c, chat_id, title):
+    for table in ["expeditions"] + list(SQLITE_ROSTERS.values()):
+        c.execute("DELETE FROM {} WHERE chat_id = ? AND slug = ?".format(table), (chat_id, title.lower()))
+
+
+def _sqlite_checkin_expedition(c, chat_id, title, tg_id, handle, label=""):
+    _sqlite_insert_player(c, "expedition_members", chat_id, title.lower(), tg_id, handle, label)
+
+
+def _sqlite_checkout_expedition(c, chat_id, title, tg_id, handle, label=""):
+    _sqlite_delete_player(c, "expedition_members", chat_id, title.lower(), tg_id, handle, label)
+
+
+def _sqlite_set_reset_time(c, chat_id, time):
+    c.execute("UPDATE guilds SET daily_reset_time = ? WHERE chat_id = ?", (time, chat_id))
+
+
+def _sqlite_reset_expeditions(c, chat_id):
+    c.execute("DELETE FROM expedition_members WHERE chat_id = ?", (chat_id,))
+    c.execute("INSERT INTO expedition_members (chat_id, slug, tg_id, tg_handle, label) "
+              "SELECT chat_id, slug, tg_id, tg_handle, label FROM expedition_daily WHERE chat_id = ? ORDER BY rowid",
+              (chat_id,))
+    c.execute("DELETE FROM expedition_ready WHERE chat_id = ?", (chat_id,))
+
+
+def _sqlite_fort_mark(c, chat_id, tg_id, handle, label=""):
+    c.execute("INSERT INTO fort_attendance (chat_id, tg_id, tg_handle, label) VALUES (?, ?, ?, ?)",
+              (chat_id, tg_id, handle, label))
+
+
+def _sqlite_fort_unmark(c, chat_id, tg_id, handle, label=""):
+    c.execute("DELETE FROM fort_attendance WHERE rowid = (SELECT rowid FROM fort_attendance WHERE chat_id = ? "
+              "AND tg_id = ? AND label = ? LIMIT 1)", (chat_id, tg_id, label))
+
+
+def _sqlite_update_fort_history(c, chat_id):
+    # tg_id is stored as text in fort_history, matching the "<tg_id>:<label>" history keys
+    c.execute("INSERT INTO fort_history (chat_id, tg_id, label, tg_handle, count) "
+              "SELECT chat_id, tg_id, label, tg_handle, 1 FROM fort_attendance WHERE chat_id = ? ORDER BY rowid "
+              "ON CONFLICT (chat_id, tg_id, label) DO UPDATE SET count = count + 1, tg_handle = excluded.tg_handle",
+              (chat_id,))
+    c.execute("DELETE FROM fort_attendance WHERE chat_id = ?", (chat_id,))
+
+
+def _sqlite_reset_fort_history(c, chat_id):
+    c.execute("DELETE FROM fort_attendance WHERE chat_id = ?", (chat_id,))
+    c.execute("DELETE FROM fort_history WHERE chat_id = ?", (chat_id,))
+    c.execute("UPDATE guilds SET fort_roster = '[]' WHERE chat_id = ?", (chat_id,))
+
+
+def _sqlite_daily_reset(c, chat_id, day):
+    _sqlite_reset_expeditions(c, chat_id)
+    _sqlite_update_fort_history(c, chat_id)
+    c.execute("UPDATE guilds SET last_reset = ? WHERE chat_id = ?", (day, chat_id))
+
+
+def _sqlite_set_guild_column(column, value):
+    def op(c, chat_id, *args):
+        c.execute("UPDATE guilds SET {} = ? WHERE chat_id = ?".format(column), (value(*args), chat_id))
+    return op
+
+
+def _sqlite_remove_guild(c, chat_id):
+    for table in SQLITE_GUILD_TABLES:
+        c.execute("DELETE FROM {} WHERE chat_id = ?".format(table), (chat_id,))
+
+
+def _sqlite_set_guild(c, chat_id, data):
+    _sqlite_remove_guild(c, chat_id)
+    fort = data.get("fort") or {}
+    c.execute("INSERT INTO guilds (chat_id, title, members, pinned_message_id, daily_reset_time, stopped, fort_roster, "
+              "last_reset) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+              (chat_id, data.get("title", ""), json.dumps(data.get("members") or []), data.get("pinned_message_id"),
+               data.get("daily_reset_time", 3), int(bool(data.get("stopped", False))),
+               json.dumps(fort.get("roster") or []), data.get("last_reset")))
+    for slug, e in (data.get("expeditions") or {}).items():
+        c.execute("INSERT INTO expeditions (chat_id, slug, title, time, description) VALUES (?, ?, ?, ?, ?)",
+                  (chat_id, slug, e.get("title", ""), e.get("time", "1200"), e.get("description", "")))
+        for roster, table in SQLITE_ROSTERS.items():
+            for p in e.get(roster) or []:
+                _sqlite_insert_player(c, table, chat_id, slug, p["tg_id"], p["tg_handle"], p["label"])
+    for p in fort.get("attendance") or []:
+        _sqlite_fort_mark(c, chat_id, p["tg_id"], p["tg_handle"], p["label"])
+    handles = fort.get("handles") or {}
+    for key, count in (fort.get("history") or {}).items():
+        if key.startswith("{"):  # Savefiles from before compact history keys
+            p = json.loads(key)
+            tg_id, label, handle = p["tg_id"], p["label"], p["tg_handle"]
+        else:
+            tg_id, label = key.split(":", 1)
+            handle = handles.get(key)
+        c.execute("INSERT INTO fort_history (chat_id, tg_id, label, tg_handle, count) VALUES (?, ?, ?, ?, ?) "
+                  "ON CONFLICT (chat_id, tg_id, label) DO UPDATE SET count = count + excluded.count",
+                  (chat_id, tg_id, label, handle, count))
+
+
+SQLITE_OPS = {
+    "new_expedition": _sqlite_new_expedition,
+    "set_expedition_time": _sqlite_set_expedition_time,
+    "set_expedition_title": _sqlite_set_expedition_title,
+    "set_expedition_description": _sqlite_set_expedition_description,
+    "delete_expedition": _sqlite_delete_expedition,
+    "daily_expedition": lambda c, chat_id, *args: _sqlite_toggle_player(c, "expedition_daily", chat_id, *args),
+    "checkin_expedition": _sqlite_checkin_expedition,
+    "checkout_expedition": _sqlite_checkout_expedition,
+    "ready_expedition": lambda c, chat_id, *args: _sqlite_toggle_player(c, "expedition_ready", chat_id, *args),
+    "set_reset_time": _sqlite_set_reset_time,
+    "reset_expeditions": _sqlite_reset_expeditions,
+    "fort_mark": _sqlite_fort_mark,
+    "fort_unmark": _sqlite_fort_unmark,
+    "update_fort_history": _sqlite_update_fort_history,
+    "reset_fort_history": _sqlite_reset_fort_history,
+    "daily_reset": _sqlite_daily_reset,
+    "set_pinned_message": _sqlite_set_guild_column("pinned_message_id", lambda message_id: message_id),
+    "set_last_reset": _sqlite_set_guild_column("last_reset", lambda day: day),
+    "stop": _sqlite_set_guild_column("stopped", lambda: 1),
+    "start": _sqlite_set_guild_column("stopped", lambda: 0),
+}
+
+
 class Storage:
     def __init__(self, storage_type: str = None):
+        self.bytes_written = 0  # by saves and journal appends, for load tests and metrics
         storage_inits = {
             "cloudcube": self.__init_cloudcube,
             "local": lambda: None,  # No init required for local storage
+            "sqlite": self.__init_sqlite,
         }
 
         self.SERIALIZERS = {
@@ -50,14 +276,54 @@ class Storage:
             "json": "r+",
         }
 
+        self.WRITE_MODES = {
+            "pickle": "wb",
+            "json": "w",
+        }
+
+        # Number of previous versions kept next to each local file as <filename>.1 ... <filename>.N
+        self.local_generations = int(os.getenv("LOCAL_GENERATIONS", 0))
+
         self.save_functions = {
             "cloudcube": self.__save_to_cc,
             "local": self.__save_to_local,
+            "sqlite": self.__save_to_sqlite,
         }
 
         self.load_functions = {
             "cloudcube": self.__load_from_cc,
             "local": self.__load_from_local,
+            "sqlite": self.__load_from_sqlite,
+        }
+
+        self.list_functions = {
+            "cloudcube": self.__list_on_cc,
+            "local": self.__list_on_local,
+            "sqlite": self.__list_on_sqlite,
+        }
+
+        self.delete_functions = {
+            "cloudcube": self.__delete_on_cc,
+            "local": self.__delete_on_local,
+            "sqlite": self.__delete_on_sqlite,
+        }
+
+        self.append_functions = {
+            "cloudcube": self.__append_to_cc,
+            "local": self.__append_to_local,
+            "sqlite": self.__append_to_sqlite,
+        }
+
+        self.load_journal_functions = {
+            "cloudcube": self.__load_journal_from_cc,
+            "local": self.__load_journal_from_local,
+            "sqlite": self.__load_journal_from_sqlite,
+        }
+
+        self.truncate_journal_functions = {
+            "cloudcube": self.__truncate_journal_on_cc,
+            "local": self.__truncate_journal_on_local,
+            "sqlite": self.__truncate_journal_on_sqlite,
         }
 
         # Storage type passed in overrides storage type set by env
@@ -77,25 +343,93 @@ class Storage:
             aws_secret_access_key=self.CLOUDCUBE_SECRET_ACCESS_KEY,
         )
 
+    def __init_sqlite(self):
+        self.SQLITE_PATH = os.getenv("SQLITE_PATH", "guilds.{}.sqlite3".format(os.getenv("MODE", "dev")))
+        # One connection shared by all threads, serialized by sqlite_lock
+        self.db = sqlite3.connect(self.SQLITE_PATH, check_same_thread=False, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.sqlite_lock = threading.RLock()
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SQLITE_SCHEMA)
+        for table, column, definition in SQLITE_ADDED_COLUMNS:
+            columns = [r["name"] for r in self.db.execute("PRAGMA table_info({})".format(table))]
+            if column not in columns:
+                self.db.execute("ALTER TABLE {} ADD COLUMN {} {}".format(table, column, definition))
+
     def __save_to_local(self, obj, filename, file_type):
-        with open(filename, "w+") as f:  # Ensure file exists
-            f.write("")
-        with open(filename, self.FILE_MODES.get(file_type)) as f:
-            self.SERIALIZERS.get(file_type).dump(obj, f)
+        """Writes to a temp file next to filename, fsyncs it and renames it over filename,
+        so a crash leaves either the old or the new file but never a partial one."""
+        dirname = os.path.dirname(filename)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=dirname or ".", prefix=os.path.basename(filename) + ".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, self.WRITE_MODES.get(file_type)) as f:
+                self.SERIALIZERS.get(file_type).dump(obj, f)  # Streams chunks instead of building one string
+                f.flush()
+                os.fsync(f.fileno())
+                self.__written("savefile", os.fstat(f.fileno()).st_size)
+            self.__rotate_local(filename)
+            os.replace(tmp, filename)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        self.__fsync_dir(dirname or ".")
+        return True
+
+    def __rotate_local(self, filename):
+        if self.local_generations <= 0 or not os.path.exists(filename):
+            return
+        for i in range(self.local_generations - 1, 0, -1):
+            older = "{}.{}".format(filename, i)
+            if os.path.exists(older):
+                os.replace(older, "{}.{}".format(filename, i + 1))
+        # Hard link so that filename itself never disappears before the new version replaces it
+        try:
+            os.remove(filename + ".1")
+        except FileNotFoundError:
+            pass
+        os.link(filename, filename + ".1")
+
+    @staticmethod
+    def __fsync_dir(dirname):
+        try:
+            fd = os.open(dirname, os.O_RDONLY)
+        except OSError:
+            return  # Directories cannot be opened on some platforms
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
 
     def __load_from_local(self, filename, file_type):
-        with open(filename, self.FILE_MODES.get(file_type)) as f:
+        # Fall back to older generations if the latest file cannot be read
+        candidates = [filename] + ["{}.{}".format(filename, i + 1) for i in range(self.local_generations)]
+        for candidate in candidates:
             try:
-                return self.SERIALIZERS.get(file_type).load(f)
+                with open(candidate, self.FILE_MODES.get(file_type)) as f:
+                    return self.SERIALIZERS.get(file_type).load(f)
             except FileNotFoundError:
-                return None
+                if candidate == filename:
+                    return None
+            except (ValueError, EOFError, pickle.UnpicklingError) as e:
+                print("Could not load {}: {}".format(candidate, e))
+        return None
+
+    def __encode(self, obj, file_type):
+        """Whole body of obj for backends that take one. Encoded in one shot, json's C encoder only
+        runs in one shot and is several times faster than streaming with the pure Python one."""
+        data = self.SERIALIZERS.get(file_type).dumps(obj)
+        return data.encode("utf-8") if isinstance(data, str) else data
 
     def __save_to_cc(self, obj, filename, file_type):
-        d = self.SERIALIZERS.get(file_type).dumps(obj)
+        data = self.__encode(obj, file_type)
+        self.__written("savefile", len(data))
         try:
             self.s3.put_object(Bucket=self.CLOUDCUBE_BUCKET,
                                Key="{}{}".format(self.CLOUDCUBE_KEY_PREFIX, filename),
-                               Body=d)
+                               Body=data)
         except ClientError as e:
             print(e)
             return False
@@ -112,8 +446,266 @@ class Storage:
         data = resp["Body"].read()
         return self.SERIALIZERS.get(file_type).loads(data)
 
+    def __list_on_local(self, prefix):
+        try:
+            return sorted(os.path.join(prefix, f) for f in os.listdir(prefix))
+        except FileNotFoundError:
+            return []
+
+    def __delete_on_local(self, filename):
+        try:
+            os.remove(filename)
+        except FileNotFoundError:
+            pass
+
+    def __list_on_cc(self, prefix):
+        keys = []
+        kwargs = {"Bucket": self.CLOUDCUBE_BUCKET,
+                  "Prefix": "{}{}".format(self.CLOUDCUBE_KEY_PREFIX, prefix)}
+        try:
+            while True:
+                resp = self.s3.list_objects_v2(**kwargs)
+                keys += [o["Key"] for o in resp.get("Contents", [])]
+                if not resp.get("IsTruncated"):
+                    break
+                kwargs["ContinuationToken"] = resp["NextContinuationToken"]
+        except ClientError as e:
+            print(e)
+        # Filenames are returned relative to the key prefix, the same way they are passed in
+        return sorted(k[len(self.CLOUDCUBE_KEY_PREFIX):] for k in keys)
+
+    def __delete_on_cc(self, filename):
+        try:
+            self.s3.delete_object(Bucket=self.CLOUDCUBE_BUCKET,
+                                  Key="{}{}".format(self.CLOUDCUBE_KEY_PREFIX, filename))
+        except ClientError as e:
+            print(e)
+
+    def __save_to_sqlite(self, obj, filename, file_type):
+        data = self.__encode(obj, file_type)
+        self.__written("savefile", len(data))
+        with self.sqlite_lock:
+            self.db.execute("INSERT OR REPLACE INTO files (filename, data) VALUES (?, ?)", (filename, data))
+        return True
+
+    def __load_from_sqlite(self, filename, file_type):
+        with self.sqlite_lock:
+            row = self.db.execute("SELECT data FROM files WHERE filename = ?", (filename,)).fetchone()
+        if row is None:
+            return None
+        return self.SERIALIZERS.get(file_type).loads(row["data"])
+
+    def __list_on_sqlite(self, prefix):
+        with self.sqlite_lock:
+            rows = self.db.execute("SELECT filename FROM files WHERE substr(filename, 1, ?) = ? ORDER BY filename",
+                                   (len(prefix), prefix)).fetchall()
+        return [r["filename"] for r in rows]
+
+    def __delete_on_sqlite(self, filename):
+        with self.sqlite_lock:
+            self.db.execute("DELETE FROM files WHERE filename = ?", (filename,))
+
+    def __append_to_sqlite(self, records, filename):
+        rows = [(filename, MODJson.dumps(r)) for r in records]
+        self.__written("appendfile", sum(len(r[1]) for r in rows))
+        with self.sqlite_lock:
+            self.db.executemany("INSERT INTO journal (filename, data) VALUES (?, ?)", rows)
+        return True
+
+    def __load_journal_from_sqlite(self, filename):
+        with self.sqlite_lock:
+            rows = self.db.execute("SELECT data FROM journal WHERE filename = ? ORDER BY rowid", (filename,)).fetchall()
+        return self.__parse_journal_lines([r["data"] for r in rows])
+
+    def __truncate_journal_on_sqlite(self, filename):
+        with self.sqlite_lock:
+            self.db.execute("DELETE FROM journal WHERE filename = ?", (filename,))
+
+    # Journals are stored as json lines, one record per line.
+    # S3 objects cannot be appended to, so on cloudcube every append is its own object under <filename>/
+    def __append_to_local(self, records, filename):
+        try:
+            with open(filename, "a") as f:
+                for r in records:
+                    self.__written("appendfile", f.write(MODJson.dumps(r) + "\n"))
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError as e:
+            print(e)
+            return False
+        return True
+
+    def __load_journal_from_local(self, filename):
+        try:
+            with open(filename, "r") as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return []
+        return self.__parse_journal_lines(lines)
+
+    def __truncate_journal_on_local(self, filename):
+        with open(filename, "w") as f:
+            f.write("")
+
+    def __append_to_cc(self, records, filename):
+        d = "".join(MODJson.dumps(r) + "\n" for r in records)
+        self.__written("appendfile", len(d))
+        try:
+            self.s3.put_object(Bucket=self.CLOUDCUBE_BUCKET,
+                               Key="{}{}/{:020d}".format(self.CLOUDCUBE_KEY_PREFIX, filename, time.time_ns()),
+                               Body=d)
+        except ClientError as e:
+            print(e)
+            return False
+        return True
+
+    def __load_journal_from_cc(self, filename):
+        lines = []
+        try:
+            for name in self.__list_on_cc(filename + "/"):
+                resp = self.s3.get_object(Bucket=self.CLOUDCUBE_BUCKET,
+                                          Key="{}{}".format(self.CLOUDCUBE_KEY_PREFIX, name))
+                lines += resp["Body"].read().decode("utf-8").splitlines()
+        except ClientError as e:
+            print(e)
+        return self.__parse_journal_lines(lines)
+
+    def __truncate_journal_on_cc(self, filename):
+        try:
+            keys = ["{}{}".format(self.CLOUDCUBE_KEY_PREFIX, name) for name in self.__list_on_cc(filename + "/")]
+            for i in range(0, len(keys), 1000):  # delete_objects takes at most 1000 keys
+                self.s3.delete_objects(Bucket=self.CLOUDCUBE_BUCKET,
+                                       Delete={"Objects": [{"Key": k} for k in keys[i:i + 1000]]})
+        except ClientError as e:
+            print(e)
+
+    @staticmethod
+    def __parse_journal_lines(lines):
+        records = []
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                records.append(MODJson.loads(line))
+            except ValueError:
+                # A torn last line from a crash mid-append, everything before it is intact
+                print("Skipping corrupt journal line: {}".format(line))
+        return records
+
+    @contextmanager
+    def __timed(self, op):
+        with metrics.storage_seconds.time(self.storage_type, op), profiler.span("storage"):
+            yield
+
+    def __written(self, op, size):
+        self.bytes_written += size
+        metrics.storage_bytes.inc(size, self.storage_type, op)
+
     def savefile(self, obj, filename, file_type):
-        self.save_functions[self.storage_type](obj, filename, file_type)
+        with self.__timed("savefile"):
+            return self.save_functions[self.storage_type](obj, filename, file_type)
 
     def loadfile(self, filename, file_type):
-        return self.load_functions[self.storage_type](filename, file_type)
+        with self.__timed("loadfile"):
+            return self.load_functions[self.storage_type](filename, file_type)
+
+    def listfiles(self, prefix):
+        with self.__timed("listfiles"):
+            return self.list_functions[self.storage_type](prefix)
+
+    def deletefile(self, filename):
+        with self.__timed("deletefile"):
+            self.delete_functions[self.storage_type](filename)
+
+    def appendfile(self, records, filename):
+        """Returns False if the records could not be appended."""
+        with self.__timed("appendfile"):
+            return self.append_functions[self.storage_type](records, filename)
+
+    def loadjournal(self, filename):
+        with self.__timed("loadjournal"):
+            return self.load_journal_functions[self.storage_type](filename)
+
+    def truncatejournal(self, filename):
+        with self.__timed("truncatejournal"):
+            self.truncate_journal_functions[self.storage_type](filename)
+
+    # Guild tables, only available on sqlite storage
+    def apply_records(self, records):
+        """Applies Guilds change records as row level upserts and deletes in one transaction."""
+        with self.sqlite_lock, self.__timed("apply_records"):
+            c = self.db.cursor()
+            c.execute("BEGIN")
+            try:
+                for r in records:
+                    if r["op"] == "set":
+                        _sqlite_set_guild(c, r["chat_id"], r["data"])
+                    elif r["op"] == "remove":
+                        _sqlite_remove_guild(c, r["chat_id"])
+                    elif r["op"] in SQLITE_OPS:
+                        SQLITE_OPS[r["op"]](c, r["chat_id"], *r.get("args", []))
+                    else:
+                        print("Unknown record: {}".format(r))
+                c.execute("COMMIT")
+            except BaseException:
+                c.execute("ROLLBACK")
+                raise
+
+    def guild_index(self):
+        """Returns {chat_id: Guild.index_entry()} for every stored guild."""
+        with self.sqlite_lock:
+            rows = self.db.execute("SELECT chat_id, stopped, daily_reset_time, last_reset FROM guilds "
+                                   "ORDER BY rowid").fetchall()
+            expeditions = self.db.execute("SELECT chat_id, slug, time FROM expeditions ORDER BY rowid").fetchall()
+        index = {r["chat_id"]: {"stopped": bool(r["stopped"]), "expeditions": {},
+                                "daily_reset_time": r["daily_reset_time"], "last_reset": r["last_reset"]}
+                 for r in rows}
+        for e in expeditions:
+            if e["chat_id"] in index:
+                index[e["chat_id"]]["expeditions"][e["slug"]] = e["time"]
+        return index
+
+    def load_guild(self, chat_id):
+        """Returns a single guild in the same json format as the savefile, or None."""
+        with self.sqlite_lock:
+            g = self.db.execute("SELECT * FROM guilds WHERE chat_id = ?", (chat_id,)).fetchone()
+            if g is None:
+                return None
+            expeditions = self.db.execute("SELECT * FROM expeditions WHERE chat_id = ? ORDER BY rowid",
+                                          (chat_id,)).fetchall()
+            rosters = {roster: self.db.execute("SELECT * FROM {} WHERE chat_id = ? ORDER BY rowid".format(table),
+                                               (chat_id,)).fetchall()
+                       for roster, table in SQLITE_ROSTERS.items()}
+            attendance = self.db.execute("SELECT * FROM fort_attendance WHERE chat_id = ? ORDER BY rowid",
+                                         (chat_id,)).fetchall()
+            history = self.db.execute("SELECT * FROM fort_history WHERE chat_id = ? ORDER BY rowid",
+                                      (chat_id,)).fetchall()
+
+        def player(r):
+            return {"tg_handle": r["tg_handle"], "tg_id": r["tg_id"], "label": r["label"]}
+
+        return {
+            "title": g["title"],
+            "members": json.loads(g["members"]),
+            "expeditions": {e["slug"]: {"time": e["time"],
+                                        "title": e["title"],
+                                        "description": e["description"],
+                                        **{roster: [player(r) for r in rows if r["slug"] == e["slug"]]
+                                           for roster, rows in rosters.items()}}
+                            for e in expeditions},
+            "fort": {"roster": json.loads(g["fort_roster"]),
+                     "attendance": [player(r) for r in attendance],
+                     "history": {"{}:{}".format(r["tg_id"], r["label"]): r["count"] for r in history},
+                     "handles": {"{}:{}".format(r["tg_id"], r["label"]): r["tg_handle"]
+                                 for r in history if r["tg_handle"] is not None}},
+            "pinned_message_id": g["pinned_message_id"],
+            "chat_id": chat_id,
+            "daily_reset_time": g["daily_reset_time"],
+            "stopped": bool(g["stopped"]),
+            "last_reset": g["last_reset"],
+        }
+
+    def import_guilds(self, data):
+        """One-shot import of a guilds.<MODE>.json savefile into the guild tables."""
+        self.apply_records([{"op": "set", "chat_id": int(chat_id), "data": guild}
+                            for chat_id, guild in data["guilds"].items()])
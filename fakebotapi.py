@@ -0,0 +1,104 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+from telebot import apihelper
+
+
+def use_api_url(url):
+    """Points telebot at another Bot API server, e.g. a FakeBotApi. url is formatted with (token, method)."""
+    apihelper.API_URL = url
+    # Older telebot versions bind API_URL as the default base_url of _make_request
+    defaults = apihelper._make_request.__defaults__
+    if defaults is not None and "base_url" in apihelper._make_request.__code__.co_varnames:
+        apihelper._make_request.__defaults__ = defaults[:-1] + (url,)
+
+
+class FakeBotApi:
+    """Local stand-in for the Telegram Bot API, for tests and load tests.
+
+    Every call is recorded in calls as (time, method, params). fail(method, status, retry_after) queues
+    an error response for the next call to method.
+    """
+
+    def __init__(self, port=0, latency=0):
+        self.calls = []
+        self.failures = {}
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.message_id = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self.__handler())
+        self.server.daemon_threads = True
+        self.url = "http://127.0.0.1:{}/bot{{0}}/{{1}}".format(self.server.server_address[1])
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def fail(self, method, status, retry_after=None, times=1):
+        with self.lock:
+            self.failures.setdefault(method, []).extend([(status, retry_after)] * times)
+
+    def calls_to(self, method):
+        with self.lock:
+            return [c for c in self.calls if c[1] == method]
+
+    def respond(self, method, params):
+        with self.lock:
+            self.calls.append((time.monotonic(), method, params))
+            failures = self.failures.get(method)
+            if failures:
+                status, retry_after = failures.pop(0)
+                body = {"ok": False, "error_code": status, "description": "Fake error"}
+                if retry_after is not None:
+                    body["description"] = "Too Many Requests: retry after {}".format(retry_after)
+                    body["parameters"] = {"retry_after": retry_after}
+                return status, body
+            if method in ["sendMessage", "editMessageText"]:
+                if method == "sendMessage":
+                    self.message_id += 1
+                message_id = int(params.get("message_id", self.message_id))
+                chat_id = int(params.get("chat_id", 0))
+                return 200, {"ok": True, "result": {
+                    "message_id": message_id,
+                    "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "group" if chat_id < 0 else "private"},
+                    "text": params.get("text", ""),
+                }}
+            if method == "getMe":
+                return 200, {"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}}
+            return 200, {"ok": True, "result": True}
+
+    def __handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def handle_one(self):
+                url = urlparse(self.path)
+                params = dict(parse_qsl(url.query))
+                length = int(self.headers.get("Content-Length") or 0)
+                if length:
+                    params.update(parse_qsl(self.rfile.read(length).decode("utf-8")))
+                if api.latency:
+                    time.sleep(api.latency)
+                status, body = api.respond(url.path.rsplit("/", 1)[-1], params)
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = handle_one
+            do_POST = handle_one
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
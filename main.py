@@ -1,33 +1,58 @@
+import asyncio
 import telebot
 import threading
 import time
 import os
+import atexit
+import signal
+import sys
 import logging
 import json
 from flask import Flask, request
 
+import metrics
 import models as m
 from renderers import *
 from custom_errors import *
+from scheduler import DeletionScheduler, PinnedEditCoalescer, ReminderScheduler, ResetScheduler
+import outbound as o
+import profiler
+from router import Arg, Router
+from updates import UpdateQueue
 import utils
+import ascentapi
 
 from dotenv import load_dotenv
 load_dotenv()
 
 __token__ = os.getenv("TG_TOKEN")
+__listen_mode__ = os.getenv("LISTEN_MODE")
 telebot.logger.setLevel(logging.INFO)
-bot = telebot.AsyncTeleBot(__token__)
+# Handlers run on the thread that processes the update, except when polling where telebot's pool runs them
+bot = telebot.TeleBot(__token__, threaded=__listen_mode__ not in ["asyncio", "webhook"])
+# Every call to a chat goes through the outbound queue, the bot only receives updates
+# The asyncio runtime sends from the event loop instead of worker threads
+outbound = o.Outbound(telebot.TeleBot(__token__), workers=0 if __listen_mode__ == "asyncio" else 4,
+                      global_rate=float(os.getenv("OUTBOUND_GLOBAL_RATE", 30)),
+                      group_rate=float(os.getenv("OUTBOUND_GROUP_RATE", 20 / 60)),
+                      private_rate=float(os.getenv("OUTBOUND_PRIVATE_RATE", 1)))
 
 guilds = m.Guilds.load()
 
 with open('feature_whitelist.json') as f:
     __feature_whitelist__ = json.load(f)
 
+# Telegram user ids allowed to run operator commands like /admin profile
+__operators__ = [int(i) for i in os.getenv("OPERATORS", "").split(",") if i.strip()]
+
 with open('sauron.json') as f:
     __sauron__ = json.load(f)
 print(__sauron__)
 
 
+sauron_digest = o.Digest(outbound, __sauron__["out"], max_delay=int(os.getenv("SAURON_MAX_DELAY", 30)))
+
+
 ################################
 #       Middleware             #
 ################################
@@ -43,7 +68,7 @@ def needs_to_be_sauroned(message):
 def handle_sauron(message):
     nazgul = "[({}){}]:{}".format(message.chat.title, message.from_user.username, message.text)
     print(nazgul)
-    bot.send_message(__sauron__["out"], nazgul)
+    sauron_digest.add(nazgul)
 
 
 # TODO: This is hack to keep fort feature only for ascent
@@ -54,369 +79,304 @@ def ensure_feature_whitelisted(command, message):
         raise FeatureForbidden(message.chat.id)
 
 
+def ensure_operator(message):
+    if message.from_user.id not in __operators__:
+        raise OperatorOnlyError
+
+
+def _render_pinned_msg(guild):
+    return render_guild_admin(guild), render_poll_markup(guild)
+
+
+def _edit_pinned_msg(guild, text, markup):
+    return outbound.edit_message_text(text,
+                                      chat_id=guild.chat_id,
+                                      message_id=guild.pinned_message_id,
+                                      parse_mode="Markdown",
+                                      reply_markup=markup,
+                                      priority=o.PRIORITY_PIN)
+
+
+pinned_edits = PinnedEditCoalescer(guilds, _render_pinned_msg, _edit_pinned_msg)
+
+
 def _update_pinned_msg(guild):
     if guild.pinned_message_id is not None:
-        bot.edit_message_text(render_guild_admin(guild),
-                              chat_id=guild.chat_id,
-                              message_id=guild.pinned_message_id,
-                              parse_mode="Markdown",
-                              reply_markup=render_poll_markup(guild))
+        pinned_edits.request(guild.chat_id)
 
 
-def process_command(commands, message, doc):
+def process_command(route, message, doc, kind="command"):
+    """Runs the command of route, doc is the reply if the route has none."""
+    started = time.monotonic()
     try:
-        parts = message.text.split(' ')
-        ensure_feature_whitelisted(parts[0], message)
+        ensure_feature_whitelisted(route.group, message)
         guild = guilds.get(message.chat.id)
-        if len(parts) >= 2 and parts[1] in commands:
-            command_str = parts[1]
-            answer = commands[command_str](message)
-            _update_pinned_msg(guild)
-            guilds.save()
-        else:
+        if route.command is None:
             raise WrongCommandError(doc)
+        with profiler.span("parse"):
+            args = route.command.parse(route.argtext)
+        answer = route.command.handler(message, args)
+        _update_pinned_msg(guild)
+        guilds.request_save()
     except Exception as e:
         if issubclass(type(e), GuildError):
+            metrics.command_errors.inc(1, route.key, type(e).__name__)
             answer = m.MessageReply(e.message)
         else:
+            metrics.command_errors.inc(1, route.key, "exception")
             logging.exception(e)
             answer = m.MessageReply("Unknown error")
+    elapsed = time.monotonic() - started
+    metrics.command_seconds.observe(elapsed, route.key, kind)
+    metrics.guild_command_seconds.inc(elapsed, metrics.guild_bucket(message.chat.id))
     return answer
 
 
-def handle_command(commands, message, doc):
-    answer = process_command(commands, message, doc)
-    if answer is not None and len(answer.message) > 0:
-        sent = (bot.send_message(message.chat.id, answer.message,
-                                 parse_mode="Markdown",
-                                 disable_notification=True,
-                                 reply_markup=answer.reply_markup,
-                                 )).wait()
-        if answer.temporary:
-            delete_command_and_reply(message, sent)
+def handle_command(message):
+    route = router.match(message.text)
+    with profiler.profiler.command(route.key, message.chat.id):
+        answer = process_command(route, message, router.usage(route.group))
+        if answer is not None and len(answer.message) > 0:
+            sent = outbound.send_message(message.chat.id, answer.message,
+                                         parse_mode="Markdown",
+                                         disable_notification=True,
+                                         reply_markup=answer.reply_markup,
+                                         )
+            # The handler does not wait for the reply, its deletion is scheduled once it is sent
+            if answer.temporary:
+                sent.add_done_callback(lambda task: delete_command_and_reply(message, task.result))
 
 
-def handle_callback(commands, call):
-    # monkey patch message data to format of text commands
-    call.message.text = call.data
+def handle_callback(call):
+    # Handlers read the user from the message, as for text commands
     call.message.from_user = call.from_user
-    answer = process_command(commands, call.message, "Command received: {}".format(call.data))
-    bot.answer_callback_query(call.id, text=answer.message)
+    route = router.decode(call.data)
+    with profiler.profiler.command(route.key, call.message.chat.id):
+        answer = process_command(route, call.message, "Command received: {}".format(call.data), kind="callback")
+        outbound.answer_callback_query(call.id, text=answer.message)
+
+
+def _delete_messages(batch):
+    for chat_id, message_id in batch:
+        outbound.delete_message(chat_id, message_id)
+
+
+deletions = DeletionScheduler(guilds.storage, _delete_messages)
+deletions.load()
+atexit.register(deletions.save)
 
 
 def delete_command_and_reply(message, reply):
-    def _delete_messages(msg, rep):
-        if type(rep) is tuple:
-            logging.error("Could not delete reply: {}".format(reply[1]))
-            return
-        time.sleep(5)
-        bot.delete_message(msg.chat.id, msg.message_id)
-        bot.delete_message(msg.chat.id, reply.message_id)
-    del_task = threading.Thread(target=_delete_messages, args=(message, reply), daemon=True)
-    del_task.start()
+    if type(reply) is tuple:
+        logging.error("Could not delete reply: {}".format(reply[1]))
+        return
+    deletions.schedule(message.chat.id, message.message_id)
+    deletions.schedule(message.chat.id, reply.message_id)
 
 
 ################################
-#       Callback Handlers      #
+#       Command Registry       #
 ################################
-@bot.callback_query_handler(func=lambda c: True)
-def cb_query_handler(call):
-    cb_handlers = {
-        'reg': exped_reg,
-        'mark': fort_mark,
-        'check': fort_check,
-        'ready': exped_ready,
-        'reassign': fort_reassign,
-    }
-    handle_callback(cb_handlers, call)
+# Every /exped, /fort and /admin subcommand declares its arguments once. Handlers are called with
+# (message, args), args holding the parsed arguments by name.
+router = Router()
+LABEL = Arg("label", default="")
 
 
 ################################
 #       Expedition Handlers    #
 ################################
-def exped_new(message):
-    doc = """Example:
+@router.command("exped", "new", [Arg("title"), Arg("time"), Arg("description", default="", rest=True)], doc="""Example:
 /exped new team1 1500
 /exped new team1 1500 description
-    """
-    parts = message.text.split(' ', 4)
-    if len(parts) not in [4, 5]:
-        raise WrongCommandError(doc)
-    time = parts[3]
-    title = parts[2]
-    try:
-        description = parts[4]
-    except IndexError:
-        description = ""
-
+    """)
+def exped_new(message, args):
     try:
         guild = guilds.get(message.chat.id)
-        e = guild.new_expedition(title, time, description)
-        return m.MessageReply("Expedition created: {} {}".format(escape_for_markdown(e.title), time))
+        e = guild.new_expedition(args.title, args.time, args.description)
+        return m.MessageReply("Expedition created: {} {}".format(escape_for_markdown(e.title), args.time))
     except ValueError:
-        raise WrongCommandError(doc)
+        raise WrongCommandError(exped_new.command.doc)
 
 
-def exped_title(message):
-    doc = """Example:
+@router.command("exped", "title", [Arg("oldtitle"), Arg("newtitle")], doc="""Example:
 /exped title oldtitle newtitle
-        """
-    parts = message.text.split(' ')
-    if len(parts) != 4:
-        raise WrongCommandError(doc)
-
-    guild = guilds.get(message.chat.id)
-    guild.set_expedition_title(parts[2], parts[3])
-    return m.MessageReply("{} updated to {}".format(escape_for_markdown(parts[2]), escape_for_markdown(parts[3])))
+        """)
+def exped_title(message, args):
+    try:
+        guild = guilds.get(message.chat.id)
+        guild.set_expedition_title(args.oldtitle, args.newtitle)
+        return m.MessageReply("{} updated to {}".format(escape_for_markdown(args.oldtitle),
+                                                        escape_for_markdown(args.newtitle)))
+    except ValueError:
+        raise WrongCommandError(exped_title.command.doc)
 
 
-def exped_description(message):
-    doc = """Example:
+@router.command("exped", "desc", [Arg("title"), Arg("description", default="", rest=True)], doc="""Example:
 /exped desc name description
-    """
-    parts = message.text.split(' ', 3)
-    if len(parts) < 3:
-        raise WrongCommandError(doc)
-    if len(parts) == 3:
-        parts = parts + [""]
-
+    """)
+def exped_description(message, args):
     guild = guilds.get(message.chat.id)
-    e = guild.set_expedition_description(parts[2], parts[3])
+    e = guild.set_expedition_description(args.title, args.description)
     return m.MessageReply("{} description updated".format(escape_for_markdown(e.title)))
 
 
-def exped_time(message):
-    doc = """Example:
+@router.command("exped", "time", [Arg("title"), Arg("time")], doc="""Example:
 /exped time team HHMM
-        """
-    parts = message.text.split(' ')
-    if len(parts) != 4:
-        raise WrongCommandError(doc)
+        """)
+def exped_time(message, args):
     try:
         guild = guilds.get(message.chat.id)
-        e = guild.set_expedition_time(parts[2], parts[3])
-        return m.MessageReply("{} updated to {}".format(escape_for_markdown(e.title), parts[3]))
+        e = guild.set_expedition_time(args.title, args.time)
+        return m.MessageReply("{} updated to {}".format(escape_for_markdown(e.title), args.time))
     except ValueError:
-        raise WrongCommandError(doc)
+        raise WrongCommandError(exped_time.command.doc)
 
 
-def exped_delete(message):
-    doc = """Example:
+@router.command("exped", "delete", [Arg("title")], doc="""Example:
 /exped delete team
-    """
-    parts = message.text.split(' ')
-    if len(parts) == 3:
-        guild = guilds.get(message.chat.id)
-        guild.delete_expedition(parts[2])
-        return m.MessageReply("{} deleted.".format(parts[2]))
-    else:
-        raise WrongCommandError(doc)
+    """)
+def exped_delete(message, args):
+    guild = guilds.get(message.chat.id)
+    guild.delete_expedition(args.title)
+    return m.MessageReply("{} deleted.".format(args.title))
 
 
-def exped_reg(message):
-    doc = """Example:
+@router.command("exped", "reg", [Arg("title"), LABEL], callback=True, doc="""Example:
 /exped reg team
 /exped reg team [label]
-        """
-    parts = message.text.split(' ')
-    if len(parts) == 4:
-        label = parts[3]
-    elif len(parts) == 3:
-        label = ""
-    else:
-        raise WrongCommandError(doc)
-
-    title = parts[2]
+        """)
+def exped_reg(message, args):
     handle = message.from_user.first_name
     handle_id = message.from_user.id
     guild = guilds.get(message.chat.id)
 
     try:
-        e, member = guild.checkin_expedition(title, handle_id, handle, label)
+        e, member = guild.checkin_expedition(args.title, handle_id, handle, args.label)
         answer_text = "{} checked in to {}".format(member.tg_handle, e.title)
     except ExpedMemberAlreadyExists:
-        e, member = guild.checkout_expedition(title, handle_id, handle, label)
+        e, member = guild.checkout_expedition(args.title, handle_id, handle, args.label)
         answer_text = "{} checked out of {}".format(member.tg_handle, e.title)
     return m.MessageReply(answer_text)
 
 
-def exped_daily(message):
-    doc = """Example:
+@router.command("exped", "daily", [Arg("title"), LABEL], doc="""Example:
 /exped daily team
 /exped daily team [label]
-        """
-    parts = message.text.split(' ')
-    if len(parts) == 4:
-        label = parts[3]
-    elif len(parts) == 3:
-        label = ""
-    else:
-        raise WrongCommandError(doc)
-
-    title = parts[2]
+        """)
+def exped_daily(message, args):
     handle = message.from_user.first_name
     handle_id = message.from_user.id
     guild = guilds.get(message.chat.id)
 
-    e, success = guild.daily_expedition(title, handle_id, handle, label)
+    e, success = guild.daily_expedition(args.title, handle_id, handle, args.label)
     word = "in to" if success else "out of"
     return m.MessageReply("{} checked {} daily {}".format(handle, word, e.title))
-    
 
-def exped_view(message):
-    doc = """Example:
+
+@router.command("exped", "view", [Arg("team", default=None)], doc="""Example:
 /exped view
 /exped view [team]
-    """
-    parts = message.text.split(' ')
-    if len(parts) == 3:
-        team = parts[2]
-    else:
-        team = None
+    """)
+def exped_view(message, args):
     guild = guilds.get(message.chat.id)
-    if team:
-        exped = guild.get_expedition(team)
+    if args.team:
+        exped = guild.get_expedition(args.team)
         return m.MessageReply(render_expedition_detail(exped), temporary=False)
     else:
         expeds = list(guild.expeditions.values())
         return m.MessageReply(render_expeditions(expeds,
-                                             guild_reset_time=guild.daily_reset_time,
-                                             filter=False
-                                             ),
-                          temporary=False)
+                                                 guild_reset_time=guild.daily_reset_time,
+                                                 filter=False
+                                                 ),
+                              temporary=False)
 
 
-def exped_ready(message):
-    doc = """Example:
+@router.command("exped", "ready", [Arg("title"), LABEL], text=False, callback=True, doc="""Example:
 /exped ready team
 /exped ready team [label]
-    """
-    parts = message.text.split(' ')
-    if len(parts) == 4:
-        label = parts[3]
-    elif len(parts) == 3:
-        label = ""
-    else:
-        raise WrongCommandError(doc)
-
-    title = parts[2]
+    """)
+def exped_ready(message, args):
     handle = message.from_user.first_name
     handle_id = message.from_user.id
     guild = guilds.get(message.chat.id)
 
-    e, result = guild.ready_expedition(title, handle_id, handle, label)
-    bot.edit_message_text(render_expedition_reminder(e),
-                          chat_id=guild.chat_id,
-                          message_id=message.message_id,
-                          parse_mode="Markdown",
-                          reply_markup=render_ready_markup(e))
+    e, result = guild.ready_expedition(args.title, handle_id, handle, args.label)
+    outbound.edit_message_text(render_expedition_reminder(e),
+                               chat_id=guild.chat_id,
+                               message_id=message.message_id,
+                               parse_mode="Markdown",
+                               reply_markup=render_ready_markup(e))
 
     ready_string = "ready" if result else "not ready"
     return m.MessageReply("You are marked as {} for {}.".format(ready_string, e.title))
 
 
-@bot.edited_message_handler(commands=['exped'])
-@bot.message_handler(commands=['exped'])
-def exped(message):
-    exped_commands = {
-        'reg': exped_reg,
-        'new': exped_new,
-        'delete': exped_delete,
-        'time': exped_time,
-        'title': exped_title,
-        'desc': exped_description,
-        'view': exped_view,
-        'daily': exped_daily
-    }
-    doc = """
-/exped command [arguments...]
-Available commands are : {}
-    """.format([a for a in exped_commands.keys()])
-    handle_command(exped_commands, message, doc)
-
-
 ################################
 #       Fort Handlers          #
 ################################
-def fort_mark(message):
-    doc = """Example:
+@router.command("fort", "mark", [LABEL], callback=True, doc="""Example:
 /fort mark
 /fort mark <alt>
-"""
-    parts = message.text.split(' ')
-    if len(parts) == 3:
-        label = parts[2]
-    elif len(parts) == 2:
-        label = ""
-    else:
-        raise WrongCommandError(doc)
-
+""")
+def fort_mark(message, args):
     guild = guilds.get(message.chat.id)
     handle = message.from_user.first_name
     handle_id = message.from_user.id
 
     try:
-        guild.fort_mark(handle_id, handle, label)
+        guild.fort_mark(handle_id, handle, args.label)
         answer_text = "Attendance added for {}".format(handle)
     except FortAttendanceExistsError:
-        guild.fort_unmark(handle_id, handle, label)
+        guild.fort_unmark(handle_id, handle, args.label)
         answer_text = "Attendance removed for {}".format(handle)
     return m.MessageReply(answer_text)
 
 
-def fort_check(message):
-    doc = """Example:
+@router.command("fort", "check", [LABEL], callback=True, doc="""Example:
 /fort check
 /fort check <alt>
-    """
-    parts = message.text.split(' ')
-    if len(parts) == 3:
-        label = parts[2]
-    elif len(parts) == 2:
-        label = ""
-    else:
-        raise WrongCommandError(doc)
-
+    """)
+def fort_check(message, args):
     guild = guilds.get(message.chat.id)
     handle = message.from_user.first_name
     handle_id = message.from_user.id
 
-    today = int(guild.get_attendance_today(handle_id, handle, label))
+    today = int(guild.get_attendance_today(handle_id, handle, args.label))
     try:
-        result = guild.get_history_of(handle_id, handle, label)
+        result = guild.get_history_of(handle_id, handle, args.label)
     except FortAttendanceNotFoundError:
         result = 0
     return m.MessageReply("Fort count for {}: {}".format(handle, result + today))
 
 
-def fort_reset_history(message):
-    doc = """Example:
+@router.command("fort", "reset_history", doc="""Example:
 /fort reset_history
-    """
+    """)
+def fort_reset_history(message, args):
     guild = guilds.get(message.chat.id)
     guild.reset_fort_history()
-    guilds.save()
     return m.MessageReply("Fort history reset.", temporary=False)
 
 
-def fort_get_history(message):
-    doc = """Example:
+@router.command("fort", "get_history", doc="""Example:
 /fort get_history
-    """
+    """)
+def fort_get_history(message, args):
     guild = guilds.get(message.chat.id)
     history = guild.get_history_all()
     current_day = dt.datetime.now().date()
     msg = "*Fort history {}/{}*\n".format(current_day.month, current_day.day)
-    for p in history:
-        msg += "{} : {}\n".format(p.tg_handle, history[p])
+    for key in history:
+        msg += "{} : {}\n".format(escape_for_markdown(guild.fort.name_of(key)), history[key])
     msg += "\nIf your name is not here, your recorded count is 0."
     return m.MessageReply(msg, temporary=False)
 
 
-def fort_get_roster(message):
-    doc = """Example:
+@router.command("fort", "get_roster", doc="""Example:
 /fort get_roster
-    """
+    """)
+def fort_get_roster(message, args):
     guild = guilds.get(message.chat.id)
     roster = guild.fort.get_roster()
     msg = render_fort_roster(roster)
@@ -428,56 +388,31 @@ def fort_get_roster(message):
                           )
 
 
-def fort_reassign(message):
-    doc = """Example:
+# Not a text command yet, only the roster button calls it
+@router.command("fort", "reassign", [Arg("player_out", default=None), Arg("player_in", default=None)],
+                text=False, callback=True, doc="""Example:
 /fort reassign
 /fort reassign <out>
 /fort reassign <out> <in>
 
-    """
-    player_in = None
-    player_out = None
-    parts = message.text.split(' ')
-    if len(parts) == 2:
-        player_out = message.from_user.username or message.from_user.first_name
-    if len(parts) >= 3:
-        player_out = parts[2]
-    if len(parts) == 4:
-        player_in = parts[3]
-    if len(parts) > 5:
-        raise WrongCommandError(doc)
-    return m.MessageReply("{} {}".format(player_in, player_out), temporary=False)
-
-
-@bot.edited_message_handler(commands=['fort'])
-@bot.message_handler(commands=['fort'])
-def fort(message):
-    fort_commands = {
-        'mark': fort_mark,
-        'check': fort_check,
-        'reset_history': fort_reset_history,
-        'get_history': fort_get_history,
-        'get_roster': fort_get_roster,
-        # 'reassign': fort_reassign,
-    }
-    doc = """
-/fort command [arguments...]
-Available commands are : {}
-    """.format([a for a in fort_commands.keys()])
-    handle_command(fort_commands, message, doc)
+    """)
+def fort_reassign(message, args):
+    player_out = args.player_out or message.from_user.username or message.from_user.first_name
+    return m.MessageReply("{} {}".format(args.player_in, player_out), temporary=False)
 
 
 ################################
 #       Admin Handlers         #
 ################################
-def _guild_pin(chat_id):
-    guild = guilds.get(chat_id)
+def _guild_pin(chat_id, record_use=True):
+    guild = guilds.get(chat_id, record_use=record_use)
     guild_msg = render_guild_admin(guild)
-    sent = bot.send_message(guild.chat_id,
-                            guild_msg,
-                            parse_mode="Markdown",
-                            reply_markup=render_poll_markup(guild),
-                            disable_notification=True).wait()
+    sent = outbound.send_message(guild.chat_id,
+                                 guild_msg,
+                                 parse_mode="Markdown",
+                                 reply_markup=render_poll_markup(guild),
+                                 disable_notification=True,
+                                 priority=o.PRIORITY_PIN).wait()
 
     if type(sent) is tuple:
         if "blocked" in sent[1].result.text:
@@ -485,139 +420,226 @@ def _guild_pin(chat_id):
         else:
             logging.error(sent[1].result.text)
     else:
-        guild.pinned_message_id = sent.message_id
-        bot.pin_chat_message(guild.chat_id, guild.pinned_message_id)
+        guild.set_pinned_message(sent.message_id)
+        outbound.pin_chat_message(guild.chat_id, guild.pinned_message_id)
     return None
 
 
-def guild_pin(message):
+@router.command("admin", "pin")
+def guild_pin(message, args):
     return _guild_pin(message.chat.id)
 
 
-@bot.edited_message_handler(commands=['admin'])
-@bot.message_handler(commands=['admin'])
-def admin(message):
-    admin_commands = {
-        "pin": guild_pin,
-    }
-    doc = """
-/admin command [arguments...]
-Available commands are : {}
-    """.format([a for a in admin_commands.keys()])
-    handle_command(admin_commands, message, doc)
+def _profile_amount(s):
+    """Parses 50 as the next 50 commands and 30s as 30 seconds, returns (commands, seconds)."""
+    if s.endswith("s"):
+        return None, float(s[:-1])
+    return int(s), None
+
+
+@router.command("admin", "profile", [Arg("mode"), Arg("amount", type=_profile_amount, default=None)], doc="""Example:
+/admin profile cprofile 50   (the next 50 commands)
+/admin profile sampling 30s   (all threads for 30 seconds)
+/admin profile stop
+""")
+def admin_profile(message, args):
+    ensure_operator(message)
+    if args.mode == "stop" and args.amount is None:
+        if not profiler.profiler.running():
+            return m.MessageReply("Not profiling.")
+        path = profiler.profiler.stop()
+        if path is None:
+            return m.MessageReply("Profile captured no commands.")
+        return m.MessageReply("Profile written to {}".format(path))
+    if args.mode not in ["cprofile", "sampling"] or args.amount is None:
+        raise WrongCommandError(admin_profile.command.doc)
+    commands, seconds = args.amount
+    try:
+        profiler.profiler.start(args.mode, commands=commands, seconds=seconds)
+    except ValueError as e:
+        return m.MessageReply(str(e))
+    return m.MessageReply("Profiling with {} for {}.".format(
+        args.mode, "{} commands".format(commands) if commands is not None else "{}s".format(seconds)))
+
+
+################################
+#       Command Handlers       #
+################################
+@bot.callback_query_handler(func=lambda c: True)
+def cb_query_handler(call):
+    handle_callback(call)
+
+
+@bot.edited_message_handler(commands=list(router.groups))
+@bot.message_handler(commands=list(router.groups))
+def command_handler(message):
+    handle_command(message)
 
 
 def _guild_stop(chat_id):
     g = guilds.get(chat_id)
-    setattr(g, "stopped", True)
+    g.stop()
 
 
 @bot.message_handler(commands=['stop'])
 def stop(message):
     try:
         _guild_stop(message.chat.id)
-        bot.send_message(message.chat.id, "Guild bot stopped.")
-        guilds.save()
+        outbound.send_message(message.chat.id, "Guild bot stopped.")
+        guilds.flush()
     except GuildNotFoundError:
-        bot.send_message(message.chat.id, "Guild bot already stopped.")
+        outbound.send_message(message.chat.id, "Guild bot already stopped.")
 
 
 @bot.message_handler(commands=['start'])
 def start(message):
     try:
         g = guilds.get(message.chat.id, ignore_stopped=True)
-        setattr(g, "stopped", False)
-        bot.send_message(message.chat.id, "Guild bot ready.")
+        g.start()
+        outbound.send_message(message.chat.id, "Guild bot ready.")
     except GuildNotFoundError:
-        guild = m.Guild()
+        guild = m.Guild(title=message.chat.title, chat_id=message.chat.id)
         guilds.set(message.chat.id, guild)
-        guild.chat_id = message.chat.id
-        guild.title = message.chat.title
-        bot.send_message(message.chat.id, "Guild bot initialized.")
+        outbound.send_message(message.chat.id, "Guild bot initialized.")
     finally:
-        guilds.save()
+        guilds.request_save()
 
 
 @bot.message_handler(commands=['reset_guild'])
 def reset(message):
-    guilds.guilds.pop(message.chat.id, None)
+    guilds.remove(message.chat.id)
     start(message)
+    guilds.flush()
+
+
+def _exped_remind(guild, e, delay):
+    if len(e.members) != 0:
+        return outbound.send_message(guild.chat_id,
+                                     render_expedition_reminder(e),
+                                     parse_mode="Markdown",
+                                     reply_markup=render_ready_markup(e),
+                                     priority=o.PRIORITY_REMINDER,
+                                     delay=delay,
+                                     )
+
+
+def _daily_reset_done(guild):
+    _guild_pin(guild.chat_id, record_use=False)
+    guilds.request_save()
 
 
 class GuildAutomation(object):
     def __init__(self):
-        tasks = [
-            self.daily_reset,
-            self.exped_reminder,
-            self.fort_reminder,
-        ]
+        self.reminders = ReminderScheduler(guilds, _exped_remind)
+        self.reminders.watch()
+        self.resets = ResetScheduler(guilds, _daily_reset_done)
+        self.resets.watch()
+        self.schedulers = [self.resets, self.reminders, pinned_edits, deletions]
+
+    def start_threads(self):
+        tasks = [s.run for s in self.schedulers] + [self.fort_reminder]
         for task in tasks:
             thread = threading.Thread(target=task, args=())
             thread.daemon = True
             thread.start()
 
-    def exped_reminder(self):
-        while True:
-            now = utils.get_singapore_time_now()
-            two_mins = now + dt.timedelta(minutes=2)
-            for guild in guilds.values():
-                if getattr(guild, "stopped", False):
-                    continue
-                for e in guild.expeditions.values():
-                    if utils.equal_hour_minute(e.get_time(), two_mins) and len(e.members) != 0:
-                        ready_markup = types.InlineKeyboardMarkup()
-                        ready_markup.add(
-                            types.InlineKeyboardButton(
-                                "Im ready!",
-                                callback_data="/exped ready {}".format(e.title)
-                            )
-                        )
-                        bot.send_message(guild.chat_id,
-                                         render_expedition_reminder(e),
-                                         parse_mode="Markdown",
-                                         reply_markup=ready_markup,
-                                         )
-            time.sleep(60)
+    def start_tasks(self, executor=None):
+        """Runs the same loops as asyncio tasks, for the asyncio runtime."""
+        for s in self.schedulers:
+            asyncio.ensure_future(s.run_async(executor))
+        asyncio.ensure_future(self.fort_reminder_async(executor))
 
-    def daily_reset(self):
+    def fort_reminder(self):
         while True:
-            now = utils.get_singapore_time_now()
-            for guild in guilds.values():
-                if getattr(guild, "stopped", False):
-                    continue
-                if now.hour == guild.daily_reset_time:
-                    guild.reset_expeditions()
-                    guild.update_fort_history()
-                    _guild_pin(guild.chat_id)
-            guilds.save()
-            time.sleep(60 * 60)
+            self.fort_remind()
+            time.sleep(60)
 
-    def fort_reminder(self):
+    async def fort_reminder_async(self, executor=None):
+        loop = asyncio.get_event_loop()
         while True:
-            ascent_chat_id = -1001235725395
-            guild = guilds.get(ascent_chat_id)
+            await loop.run_in_executor(executor, self.fort_remind)
+            await asyncio.sleep(60)
+
+    def fort_remind(self):
+        ascent_chat_id = -1001235725395
+        guild = guilds.get(ascent_chat_id, record_use=False)
+        now = utils.get_singapore_time_now()
+        if now.hour == 20 and now.minute == 52:
+            ascentapi.roster_cache.refresh()  # So the reminder goes out with a fresh roster
+        if now.hour == 20 and now.minute == 55:
             roster = guild.fort.get_roster()
-            now = utils.get_singapore_time_now()
-            if now.hour == 20 and now.minute == 55:
-                bot.send_message(ascent_chat_id,  # hard coded ascent chat id
-                                 "Fort Reminder:\n\n" + render_fort_roster(roster),
-                                 parse_mode="Markdown",
-                                 )
-            time.sleep(60)
+            outbound.send_message(ascent_chat_id,  # hard coded ascent chat id
+                                  "Fort Reminder:\n\n" + render_fort_roster(roster),
+                                  parse_mode="Markdown",
+                                  priority=o.PRIORITY_REMINDER,
+                                  )
+
 
+automation = GuildAutomation()
+if __listen_mode__ != "asyncio":
+    automation.start_threads()
 
-GuildAutomation()
+if os.getenv("PROFILE"):
+    # Profile from start up, for PROFILE_COMMANDS commands or else PROFILE_SECONDS seconds
+    if os.getenv("PROFILE_COMMANDS"):
+        profiler.profiler.start(os.getenv("PROFILE"), commands=int(os.getenv("PROFILE_COMMANDS")))
+    else:
+        profiler.profiler.start(os.getenv("PROFILE"), seconds=float(os.getenv("PROFILE_SECONDS", 60)))
+atexit.register(profiler.profiler.stop)
+
+metrics.Gauge("ascentbot_outbound_queued", "Bot API calls waiting to be sent", ["priority"],
+              collect=lambda: outbound.stats()["queued_by_priority"])
+metrics.Gauge("ascentbot_outbound_in_flight", "Chats with a Bot API call in flight",
+              collect=lambda: outbound.stats()["in_flight"])
+metrics.Gauge("ascentbot_outbound_blocked_chats", "Chats waiting out a 429",
+              collect=lambda: outbound.stats()["blocked_chats"])
+metrics.Counter("ascentbot_outbound_calls_total", "Bot API calls by how they ended", ["result"],
+                collect=lambda: dict(outbound.counters))
+metrics.Gauge("ascentbot_scheduled_pending", "Entries waiting in each automation scheduler", ["scheduler"],
+              collect=lambda: {type(s).__name__: s.pending() for s in automation.schedulers})
+metrics.Gauge("ascentbot_guilds_resident", "Guilds loaded in memory", collect=lambda: len(guilds.guilds))
+metrics.Gauge("ascentbot_guilds_save_requests", "Save requests not flushed yet", collect=lambda: guilds.save_requests)
+metrics.Counter("ascentbot_render_cache_total", "Render cache lookups", ["result"],
+                collect=lambda: {"hit": render_cache.hits, "miss": render_cache.misses})
+metrics.Counter("ascentbot_sauron_dropped_total", "Sauron lines dropped because the digest was backed up",
+                collect=lambda: sauron_digest.stats()["dropped"])
 
 if __name__ == "__main__":
+    # Exit through sys.exit on SIGTERM so pending saves are flushed by atexit
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    if __listen_mode__ == "asyncio":
+        import aio
+        aio.run(bot, __token__, outbound, automation, port=int(os.environ.get('PORT', 5000)))
 
-    if os.getenv("LISTEN_MODE") == "webhook":
+    elif __listen_mode__ == "webhook":
         server = Flask(__name__)
+        updates = UpdateQueue(lambda update: bot.process_new_updates([update]),
+                              workers=int(os.getenv("UPDATE_WORKERS", 8)))
+        metrics.Gauge("ascentbot_updates_pending", "Updates received and not processed yet",
+                      collect=lambda: updates.stats()["pending"])
 
         @server.route('/' + __token__, methods=['POST'])
         def getMessage():
-            bot.process_new_updates([telebot.types.Update.de_json(request.stream.read().decode("utf-8"))])
+            if not updates.put(telebot.types.Update.de_json(request.stream.read().decode("utf-8"))):
+                return "Busy", 503  # Telegram delivers it again later
             return "!", 200
 
+        @server.route('/' + __token__ + '/stats')
+        def stats():
+            return json.dumps({
+                "updates": updates.stats(),
+                "outbound": outbound.stats(),
+                "storage_bytes_written": guilds.storage.bytes_written,
+                "pending_deletions": deletions.pending(),
+                "reminders": automation.reminders.stats(),
+                "sauron": sauron_digest.stats(),
+            }), 200, {"Content-Type": "application/json"}
+
+
+        @server.route('/' + __token__ + '/metrics')
+        def metrics_route():
+            return metrics.registry.render(), 200, {"Content-Type": metrics.CONTENT_TYPE}
 
         @server.route("/")
         def webhook():
@@ -0,0 +1,159 @@
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+# Seconds, from a fast in-memory command up to a slow Bot API or cloudcube call
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+# Per guild series are spread over this many buckets, label values must not grow with the number of guilds
+GUILD_BUCKETS = 32
+
+
+def guild_bucket(chat_id):
+    """Stable bucket of a chat, the same across restarts unlike hash()."""
+    return zlib.crc32(str(chat_id).encode("utf-8")) % GUILD_BUCKETS
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if len(pairs) == 0:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, _escape(v)) for k, v in pairs) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    """One metric family. Values are keyed by the tuple of label values, in labelnames order.
+
+    collect, if given, is called at render time and returns the values instead: a number, or
+    {label values: number}. That exposes counters other objects already keep without copying them.
+    """
+    kind = None
+
+    def __init__(self, name, help, labelnames=(), collect=None, registry=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+        self.lock = threading.Lock()
+        self.values = {}
+        (registry or globals()["registry"]).register(self)
+
+    def samples(self):
+        if self.collect is None:
+            with self.lock:
+                return [(self.name, key, None, value) for key, value in self.values.items()]
+        values = self.collect()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [(self.name, key if isinstance(key, tuple) else (key,), None, value) for key, value in values.items()]
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.kind)]
+        for name, key, extra, value in self.samples():
+            lines.append("{}{} {}".format(name, _labels(self.labelnames, key, extra), _number(value)))
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, *labels):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        super().__init__(name, help, labelnames, registry=registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = self.values[labels] = [0] * len(self.buckets) + [0, 0]  # buckets, count, sum
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, *labels)
+
+    def samples(self):
+        with self.lock:
+            values = [(key, list(counts)) for key, counts in self.values.items()]
+        samples = []
+        for key, counts in values:
+            for bound, count in zip(self.buckets, counts):
+                samples.append((self.name + "_bucket", key, ("le", _number(bound)), count))
+            samples.append((self.name + "_bucket", key, ("le", "+Inf"), counts[-2]))
+            samples.append((self.name + "_count", key, None, counts[-2]))
+            samples.append((self.name + "_sum", key, None, counts[-1]))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics[metric.name] = metric  # Registering a name again replaces the old metric
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+registry = Registry()
+
+command_seconds = Histogram("ascentbot_command_seconds", "Time to process a command or callback, before replying",
+                            ["command", "kind"])
+command_errors = Counter("ascentbot_command_errors_total", "Commands that failed, by error", ["command", "error"])
+guild_command_seconds = Counter("ascentbot_guild_command_seconds_total",
+                                "Time spent processing commands, by guild_bucket() of the chat", ["guild_bucket"])
+save_seconds = Histogram("ascentbot_guilds_save_seconds", "Duration of Guilds.save", ["persistence"])
+storage_seconds = Histogram("ascentbot_storage_seconds", "Duration of storage operations", ["backend", "op"])
+storage_bytes = Counter("ascentbot_storage_written_bytes_total", "Bytes written to storage", ["backend", "op"])
+outbound_seconds = Histogram("ascentbot_outbound_seconds", "Duration of Bot API calls", ["method", "outcome"])
+scheduler_lag = Histogram("ascentbot_scheduler_lag_seconds", "How late scheduled automation ran", ["scheduler"])
@@ -0,0 +1,58 @@
+import unittest
+
+import metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def test_histogram(self):
+        h = metrics.Histogram("cmd_seconds", "Command time", ["command"], buckets=[0.1, 1], registry=self.registry)
+        h.observe(0.05, "exped.reg")
+        h.observe(0.5, "exped.reg")
+        h.observe(2, "exped.reg")
+        lines = self.registry.render().splitlines()
+        self.assertEqual(lines[:2], ["# HELP cmd_seconds Command time", "# TYPE cmd_seconds histogram"])
+        self.assertEqual(lines[2:], [
+            'cmd_seconds_bucket{command="exped.reg",le="0.1"} 1',
+            'cmd_seconds_bucket{command="exped.reg",le="1"} 2',
+            'cmd_seconds_bucket{command="exped.reg",le="+Inf"} 3',
+            'cmd_seconds_count{command="exped.reg"} 3',
+            'cmd_seconds_sum{command="exped.reg"} 2.55',
+        ])
+
+    def test_counter_and_gauge(self):
+        c = metrics.Counter("errors_total", "Errors", ["command", "error"], registry=self.registry)
+        c.inc(1, "fort.mark", "FortAttendanceExistsError")
+        c.inc(2, "fort.mark", "FortAttendanceExistsError")
+        g = metrics.Gauge("title", "Escaped", ["name"], registry=self.registry)
+        g.set(1, 'say "hi"\n')
+        self.assertIn('errors_total{command="fort.mark",error="FortAttendanceExistsError"} 3', self.registry.render())
+        self.assertIn('title{name="say \\"hi\\"\\n"} 1', self.registry.render())
+
+    def test_collect(self):
+        depth = {1: 3, 4: 0}
+        metrics.Gauge("queued", "Queued", ["priority"], collect=lambda: depth, registry=self.registry)
+        metrics.Gauge("pending", "Pending", collect=lambda: 7, registry=self.registry)
+        depth[4] = 2
+        rendered = self.registry.render()
+        self.assertIn('queued{priority="1"} 3\nqueued{priority="4"} 2', rendered)
+        self.assertIn("pending 7", rendered)
+
+    def test_time(self):
+        h = metrics.Histogram("save_seconds", "Save time", ["persistence"], registry=self.registry)
+        with self.assertRaises(ValueError):
+            with h.time("snapshot"):
+                raise ValueError
+        self.assertIn('save_seconds_count{persistence="snapshot"} 1', self.registry.render())
+
+
+    def test_guild_bucket(self):
+        buckets = {metrics.guild_bucket(chat_id) for chat_id in range(-100000, -90000)}
+        self.assertEqual(buckets, set(range(metrics.GUILD_BUCKETS)))
+        self.assertEqual(metrics.guild_bucket(-1001234), metrics.guild_bucket("-1001234"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,75 +1,272 @@
+from collections import OrderedDict
 from datetime import datetime
 from custom_errors import *
-from threading import Lock
+from threading import Condition, Lock, Thread
+import atexit
 import database
+import functools
+import inspect
+import itertools
+import logging
+import metrics
 import os
+import profiler
+import sys
+import time
 import json
 import ascentapi
 
 
+JOURNALED_OPS = set()
+
+
+def journaled(method):
+    """Runs a Guild mutation under the guild lock and records it for the journal if it succeeds.
+
+    Keyword arguments are bound to the method's parameters and recorded positionally, as records are
+    replayed with positional arguments only.
+    """
+    JOURNALED_OPS.add(method.__name__)
+    signature = inspect.signature(method)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if kwargs:
+            bound = signature.bind(self, *args, **kwargs)
+            bound.apply_defaults()
+            args = bound.args[1:]
+        waited = time.monotonic()
+        with self.lock:
+            profiler.add("lock_wait", time.monotonic() - waited)
+            with profiler.span("mutation"):
+                result = method(self, *args)
+            self.changes.record(method.__name__, list(args))
+        self.listeners.notify(self, method.__name__, args)
+        return result
+    return wrapper
+
+
+class ChangeLog:
+    """Mutations of a guild that have not been persisted yet."""
+    __slots__ = ("records", "dirty")
+
+    def __init__(self):
+        self.records = []
+        self.dirty = False  # changed since the guild was last written out
+
+    def record(self, op, args):
+        self.records.append({"op": op, "args": args})
+        self.dirty = True
+
+    def drain(self):
+        records, self.records = self.records, []
+        return records
+
+    def mark_dirty(self):
+        self.dirty = True
+
+    def mark_clean(self):
+        dirty, self.dirty = self.dirty, False
+        return dirty
+
+
+class Listeners:
+    """Callbacks called with (guild, op, args) after every successful journaled mutation of the guilds sharing them,
+    and with op "set" when Guilds.set adds a guild."""
+    __slots__ = ("callbacks",)
+
+    def __init__(self):
+        self.callbacks = []
+
+    def add(self, callback):
+        self.callbacks.append(callback)
+
+    def remove(self, callback):
+        self.callbacks.remove(callback)
+
+    def notify(self, guild, op, args):
+        for callback in list(self.callbacks):
+            try:
+                callback(guild, op, args)
+            except Exception as e:
+                logging.exception(e)
+
+
 class Player:
+    __slots__ = ("tg_handle", "tg_id", "label", "key")
+
     def __init__(self, tg_id: str = "", tg_handle: str = "", label: str = ""):
-        self.tg_handle = tg_handle
+        # The same few players show up in many rosters and in the fort history, share their strings
+        self.tg_handle = sys.intern(tg_handle) if type(tg_handle) is str else tg_handle
         self.tg_id = tg_id
-        self.label = label
+        self.label = sys.intern(label) if type(label) is str else label
+        self.key = (tg_id, self.label)  # identity of the player in rosters, the handle can change
 
     def __eq__(self, other):
         if type(other) is not Player:
             return False
-        return self.__str__() == other.__str__()
+        return self.key == other.key
 
     def __hash__(self):
-        return hash(self.__str__())
+        return hash(self.key)
 
     def __str__(self):
-        return json.dumps(self.__dict__, sort_keys=True)
+        return json.dumps(self.to_json(), sort_keys=True)
+
+    def to_json(self):
+        return {"tg_handle": self.tg_handle, "tg_id": self.tg_id, "label": self.label}
+
+    def history_key(self):
+        """Compact string form of key, used to key fort history."""
+        return sys.intern("{}:{}".format(self.tg_id, self.label))
 
     @classmethod
     def from_json(cls, data):
         return cls(**data)
 
 
+class Roster:
+    """Players in sign up order, indexed by Player.key. Serializes as a list.
+
+    Renders read rosters from other threads without the guild lock, so they iterate over a snapshot.
+    """
+    __slots__ = ("players",)
+
+    def __init__(self, players=None):
+        self.players = {p.key: p for p in players or []}
+
+    def __contains__(self, player):
+        return player.key in self.players
+
+    def __iter__(self):
+        return iter(list(self.players.values()))
+
+    def __len__(self):
+        return len(self.players)
+
+    def __eq__(self, other):
+        return type(other) is Roster and list(self) == list(other)
+
+    def append(self, player):
+        self.players[player.key] = player
+
+    def remove(self, player):
+        try:
+            del self.players[player.key]
+        except KeyError:
+            raise ValueError("{} not in roster".format(player))
+
+    def to_json(self):
+        return list(self.players.values())
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(Player.from_json(p) for p in data or [])
+
+
+# Expedition versions are unique across all expeditions so renderers can cache blocks by version alone
+expedition_versions = itertools.count(1)
+
+
 class Expedition:
+    __slots__ = ("time", "parsed_time", "minute_of_day", "title", "members", "ready", "description", "daily",
+                 "version")
+    # Join buttons carry "r <title>" as callback_data, which Telegram limits to 64 bytes
+    TITLE_LIMIT = 62
+
+    @classmethod
+    def check_title(cls, title):
+        if len(title.encode("utf-8")) > cls.TITLE_LIMIT:
+            raise ValueError("Expedition title is over {} bytes: {}".format(cls.TITLE_LIMIT, title))
+
     def __init__(self, title: str = "", time: str = "1200", description: str = "", members: list = None, ready: list = None, daily: list = None):
         self.set_time(time)
         self.title = title
-        self.members = members or []
-        self.ready = ready or []
+        self.members = Roster(members)
+        self.ready = Roster(ready)
         self.description = description
-        self.daily = daily or []
+        self.daily = Roster(daily)
+        self.touch()
+
+    def touch(self):
+        """Marks the expedition as changed, called by every Guild mutation of it."""
+        self.version = next(expedition_versions)
 
     def set_time(self, time):
-        datetime.strptime(time, '%H%M')  # check that time corresponds to format
+        parsed = datetime.strptime(time, '%H%M').time()  # check that time corresponds to format
         self.time = time
+        self.parsed_time = parsed
+        self.minute_of_day = parsed.hour * 60 + parsed.minute
 
     def set_title(self, title):
         self.title = title
 
+    def callback_title(self):
+        """Title as carried by callback_data, titles stored before TITLE_LIMIT are truncated to it."""
+        return self.title.encode("utf-8")[:self.TITLE_LIMIT].decode("utf-8", errors="ignore")
+
     def set_description(self, description):
         self.description = description
 
     def get_time(self):
-        return datetime.strptime(self.time, "%H%M").time()
+        return self.parsed_time
+
+    def minutes_since_reset(self, daily_reset_time=0):
+        """Sort key of the expedition within a guild day starting at daily_reset_time."""
+        return (self.minute_of_day - daily_reset_time * 60) % (24 * 60)
+
+    def to_json(self):
+        return {"time": self.time, "title": self.title, "members": self.members, "ready": self.ready,
+                "description": self.description, "daily": self.daily}
 
     @classmethod
     def from_json(cls, data):
-        data["members"] = [Player.from_json(m) for m in data.get("members", list())]
-        data["ready"] = [Player.from_json(m) for m in data.get("ready", list())]
-        data["daily"] = [Player.from_json(m) for m in data.get("daily", list())]
+        data["members"] = Roster.from_json(data.get("members"))
+        data["ready"] = Roster.from_json(data.get("ready"))
+        data["daily"] = Roster.from_json(data.get("daily"))
         return cls(**data)
 
 
 class Fort:
-    def __init__(self, roster: list = None, attendance: list = None, history: dict = None):
+    __slots__ = ("roster", "attendance", "history", "handles")
+
+    def __init__(self, roster: list = None, attendance: list = None, history: dict = None, handles: dict = None):
         self.roster = roster or []
-        self.attendance = attendance or []
-        self.history = history or {}
+        self.attendance = Roster(attendance)
+        self.history = history or {}  # Player.history_key() -> count
+        self.handles = handles or {}  # Player.history_key() -> last known tg_handle
+
+    def to_json(self):
+        return {"roster": self.roster, "attendance": self.attendance, "history": self.history,
+                "handles": self.handles}
 
     @classmethod
     def from_json(cls, data):
-        data["attendance"] = [Player.from_json(e) for e in data.get("attendance", list())]
+        data["attendance"] = Roster.from_json(data.get("attendance"))
+        handles = data.get("handles") or {}
+        history = {}
+        for key, count in (data.get("history") or {}).items():
+            if key.startswith("{"):
+                # History used to be keyed by the player's full json, migrate it to compact keys
+                p = Player.from_json(json.loads(key))
+                key = p.history_key()
+                handles.setdefault(key, p.tg_handle)
+            history[key] = history.get(key, 0) + count
+        data["history"] = history
+        data["handles"] = handles
         return cls(**data)
 
+    def name_of(self, key):
+        """Display name of the player behind a history key."""
+        handle = self.handles.get(key)
+        for p in self.attendance:
+            if p.history_key() == key:
+                handle = p.tg_handle
+        label = key.split(":", 1)[1]
+        if handle is None:
+            return key
+        return "{} {}".format(handle, label) if label else handle
+
     def get_roster(self):
         return ascentapi.get_fort_roster()
 
@@ -82,7 +279,8 @@ class Guild:
                  pinned_message_id: int = None,
                  chat_id: int = None,
                  daily_reset_time: int = 3,
-                 stopped: bool = False):
+                 stopped: bool = False,
+                 last_reset: str = None):
         self.title = title
         self.members = members or []
         self.expeditions = expeditions or {}
@@ -90,145 +288,178 @@ class Guild:
         self.pinned_message_id = pinned_message_id or None
         self.chat_id = chat_id or None
         self.lock = Lock()
+        self.changes = ChangeLog()
+        self.listeners = Listeners()  # replaced by the listeners of the Guilds it is added to
         self.daily_reset_time = daily_reset_time
         self.stopped = stopped
+        self.last_reset = last_reset  # ISO date of the guild day the last daily reset ran for
+
+    def to_json(self):
+        # lock, changes and listeners are runtime state, not part of the saved guild
+        return {"title": self.title, "members": self.members, "expeditions": self.expeditions, "fort": self.fort,
+                "pinned_message_id": self.pinned_message_id, "chat_id": self.chat_id,
+                "daily_reset_time": self.daily_reset_time, "stopped": self.stopped, "last_reset": self.last_reset}
 
     @classmethod
     def from_json(cls, data):
+        # Saved by older versions, which serialized the runtime state as null
         data.pop("lock", None)
+        data.pop("changes", None)
+        data.pop("listeners", None)
         data["fort"] = Fort.from_json(data["fort"])
         data["expeditions"] = {t: Expedition.from_json(e) for (t, e) in data.get("expeditions", dict()).items()}
         # TODO: Members
         return cls(**data)
 
     # Expeditions
+    @journaled
     def new_expedition(self, title, time, description=""):
-        with self.lock:
-            try:
-                self.get_expedition(title)
-            except ExpeditionNotFoundError:
-                slug = title.lower()
-                self.expeditions[slug] = Expedition(title, time, description)
-                return self.expeditions[slug]
-            else:
-                raise ExpeditionExistsError
+        Expedition.check_title(title)
+        try:
+            self.get_expedition(title)
+        except ExpeditionNotFoundError:
+            slug = title.lower()
+            self.expeditions[slug] = Expedition(title, time, description)
+            return self.expeditions[slug]
+        else:
+            raise ExpeditionExistsError
 
+    @journaled
     def set_expedition_time(self, title, time):
-        with self.lock:
-            e = self.get_expedition(title)
-            e.set_time(time)
-            return e
+        e = self.get_expedition(title)
+        e.set_time(time)
+        e.touch()
+        return e
 
+    @journaled
     def set_expedition_title(self, oldtitle, newtitle):
-        with self.lock:
-            try:
-                self.get_expedition(newtitle)
-            except ExpeditionNotFoundError:
-                e = self.get_expedition(oldtitle)
-                e.set_title(newtitle)
-
-                oldslug = oldtitle.lower()
-                del self.expeditions[oldslug]
-
-                newslug = newtitle.lower()
-                self.expeditions[newslug] = e
+        Expedition.check_title(newtitle)
+        try:
+            self.get_expedition(newtitle)
+        except ExpeditionNotFoundError:
+            e = self.get_expedition(oldtitle)
+            oldslug = e.title.lower()
+            e.set_title(newtitle)
+            e.touch()
 
-                return e
-            else:
-                raise ExpeditionExistsError
+            del self.expeditions[oldslug]
 
+            newslug = newtitle.lower()
+            self.expeditions[newslug] = e
 
+            return e
+        else:
+            raise ExpeditionExistsError
 
+    @journaled
     def set_expedition_description(self, title, description=""):
-        with self.lock:
-            e = self.get_expedition(title)
-            e.set_description(description)
-            return e
+        e = self.get_expedition(title)
+        e.set_description(description)
+        e.touch()
+        return e
 
     def get_expedition(self, title):
-        try:
-            slug = title.lower()
-            return self.expeditions[slug]
-        except KeyError:
+        slug = title.lower()
+        e = self.expeditions.get(slug)
+        if e is None:
+            # Buttons of titles stored before TITLE_LIMIT carry them truncated
+            e = next((e for e in self.expeditions.values() if e.callback_title().lower() == slug), None)
+        if e is None:
             raise ExpeditionNotFoundError
+        return e
 
+    @journaled
     def delete_expedition(self, title):
-        with self.lock:
-            try:
-                slug = title.lower()
-                del self.expeditions[slug]
-            except KeyError:
-                raise ExpeditionNotFoundError
+        del self.expeditions[self.get_expedition(title).title.lower()]
 
+    @journaled
     def daily_expedition(self, title, tg_id, handle, label=""):
-        with self.lock:
-            e = self.get_expedition(title)
-            p = Player(tg_id, handle, label)
-            if p in e.daily:
-                e.daily.remove(p)
-                return e, False
-            else: 
-                if len(e.daily) >= 10:
-                    raise ExpeditionFullError
-                e.daily.append(p)
-                return e, True
-
+        e = self.get_expedition(title)
+        p = Player(tg_id, handle, label)
+        e.touch()
+        if p in e.daily:
+            e.daily.remove(p)
+            return e, False
+        else:
+            if len(e.daily) >= 10:
+                raise ExpeditionFullError
+            e.daily.append(p)
+            return e, True
+
+    @journaled
     def checkin_expedition(self, title, tg_id, handle, label=""):
-        with self.lock:
-            e = self.get_expedition(title)
-            p = Player(tg_id, handle, label)
-            if p not in e.members:
-                if len(e.members) >= 10:
-                    raise ExpeditionFullError
-                e.members.append(p)
-                return e, p
-            else:
-                raise ExpedMemberAlreadyExists
-
+        e = self.get_expedition(title)
+        p = Player(tg_id, handle, label)
+        if p not in e.members:
+            if len(e.members) >= 10:
+                raise ExpeditionFullError
+            e.members.append(p)
+            e.touch()
+            return e, p
+        else:
+            raise ExpedMemberAlreadyExists
+
+    @journaled
     def checkout_expedition(self, title, tg_id, handle, label=""):
-        with self.lock:
-            e = self.get_expedition(title)
-            p = Player(tg_id, handle, label)
-            if p in e.members:
-                e.members.remove(p)
-                return e, p
-            else:
-                raise ExpedMemberNotFoundError
-
+        e = self.get_expedition(title)
+        p = Player(tg_id, handle, label)
+        if p in e.members:
+            e.members.remove(p)
+            e.touch()
+            return e, p
+        else:
+            raise ExpedMemberNotFoundError
+
+    @journaled
     def ready_expedition(self, title, tg_id, handle, label=""):
-        with self.lock:
-            e = self.get_expedition(title)
-            p = Player(tg_id, handle, label)
-            if p in e.ready:
-                e.ready.remove(p)
-                return e, False
-            else:
-                e.ready.append(p)
-                return e, True
-
+        e = self.get_expedition(title)
+        p = Player(tg_id, handle, label)
+        e.touch()
+        if p in e.ready:
+            e.ready.remove(p)
+            return e, False
+        else:
+            e.ready.append(p)
+            return e, True
+
+    @journaled
     def set_reset_time(self, time):
-        with self.lock:
-            self.daily_reset_time = time
+        self.daily_reset_time = time
 
-    def reset_expeditions(self):
-        with self.lock:
-            for e in self.expeditions:
-                self.expeditions[e].members = list(self.expeditions[e].daily)
-                self.expeditions[e].ready = []
+    @journaled
+    def set_last_reset(self, day):
+        self.last_reset = day
 
+    @journaled
+    def reset_expeditions(self):
+        self.__reset_expeditions()
+
+    def __reset_expeditions(self):
+        for e in self.expeditions:
+            self.expeditions[e].members = Roster(self.expeditions[e].daily)
+            self.expeditions[e].ready = Roster()
+            self.expeditions[e].touch()
+
+    @journaled
+    def daily_reset(self, day):
+        """Resets expeditions and folds fort attendance into history for the guild day `day`, as one mutation."""
+        self.__reset_expeditions()
+        self.__update_fort_history()
+        self.last_reset = day
+
+    @journaled
     def fort_mark(self, tg_id, handle, label=""):
-        with self.lock:
-            p = Player(tg_id, handle, label)
-            if p in self.fort.attendance:
-                raise FortAttendanceExistsError
-            self.fort.attendance.append(p)
+        p = Player(tg_id, handle, label)
+        if p in self.fort.attendance:
+            raise FortAttendanceExistsError
+        self.fort.attendance.append(p)
 
+    @journaled
     def fort_unmark(self, tg_id, handle, label=""):
-        with self.lock:
-            p = Player(tg_id, handle, label)
-            if p not in self.fort.attendance:
-                raise FortAttendanceNotFoundError
-            self.fort.attendance.remove(p)
+        p = Player(tg_id, handle, label)
+        if p not in self.fort.attendance:
+            raise FortAttendanceNotFoundError
+        self.fort.attendance.remove(p)
 
     def get_attendance_today(self, tg_id, handle, label=""):
         p = Player(tg_id, handle, label)
@@ -236,33 +467,71 @@ class Guild:
             return True
         return False
 
+    @journaled
     def update_fort_history(self):
-        with self.lock:
-            for p in self.fort.attendance:
-                p_str = str(p)
-                count = self.fort.history.get(p_str, 0)
-                self.fort.history[p_str] = count + 1
-            self.fort.attendance = []
+        self.__update_fort_history()
+
+    def __update_fort_history(self):
+        for p in self.fort.attendance:
+            key = p.history_key()
+            self.fort.history[key] = self.fort.history.get(key, 0) + 1
+            self.fort.handles[key] = p.tg_handle
+        self.fort.attendance = Roster()
 
     def get_history_of(self, tg_id, handle, label=""):
         p = Player(tg_id, handle, label)
-        p_str = str(p)
         try:
-            return self.fort.history[p_str]
+            return self.fort.history[p.history_key()]
         except KeyError:
             raise FortAttendanceNotFoundError
 
+    @journaled
     def reset_fort_history(self):
         self.fort = Fort()
 
     def get_history_all(self):
+        """Returns {Player.history_key(): count} including today's attendance."""
         combined = {}
         for p in self.fort.attendance:
-            combined[str(p)] = 1
-        for p_Str in self.fort.history:
-            combined[p_Str] = self.fort.history.get(p_Str, 0) + combined.get(p_Str, 0)
+            combined[p.history_key()] = 1
+        for key, count in list(self.fort.history.items()):
+            combined[key] = count + combined.get(key, 0)
         return combined
 
+    # Lifecycle
+    @journaled
+    def set_pinned_message(self, message_id):
+        self.pinned_message_id = message_id
+
+    @journaled
+    def stop(self):
+        self.stopped = True
+
+    @journaled
+    def start(self):
+        self.stopped = False
+
+    @property
+    def dirty(self):
+        return self.changes.dirty
+
+    INDEX_KEYS = ("stopped", "expeditions", "daily_reset_time", "last_reset")
+
+    def index_entry(self):
+        """What Guilds keeps of the guild while it is not hydrated, enough to schedule its automation."""
+        return {"stopped": self.stopped,
+                "expeditions": {slug: e.time for slug, e in self.expeditions.items()},
+                "daily_reset_time": self.daily_reset_time,
+                "last_reset": self.last_reset}
+
+    @staticmethod
+    def index_entry_of(data):
+        """index_entry of a guild in its json form, without deserializing it."""
+        return {"stopped": data.get("stopped", False),
+                "expeditions": {slug: e.get("time", "1200") for slug, e in (data.get("expeditions") or {}).items()},
+                "daily_reset_time": data.get("daily_reset_time", 3),
+                "last_reset": data.get("last_reset")}
+
     def __eq__(self, other):
         if type(other) is not Guild:
             return False
@@ -271,51 +540,371 @@ class Guild:
 
 class Guilds:
     savefile = "guilds.{}.json".format(os.getenv("MODE", "dev"))
-
-    def __init__(self, guilds: dict = None, storage: database.Storage = None):
-        self.guilds = guilds or {}
+    journalfile = "guilds.{}.journal".format(os.getenv("MODE", "dev"))
+    sharddir = "guilds/{}/".format(os.getenv("MODE", "dev"))
+    # "snapshot" rewrites the whole savefile on every save, "journal" appends the mutations since the last save,
+    # "sharded" keeps one file per guild under sharddir and only rewrites the guilds that changed
+    persistence = os.getenv("PERSISTENCE", "snapshot")
+    compact_every = int(os.getenv("JOURNAL_COMPACT_EVERY", 1000))
+    # request_save flushes save_interval seconds after the first request, or as soon as save_burst saves are pending.
+    # A save_interval of 0 makes request_save synchronous.
+    save_interval = int(os.getenv("SAVE_INTERVAL_MS", 1000)) / 1000
+    save_burst = int(os.getenv("SAVE_BURST", 50))
+    # With sharded or sqlite persistence, clean guilds idle for evict_after seconds are dropped from memory
+    # once more than max_resident are loaded. 0 keeps every guild in memory.
+    max_resident = int(os.getenv("GUILDS_MAX_RESIDENT", 0))
+    evict_after = int(os.getenv("GUILDS_EVICT_AFTER", 600))
+
+    def __init__(self, guilds: dict = None, storage: database.Storage = None, journal_seq: int = 0,
+                 index: dict = None, loader=None):
+        self.guilds = OrderedDict(guilds or {})  # hydrated guilds, least recently used first
         self.storage = storage or database.Storage()
-
-    def get(self, guild_chat_id, ignore_stopped=False):
+        # Guild.index_entry of every known guild, hydrated or not. Indexes written before entries held
+        # the automation schedule have the stopped flag alone.
+        self.index = {chat_id: e if isinstance(e, dict) else {"stopped": e} for chat_id, e in (index or {}).items()}
+        self.index.update({chat_id: g.index_entry() for chat_id, g in self.guilds.items()})
+        self.listeners = Listeners()  # shared by every guild of this Guilds
+        for g in self.guilds.values():
+            g.listeners = self.listeners
+        self.unhydrated = {}  # json of guilds read from the savefile that have not been used yet
+        self.loader = loader or (lambda chat_id: self.unhydrated.pop(chat_id, None))
+        self.last_used = {}
+        self.hydrate_lock = Lock()
+        self.journal_seq = journal_seq  # seq of the last journal record folded into this state
+        self.changes = []  # guild creations and removals not yet persisted
+        self.uncompacted = 0
+        self.index_dirty = False
+        self.save_lock = Lock()
+        self.save_requested = Condition()
+        self.save_requests = 0
+        self.save_worker = None
+        self.save_functions = {
+            "snapshot": self.__save_snapshot,
+            "journal": self.__save_journal,
+            "sharded": self.__save_sharded,
+            "sqlite": self.__save_rows,
+        }
+        if self.storage.storage_type == "sqlite":
+            self.persistence = "sqlite"  # Guild tables replace the savefile entirely
+
+    def get(self, guild_chat_id, ignore_stopped=False, record_use=True):
+        """record_use=False is for automation like reminders, which must not keep an idle guild from being evicted."""
+        if guild_chat_id not in self.index:
+            raise GuildNotFoundError
+        if self.is_stopped(guild_chat_id) and not ignore_stopped:
+            raise GuildNotFoundError
         try:
-            g = self.guilds[guild_chat_id]
-            if g.stopped and not ignore_stopped:
-                raise GuildNotFoundError
-            else:
-                return self.guilds[guild_chat_id]
+            return self.__hydrate(guild_chat_id, record_use)
         except KeyError:
             raise GuildNotFoundError
 
+    def is_stopped(self, guild_chat_id):
+        g = self.guilds.get(guild_chat_id)
+        if g is not None:
+            return g.stopped
+        return self.index[guild_chat_id]["stopped"]
+
+    def __hydrate(self, chat_id, record_use=True):
+        g = self.guilds.get(chat_id)
+        if g is None:
+            with self.hydrate_lock:
+                if chat_id not in self.guilds:
+                    data = self.loader(chat_id)
+                    if data is None:
+                        raise KeyError(chat_id)
+                    self.guilds[chat_id] = Guild.from_json(data)
+                    self.guilds[chat_id].listeners = self.listeners
+                    self.last_used[chat_id] = time.monotonic()  # Not evicted again before it is used
+                g = self.guilds[chat_id]
+            self.__evict()
+        if not record_use:
+            return g
+        self.last_used[chat_id] = time.monotonic()
+        try:
+            self.guilds.move_to_end(chat_id)
+        except KeyError:
+            pass  # Evicted or removed by another thread, g stays usable for this call
+        return g
+
+    def __evict(self):
+        if self.max_resident <= 0 or self.persistence not in ["sharded", "sqlite"]:
+            return  # Guilds can only be hydrated again from per-guild storage
+        now = time.monotonic()
+        with self.hydrate_lock:
+            for chat_id in list(self.guilds):
+                if len(self.guilds) <= self.max_resident:
+                    return
+                g = self.guilds[chat_id]
+                if g.dirty or now - self.last_used.get(chat_id, 0) < self.evict_after:
+                    continue
+                self.index[chat_id] = g.index_entry()
+                del self.guilds[chat_id]
+                self.last_used.pop(chat_id, None)
+
     def set(self, guild_chat_id, guild):
-        self.guilds[guild_chat_id] = guild
+        with guild.lock:
+            guild.changes.drain()  # Anything before this point is part of the recorded guild
+            guild.changes.mark_dirty()
+            data = database.MODJson.loads(database.MODJson.dumps(guild))
+        self.changes.append({"chat_id": guild_chat_id, "op": "set", "data": data})
+        guild.listeners = self.listeners
+        with self.hydrate_lock:
+            self.unhydrated.pop(guild_chat_id, None)
+            self.guilds[guild_chat_id] = guild
+            self.index[guild_chat_id] = guild.index_entry()
+        self.last_used[guild_chat_id] = time.monotonic()
+        self.listeners.notify(guild, "set", ())
+
+    def remove(self, guild_chat_id):
+        self.changes.append({"chat_id": guild_chat_id, "op": "remove"})
+        with self.hydrate_lock:
+            self.guilds.pop(guild_chat_id, None)
+            self.unhydrated.pop(guild_chat_id, None)
+            self.index.pop(guild_chat_id, None)
+        self.last_used.pop(guild_chat_id, None)
 
     def values(self):
-        return self.guilds.values()
+        """All guilds, hydrating the ones that are not loaded yet. Does not count as using them."""
+        return [g for g in (self.__hydrate_or_none(chat_id) for chat_id in list(self.index)) if g is not None]
+
+    def active_index(self):
+        """(chat_id, index entry) of the guilds that are not stopped, without hydrating them.
+
+        Guilds whose entry predates some of Guild.INDEX_KEYS are hydrated once to fill it in.
+        """
+        entries = []
+        for chat_id in list(self.index):
+            g = self.guilds.get(chat_id)
+            if g is not None:
+                entry = g.index_entry()  # The index of hydrated guilds is only refreshed when they are saved
+            else:
+                entry = self.index.get(chat_id)
+                if entry is None or entry["stopped"]:
+                    continue
+                if any(k not in entry for k in Guild.INDEX_KEYS):
+                    g = self.__hydrate_or_none(chat_id)
+                    if g is None:
+                        continue
+                    entry = self.index[chat_id] = g.index_entry()
+                    self.index_dirty = True
+            if not entry["stopped"]:
+                entries.append((chat_id, entry))
+        return entries
+
+    def __hydrate_or_none(self, chat_id):
+        try:
+            return self.__hydrate(chat_id, record_use=False)
+        except KeyError:
+            return None
 
     def keys(self):
-        return self.guilds.keys()
+        return self.index.keys()
+
+    def drain_changes(self):
+        records, self.changes = self.changes, []
+        for chat_id, guild in list(self.guilds.items()):
+            self.index[chat_id] = guild.index_entry()
+            for r in guild.changes.drain():
+                r["chat_id"] = chat_id
+                records.append(r)
+        return records
 
     def save(self):
-        saveobj = self.__dict__.copy()
-        del saveobj["storage"]
+        with self.save_lock, metrics.save_seconds.time(self.persistence):
+            records = self.drain_changes()
+            self.save_functions[self.persistence](records)
+
+    def request_save(self):
+        """Marks state as needing a save, the background worker coalesces requests into one save."""
+        if self.save_interval <= 0:
+            return self.save()
+        with self.save_requested:
+            self.save_requests += 1
+            if self.save_worker is None:
+                self.save_worker = Thread(target=self.__save_loop, daemon=True)
+                self.save_worker.start()
+                atexit.register(self.flush)
+            self.save_requested.notify()
+
+    def flush(self):
+        """Saves now, including anything still waiting for the background worker."""
+        with self.save_requested:
+            self.save_requests = 0
+        self.save()
+
+    def __save_loop(self):
+        while True:
+            with self.save_requested:
+                while self.save_requests == 0:
+                    self.save_requested.wait()
+                deadline = time.monotonic() + self.save_interval
+                while self.save_requests < self.save_burst and time.monotonic() < deadline:
+                    self.save_requested.wait(deadline - time.monotonic())
+                if self.save_requests == 0:
+                    continue  # Flushed in the meantime
+                self.save_requests = 0
+            try:
+                self.save()
+            except Exception as e:
+                logging.exception(e)
+                with self.save_requested:
+                    self.save_requests += 1  # Try again after the next interval
+
+    def __save_snapshot(self, records=None):
+        with self.hydrate_lock:
+            guilds = dict(self.unhydrated)
+            guilds.update(self.guilds)
+        for guild in list(self.guilds.values()):
+            guild.changes.mark_clean()
+        saveobj = {"guilds": guilds, "journal_seq": self.journal_seq}
         self.storage.savefile(saveobj, self.savefile, "json")
 
+    @classmethod
+    def shardfile(cls, chat_id):
+        return "{}{}.json".format(cls.sharddir, chat_id)
+
+    @classmethod
+    def indexfile(cls):
+        return "{}index.json".format(cls.sharddir)
+
+    def __save_sharded(self, records):
+        for r in records:
+            if r["op"] == "remove" and r["chat_id"] not in self.index:
+                self.storage.deletefile(self.shardfile(r["chat_id"]))
+                self.index_dirty = True
+        for chat_id, guild in list(self.guilds.items()):
+            if not guild.changes.mark_clean():
+                continue
+            self.index_dirty = True
+            if not self.storage.savefile(guild, self.shardfile(chat_id), "json"):
+                guild.changes.mark_dirty()  # Retry on the next save
+        if self.index_dirty:
+            self.index_dirty = not self.storage.savefile({str(k): v for k, v in self.index.items()},
+                                                         self.indexfile(), "json")
+
+    def __save_journal(self, records):
+        if len(records) == 0:
+            return
+        for r in records:
+            self.journal_seq += 1
+            r["seq"] = self.journal_seq
+        try:
+            appended = self.storage.appendfile(records, self.journalfile)
+        except Exception:
+            self.__keep_journal(records)
+            raise
+        if not appended:
+            self.__keep_journal(records)
+            logging.error("Could not append {} records to {}".format(len(records), self.journalfile))
+            return
+        for guild in list(self.guilds.values()):
+            guild.changes.mark_clean()
+        self.uncompacted += len(records)
+        if self.uncompacted >= self.compact_every:
+            self.compact()
+
+    def __keep_journal(self, records):
+        """Keeps records that may not have been appended for the next save, with the same seqs so that
+        any of them appended after all are skipped on replay instead of applied twice."""
+        self.journal_seq -= len(records)
+        self.changes = records + self.changes
+
+    def __save_rows(self, records):
+        try:
+            self.storage.apply_records(records)
+        except Exception:
+            self.changes = records + self.changes  # Nothing was committed, keep the records for the next save
+            raise
+        for guild in list(self.guilds.values()):
+            guild.changes.mark_clean()
+
+    def compact(self):
+        """Folds the journal into a snapshot. Records already in the snapshot are skipped on replay,
+        so a crash between the two steps is safe."""
+        self.__save_snapshot()
+        self.storage.truncatejournal(self.journalfile)
+        self.uncompacted = 0
+
+    def replay(self, records):
+        for r in sorted(records, key=lambda r: r["seq"]):
+            if r["seq"] <= self.journal_seq:
+                continue
+            self.apply(r)
+            self.journal_seq = r["seq"]
+            self.uncompacted += 1
+        self.drain_changes()
+
+    def apply(self, record):
+        chat_id = record["chat_id"]
+        op = record["op"]
+        if op == "set":
+            self.set(chat_id, Guild.from_json(record["data"]))
+        elif op == "remove":
+            self.remove(chat_id)
+        elif op in JOURNALED_OPS and chat_id in self.index:
+            try:
+                getattr(self.__hydrate(chat_id), op)(*record["args"])
+            except (GuildError, ValueError, KeyError) as e:
+                logging.error("Could not replay {}: {}".format(record, e))
+        else:
+            logging.error("Could not replay {}".format(record))
+
     @staticmethod
     def load(storage: database.Storage = None):
+        """Loads the index of guilds, each guild is only deserialized the first time it is used."""
         if storage is None:
             storage = database.Storage()
 
+        if storage.storage_type == "sqlite":
+            return Guilds(storage=storage, index=storage.guild_index(), loader=storage.load_guild)
+
+        if Guilds.persistence == "sharded":
+            guilds = Guilds.load_shards(storage)
+            if guilds is not None:
+                return guilds  # Shards are written on every save so there is no journal tail to replay
+
         t = storage.loadfile(Guilds.savefile, "json")
         if t is None:
-            return Guilds()
-        return Guilds.from_json(t)
+            guilds = Guilds(storage=storage)
+        else:
+            guilds = Guilds.from_json(t, storage=storage)
+        if Guilds.persistence == "sharded":
+            # Migrating from a single savefile, write every guild out to its shard on the next save
+            for guild in guilds.values():
+                guild.changes.mark_dirty()
+        guilds.replay(storage.loadjournal(Guilds.journalfile))
+        return guilds
 
+    @staticmethod
+    def load_shards(storage: database.Storage):
+        def load_shard(chat_id):
+            return storage.loadfile(Guilds.shardfile(chat_id), "json")
+
+        index = storage.loadfile(Guilds.indexfile(), "json")
+        if index is not None:
+            return Guilds(storage=storage, index={int(k): v for k, v in index.items()}, loader=load_shard)
+
+        # Shards written before the index existed, read them all once to build it
+        filenames = storage.listfiles(Guilds.sharddir)
+        chat_ids = [os.path.basename(f).split(".")[0] for f in filenames if f.endswith(".json")]
+        guilds = {}
+        for chat_id in [int(c) for c in chat_ids if c.lstrip("-").isdigit()]:
+            data = load_shard(chat_id)
+            if data is not None:
+                guilds[chat_id] = Guild.from_json(data)
+        if len(guilds) == 0:
+            return None
+        g = Guilds(guilds=guilds, storage=storage, loader=load_shard)
+        g.index_dirty = True
+        return g
 
     @classmethod
-    def from_json(cls, data):
+    def from_json(cls, data, storage: database.Storage = None):
         data.pop("storage", None)
-        data["guilds"] = {int(k): Guild.from_json(v) for k, v in data["guilds"].items()}
-        return cls(**data)
+        unhydrated = {int(k): v for k, v in data.pop("guilds").items()}
+        guilds = cls(storage=storage, index={k: Guild.index_entry_of(v) for k, v in unhydrated.items()}, **data)
+        guilds.unhydrated = unhydrated
+        return guilds
 
 
 class MessageReply:
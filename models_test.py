@@ -1,15 +1,19 @@
 from models import *
+from unittest import mock
+import atexit
 import json
+import os
+import tempfile
+import time
 import unittest
 import database
 
 
 def obj_to_json(o):
-    try:
-        return o.__dict__
-    except AttributeError:
+    d = database.obj_to_json(o)
+    if d is None:
         print("Could not serialize: {}".format(o))
-        return None
+    return d
 
 
 class TestStringMethods(unittest.TestCase):
@@ -17,6 +21,29 @@ class TestStringMethods(unittest.TestCase):
         member1 = Player("id1", "handle1", "lal1")
         member2 = Player("id1", "handle1", "lal1")
         self.assertEqual(member1, member2)
+        self.assertEqual(member1, Player("id1", "renamed", "lal1"))  # Identity is (tg_id, label)
+        self.assertNotEqual(member1, Player("id1", "handle1", "lal2"))
+
+    def test_roster(self):
+        roster = Roster([Player("id1", "handle1"), Player("id2", "handle2")])
+        roster.append(Player("id3", "handle3"))
+        roster.remove(Player("id1", "handle1"))
+        self.assertIn(Player("id2", "handle2"), roster)
+        self.assertNotIn(Player("id1", "handle1"), roster)
+        with self.assertRaises(ValueError):
+            roster.remove(Player("id1", "handle1"))
+        # Serialized in sign up order, in the same format as before
+        self.assertEqual(database.MODJson.dumps(roster),
+                         '[{"tg_handle": "handle2", "tg_id": "id2", "label": ""}, '
+                         '{"tg_handle": "handle3", "tg_id": "id3", "label": ""}]')
+        # Iterating is not disturbed by a checkin or checkout on another thread
+        names = []
+        for p in roster:
+            if len(names) == 0:
+                roster.append(Player("id4", "handle4"))
+                roster.remove(Player("id2", "handle2"))
+            names.append(p.tg_handle)
+        self.assertEqual(names, ["handle2", "handle3"])
 
     def test_serialization(self):
         # create local storage
@@ -42,11 +69,12 @@ class TestStringMethods(unittest.TestCase):
         _f = json.dumps(f, default=obj_to_json)
         self.assertEqual(_f, d)
 
-        gs = Guilds(storage=storage)
-        gs.set("23452", g)
+        with mock.patch.object(Guilds, "savefile", os.path.join(tempfile.mkdtemp(), "guilds.json")):
+            gs = Guilds(storage=storage)
+            gs.set("23452", g)
 
-        gs.save()
-        gs2 = Guilds.load(storage=storage)
+            gs.save()
+            gs2 = Guilds.load(storage=storage)
 
         # Test expedition info is retained
         g2 = gs2.get("23452")
@@ -57,6 +85,281 @@ class TestStringMethods(unittest.TestCase):
         attendance = g2.get_attendance_today("tg_id1", "handle1", "label1")
         self.assertTrue(attendance)
 
+    def test_journal(self):
+        storage = database.Storage(storage_type="local")
+        tmp = tempfile.mkdtemp()
+        with mock.patch.multiple(Guilds,
+                                 savefile=os.path.join(tmp, "guilds.json"),
+                                 journalfile=os.path.join(tmp, "guilds.journal"),
+                                 persistence="journal",
+                                 compact_every=6):
+            gs = Guilds(storage=storage)
+            gs.set(1234, Guild(title="guild1", chat_id=1234))
+            g = gs.get(1234)
+            g.new_expedition("test1", "1200")
+            g.checkin_expedition("test1", "mem1", "han1", "lab1")
+            gs.save()
+            self.assertFalse(os.path.exists(Guilds.savefile))  # Only the journal is written
+
+            # Failed mutations are not journaled
+            with self.assertRaises(ExpedMemberAlreadyExists):
+                g.checkin_expedition("test1", "mem1", "han1", "lab1")
+            g.checkin_expedition("test1", "mem2", "han2", "lab2")
+            g.fort_mark("tg_id1", "handle1", "label1")
+            gs.save()
+
+            gs2 = Guilds.load(storage=storage)
+            self.assertEqual([p.tg_id for p in gs2.get(1234).get_expedition("test1").members], ["mem1", "mem2"])
+            self.assertTrue(gs2.get(1234).get_attendance_today("tg_id1", "handle1", "label1"))
+
+            # Compaction folds the journal into the snapshot
+            g.checkout_expedition("test1", "mem1", "han1", "lab1")
+            gs.save()
+            self.assertTrue(os.path.exists(Guilds.savefile))
+            self.assertEqual(storage.loadjournal(Guilds.journalfile), [])
+
+            gs.remove(1234)
+            gs.save()
+            gs3 = Guilds.load(storage=storage)
+            self.assertEqual(list(gs3.keys()), [])
+
+    def test_journal_append_failure(self):
+        storage = database.Storage(storage_type="local")
+        tmp = tempfile.mkdtemp()
+        with mock.patch.multiple(Guilds,
+                                 savefile=os.path.join(tmp, "guilds.json"),
+                                 journalfile=os.path.join(tmp, "guilds.journal"),
+                                 persistence="journal"):
+            gs = Guilds(storage=storage)
+            gs.set(1234, Guild(title="guild1", chat_id=1234))
+            gs.save()
+            g = gs.get(1234)
+            g.new_expedition("test1", "1200")
+            with mock.patch.object(storage, "appendfile", return_value=False):
+                gs.save()
+            self.assertTrue(g.changes.dirty)
+
+            # Appended after all but reported as failed, the retry must not apply it twice
+            append = storage.appendfile
+            g.checkin_expedition("test1", "mem1", "han1")
+            with mock.patch.object(storage, "appendfile", lambda records, filename: append(records, filename) and False):
+                gs.save()
+            gs.save()
+            self.assertFalse(g.changes.dirty)
+            gs2 = Guilds.load(storage=storage)
+            self.assertEqual([p.tg_id for p in gs2.get(1234).get_expedition("test1").members], ["mem1"])
+            self.assertEqual(gs2.journal_seq, 3)
+
+    def test_journaled_kwargs(self):
+        g = Guild(title="guild1", chat_id=1234)
+        g.new_expedition("test1", time="1200", description="desc")
+        g.checkin_expedition("test1", "mem1", "han1")
+        self.assertEqual(g.changes.drain(), [{"op": "new_expedition", "args": ["test1", "1200", "desc"]},
+                                             {"op": "checkin_expedition", "args": ["test1", "mem1", "han1"]}])
+        with self.assertRaises(TypeError):
+            g.new_expedition("test2", "1200", colour="red")
+        self.assertEqual(g.changes.drain(), [])
+
+    def test_long_title_rejected(self):
+        g = Guild(title="guild1", chat_id=1234)
+        g.new_expedition("test1", "1200")
+        g.changes.drain()
+        with self.assertRaises(ValueError):
+            g.new_expedition("t" * 63, "1200")
+        with self.assertRaises(ValueError):
+            g.set_expedition_title("test1", "\u00e9" * 32)  # 64 bytes in UTF-8
+        self.assertEqual(g.changes.drain(), [])
+        self.assertEqual(list(g.expeditions), ["test1"])
+        g.set_expedition_title("test1", "t" * 62)
+        self.assertEqual(g.get_expedition("t" * 62).title, "t" * 62)
+
+    def test_legacy_long_title(self):
+        g = Guild(title="guild1", chat_id=1234)
+        title = "Legacy" + "\u00e9" * 40  # Stored before the limit, 86 bytes in UTF-8
+        g.expeditions[title.lower()] = Expedition(title, "1300")
+        e = g.get_expedition(title)
+        self.assertEqual(e.callback_title(), "Legacy" + "\u00e9" * 28)
+        self.assertIs(g.get_expedition(e.callback_title()), e)
+        g.checkin_expedition(e.callback_title(), 1, "han1")
+        self.assertEqual(len(e.members), 1)
+        g.set_expedition_title(e.callback_title(), "short")
+        self.assertEqual(list(g.expeditions), ["short"])
+        g.delete_expedition("short")
+        self.assertEqual(list(g.expeditions), [])
+
+    def test_guild_json_has_no_runtime_state(self):
+        gs = Guilds(storage=database.Storage(storage_type="local"))
+        g = Guild(title="guild1", chat_id=1234)
+        g.new_expedition("test1", "1200")
+        gs.set(1234, g)
+        data = database.MODJson.loads(database.MODJson.dumps(g))
+        self.assertEqual(sorted(data), ["chat_id", "daily_reset_time", "expeditions", "fort", "last_reset", "members",
+                                        "pinned_message_id", "stopped", "title"])
+        self.assertEqual(gs.drain_changes()[0]["data"], data)
+        self.assertEqual(Guild.from_json(dict(data, lock=None, changes=None, listeners=None)).to_json().keys(),
+                         g.to_json().keys())
+
+    def test_sharded(self):
+        storage = database.Storage(storage_type="local")
+        tmp = tempfile.mkdtemp()
+        with mock.patch.multiple(Guilds,
+                                 savefile=os.path.join(tmp, "guilds.json"),
+                                 journalfile=os.path.join(tmp, "guilds.journal"),
+                                 sharddir=os.path.join(tmp, "guilds/"),
+                                 persistence="sharded"):
+            gs = Guilds(storage=storage)
+            gs.set(1, Guild(title="guild1", chat_id=1))
+            gs.set(2, Guild(title="guild2", chat_id=2))
+            gs.save()
+            self.assertEqual(storage.listfiles(Guilds.sharddir),
+                             [Guilds.shardfile(1), Guilds.shardfile(2), Guilds.indexfile()])
+            self.assertFalse(gs.get(1).dirty)
+
+            # Only the guild that changed is written
+            gs.get(2).new_expedition("test1", "1200")
+            self.assertTrue(gs.get(2).dirty)
+            self.assertFalse(gs.get(1).dirty)
+            with mock.patch.object(storage, "savefile", wraps=storage.savefile) as savefile:
+                gs.save()
+                savefile.assert_any_call(gs.get(2), Guilds.shardfile(2), "json")
+                self.assertNotIn(Guilds.shardfile(1), [c[0][1] for c in savefile.call_args_list])
+
+            gs.remove(1)
+            gs.save()
+            gs2 = Guilds.load(storage=storage)
+            self.assertEqual(list(gs2.keys()), [2])
+            self.assertEqual(gs2.get(2).get_expedition("test1").time, "1200")
+
+    def test_request_save_coalesces(self):
+        storage = database.Storage(storage_type="local")
+        tmp = tempfile.mkdtemp()
+        with mock.patch.multiple(Guilds,
+                                 savefile=os.path.join(tmp, "guilds.json"),
+                                 save_interval=0.2,
+                                 save_burst=1000):
+            gs = Guilds(storage=storage)
+            gs.set(1, Guild(title="guild1", chat_id=1))
+            with mock.patch.object(storage, "savefile", wraps=storage.savefile) as savefile:
+                for _ in range(20):
+                    gs.request_save()
+                time.sleep(0.5)
+                self.assertEqual(savefile.call_count, 1)
+
+                gs.get(1).new_expedition("test1", "1200")
+                gs.request_save()
+                gs.flush()  # Does not wait for the interval
+                self.assertEqual(savefile.call_count, 2)
+            self.assertIn("test1", Guilds.load(storage=storage).get(1).expeditions)
+            atexit.unregister(gs.flush)  # It would save to the default savefile once the patch is gone
+
+    def test_local_generations(self):
+        storage = database.Storage(storage_type="local")
+        storage.local_generations = 2
+        filename = os.path.join(tempfile.mkdtemp(), "guilds.json")
+        for i in range(4):
+            storage.savefile({"version": i}, filename, "json")
+        self.assertEqual(sorted(os.listdir(os.path.dirname(filename))), ["guilds.json", "guilds.json.1", "guilds.json.2"])
+        self.assertEqual(storage.loadfile(filename + ".2", "json"), {"version": 1})
+
+        # A corrupt latest version falls back to the previous generation
+        with open(filename, "w") as f:
+            f.write('{"version"')
+        self.assertEqual(storage.loadfile(filename, "json"), {"version": 2})
+
+    def test_sqlite(self):
+        path = os.path.join(tempfile.mkdtemp(), "guilds.sqlite3")
+        with mock.patch.dict(os.environ, {"SQLITE_PATH": path}):
+            storage = database.Storage(storage_type="sqlite")
+        gs = Guilds(storage=storage)
+        gs.set(1, Guild(title="guild1", chat_id=1))
+        gs.set(2, Guild(title="guild2", chat_id=2))
+        g = gs.get(1)
+        g.new_expedition("test1", "1200", "desc")
+        g.checkin_expedition("test1", "mem1", "han1", "lab1")
+        g.checkin_expedition("test1", "mem2", "han2")
+        g.daily_expedition("test1", "mem2", "han2")
+        g.ready_expedition("test1", "mem1", "han1", "lab1")
+        g.set_expedition_title("test1", "Test2")
+        g.new_expedition("test3", "1300")
+        g.fort_mark("tg_id1", "handle1", "label1")
+        g.update_fort_history()
+        g.fort_mark("tg_id1", "handle1", "label1")
+        g.fort_mark("tg_id2", "handle2")
+        g.fort_unmark("tg_id2", "handle2")
+        g.set_pinned_message(42)
+        gs.save()
+        g.reset_expeditions()
+        g.fort_mark("tg_id2", "handle2")
+        g.daily_reset("2020-01-01")
+        g.delete_expedition("test3")
+        gs.remove(2)
+        gs.save()
+
+        gs2 = Guilds.load(storage=storage)
+        self.assertEqual(list(gs2.keys()), [1])
+        self.assertEqual(database.MODJson.dumps(gs2.get(1)), database.MODJson.dumps(g))
+
+        # Importing a savefile gives the same guild back
+        with mock.patch.dict(os.environ, {"SQLITE_PATH": os.path.join(tempfile.mkdtemp(), "guilds.sqlite3")}):
+            imported = database.Storage(storage_type="sqlite")
+        imported.import_guilds(database.MODJson.loads(database.MODJson.dumps({"guilds": gs.guilds})))
+        self.assertEqual(imported.load_guild(1), storage.load_guild(1))
+
+    def test_lazy_hydration(self):
+        storage = database.Storage(storage_type="local")
+        tmp = tempfile.mkdtemp()
+        with mock.patch.multiple(Guilds,
+                                 sharddir=os.path.join(tmp, "guilds/"),
+                                 persistence="sharded",
+                                 max_resident=2,
+                                 evict_after=0):
+            gs = Guilds(storage=storage)
+            for i in range(1, 5):
+                gs.set(i, Guild(title="guild{}".format(i), chat_id=i))
+            gs.get(4).stop()
+            gs.save()
+
+            gs2 = Guilds.load(storage=storage)
+            self.assertEqual(sorted(gs2.keys()), [1, 2, 3, 4])
+            self.assertEqual(len(gs2.guilds), 0)
+            with self.assertRaises(GuildNotFoundError):
+                gs2.get(4)
+            self.assertEqual(len(gs2.guilds), 0)  # Stopped guilds are answered from the index
+
+            gs2.get(1).new_expedition("test1", "1200")
+            gs2.get(2)
+            gs2.get(3)
+            self.assertEqual(list(gs2.guilds), [1, 3])  # Dirty guild 1 is kept, clean guild 2 is evicted
+            gs2.save()
+            self.assertEqual([chat_id for chat_id, entry in gs2.active_index()], [1, 2, 3])
+            self.assertIn("test1", gs2.get(1).expeditions)
+            self.assertLessEqual(len(gs2.guilds), 2)
+
+    def test_fort_history_migration(self):
+        old_key = json.dumps({"label": "", "tg_handle": "handle1", "tg_id": 1}, sort_keys=True)
+        renamed_key = json.dumps({"label": "", "tg_handle": "renamed", "tg_id": 1}, sort_keys=True)
+        alt_key = json.dumps({"label": "alt", "tg_handle": "handle1", "tg_id": 1}, sort_keys=True)
+        fort = Fort.from_json({"roster": [], "attendance": [], "history": {old_key: 2, renamed_key: 1, alt_key: 4}})
+        self.assertEqual(fort.history, {"1:": 3, "1:alt": 4})
+        self.assertEqual(fort.name_of("1:alt"), "handle1 alt")
+
+        g = Guild(fort=fort)
+        g.fort_mark(1, "handle2", "")
+        g.update_fort_history()
+        self.assertEqual(g.get_history_of(1, "handle2", ""), 4)
+        self.assertEqual(fort.name_of("1:"), "handle2")
+
+    def test_expedition_time(self):
+        e = Expedition("test1", "0230")
+        self.assertEqual(e.get_time(), datetime.strptime("0230", "%H%M").time())
+        self.assertEqual(e.minutes_since_reset(3), 23 * 60 + 30)  # Just before the next reset
+        self.assertEqual(e.minutes_since_reset(0), 150)
+        e.set_time("0300")
+        self.assertEqual(e.minutes_since_reset(3), 0)
+        with self.assertRaises(ValueError):
+            e.set_time("2500")
+        self.assertEqual(e.time, "0300")
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
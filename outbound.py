@@ -0,0 +1,420 @@
+import atexit
+import functools
+import heapq
+import logging
+import sys
+import threading
+import time
+
+from telebot import apihelper
+
+import metrics
+import profiler
+
+# Lower values are sent first
+PRIORITY_CALLBACK = 0
+PRIORITY_REPLY = 1
+PRIORITY_REMINDER = 2
+PRIORITY_PIN = 3
+PRIORITY_BACKGROUND = 4
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity, now):
+        self.rate = rate  # tokens per second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready_at(self, now):
+        self.refill(now)
+        if self.tokens >= 1:
+            return now
+        return now + (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self.refill(now)
+        self.tokens -= 1
+
+
+class OutboundTask:
+    """Result of a queued call. wait() behaves like telebot's AsyncTask: it returns the result,
+    or the sys.exc_info() tuple of the last failure."""
+
+    def __init__(self, priority, seq, chat_id, method, args, kwargs):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.attempts = 0
+        self.not_before = 0
+        self.taken_at = None
+        self.result = None
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+        self.callbacks = []
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+    def add_done_callback(self, fn):
+        """Calls fn with the task once it is done, right away if it already is."""
+        with self.lock:
+            if not self.done.is_set():
+                self.callbacks.append(fn)
+                return
+        fn(self)
+
+    def finish(self, result):
+        with self.lock:
+            self.result = result
+            self.done.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception as e:
+                logging.exception(e)
+
+    def wait(self, timeout=None):
+        with profiler.span("telegram"):
+            self.done.wait(timeout)
+        return self.result
+
+
+class Outbound:
+    """Prioritized queue for every outbound Telegram call, drained by a few sender threads, or by
+    aio.AsyncSender in the asyncio runtime.
+
+    Calls go out highest priority first, within a global token bucket and one token bucket per chat
+    for the messages posted to it (Telegram allows about 30 messages a second overall, 20 a minute
+    per group and 1 a second per private chat). Edits and deletes don't post messages and are not
+    charged to the chat's bucket. Calls to the same chat are sent one at a time and in order. 429
+    responses block the chat for retry_after seconds, other server and network errors back off
+    exponentially.
+    """
+    CHAT_METHODS = ["send_message", "edit_message_text", "pin_chat_message", "delete_message"]
+    POSTING_METHODS = ["send_message", "pin_chat_message"]  # charged to the chat's bucket
+
+    def __init__(self, bot, workers=4, global_rate=30, group_rate=20 / 60, private_rate=1,
+                 max_retries=5, backoff=1, clock=time.monotonic):
+        self.bot = bot  # a synchronous telebot.TeleBot
+        self.global_rate = global_rate
+        self.group_rate = group_rate
+        self.private_rate = private_rate
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.clock = clock
+        self.cond = threading.Condition()
+        self.queues = {}  # chat_id -> heap of tasks, None for calls without a chat
+        self.buckets = {}
+        self.global_bucket = TokenBucket(global_rate, global_rate, clock())
+        self.blocked_until = {}  # chat_id -> time, after a 429
+        self.in_flight = set()
+        self.seq = 0
+        self.counters = {"sent": 0, "retried": 0, "failed": 0, "rate_limited": 0}
+        self.wakeup = None  # called whenever a task may have become ready, for senders that don't wait on cond
+        self.start(workers)
+
+    def start(self, workers):
+        for _ in range(workers):
+            threading.Thread(target=self.__work, daemon=True).start()
+
+    def submit(self, priority, chat_id, method, args, kwargs, delay=0):
+        """Queues a call, to be sent no sooner than delay seconds from now."""
+        with self.cond:
+            self.seq += 1
+            task = OutboundTask(priority, self.seq, chat_id, method, args, kwargs)
+            if delay > 0:
+                task.not_before = self.clock() + delay
+            heapq.heappush(self.queues.setdefault(chat_id, []), task)
+            self.cond.notify()
+        self.__wake()
+        return task
+
+    def call(self, method, *args, priority=PRIORITY_REPLY, delay=0, **kwargs):
+        chat_id = None
+        if method in self.CHAT_METHODS:
+            chat_id = kwargs["chat_id"] if "chat_id" in kwargs else args[0]
+        return self.submit(priority, chat_id, method, args, kwargs, delay)
+
+    def send_message(self, *args, priority=PRIORITY_REPLY, delay=0, **kwargs):
+        return self.call("send_message", *args, priority=priority, delay=delay, **kwargs)
+
+    def edit_message_text(self, *args, priority=PRIORITY_REPLY, delay=0, **kwargs):
+        return self.call("edit_message_text", *args, priority=priority, delay=delay, **kwargs)
+
+    def pin_chat_message(self, *args, priority=PRIORITY_PIN, **kwargs):
+        return self.call("pin_chat_message", *args, priority=priority, **kwargs)
+
+    def delete_message(self, *args, priority=PRIORITY_BACKGROUND, **kwargs):
+        return self.call("delete_message", *args, priority=priority, **kwargs)
+
+    def answer_callback_query(self, *args, priority=PRIORITY_CALLBACK, **kwargs):
+        return self.call("answer_callback_query", *args, priority=priority, **kwargs)
+
+    def stats(self):
+        with self.cond:
+            by_priority = {}
+            for queue in self.queues.values():
+                for task in queue:
+                    by_priority[task.priority] = by_priority.get(task.priority, 0) + 1
+            return dict(self.counters,
+                        queued=sum(by_priority.values()),
+                        queued_by_priority=by_priority,
+                        in_flight=len(self.in_flight),
+                        blocked_chats=sum(1 for t in self.blocked_until.values() if t > self.clock()))
+
+    def __bucket(self, chat_id, now):
+        if chat_id not in self.buckets:
+            # Groups may burst a minute's worth of messages, private chats get one a second.
+            # Chat ids can also be strings, like "@channelname".
+            if str(chat_id).startswith("-"):
+                self.buckets[chat_id] = TokenBucket(self.group_rate, max(1, self.group_rate * 60), now)
+            else:
+                self.buckets[chat_id] = TokenBucket(self.private_rate, 1, now)
+        return self.buckets[chat_id]
+
+    def __next_task(self, now):
+        """Returns (task, None) for the best task that can go now, or (None, time the next one can)."""
+        best = None
+        wake = None
+        for chat_id, queue in self.queues.items():
+            if len(queue) == 0 or (chat_id is not None and chat_id in self.in_flight):
+                continue
+            task = queue[0]
+            ready = task.not_before
+            if chat_id is not None:
+                bucket_ready = self.__bucket(chat_id, now).ready_at(now)
+                if task.method in self.POSTING_METHODS and bucket_ready > now:
+                    # Edits and deletes are not held up behind posts waiting for the chat's bucket
+                    passing = [t for t in queue if t.method not in self.POSTING_METHODS and t.not_before <= now]
+                    if len(passing) > 0:
+                        task = min(passing)
+                        ready = task.not_before
+                    else:
+                        ready = max(ready, bucket_ready)
+                ready = max(ready, self.blocked_until.get(chat_id, 0))
+            if ready > now:
+                wake = ready if wake is None else min(wake, ready)
+            elif best is None or task < best:
+                best = task
+        if best is None:
+            return None, wake
+        global_ready = self.global_bucket.ready_at(now)
+        if global_ready > now:
+            return None, global_ready
+        return best, None
+
+    def take(self):
+        """Pops the best call that may be sent now and charges its rate limits.
+
+        Returns (task, None), or (None, time the next call may be sent) when nothing can go yet.
+        """
+        with self.cond:
+            now = self.clock()
+            task, wake = self.__next_task(now)
+            if task is None:
+                return None, wake
+            queue = self.queues[task.chat_id]
+            if queue[0] is task:
+                heapq.heappop(queue)
+            else:
+                queue.remove(task)
+                heapq.heapify(queue)
+            if len(queue) == 0:
+                del self.queues[task.chat_id]
+            self.global_bucket.take(now)
+            task.taken_at = now
+            if task.chat_id is not None:
+                if task.method in self.POSTING_METHODS:
+                    self.__bucket(task.chat_id, now).take(now)
+                self.in_flight.add(task.chat_id)
+            return task, None
+
+    def __work(self):
+        while True:
+            with self.cond:
+                task, wake = self.take()
+                while task is None:
+                    self.cond.wait(None if wake is None else max(wake - self.clock(), 0.001))
+                    task, wake = self.take()
+            try:
+                result = getattr(self.bot, task.method)(*task.args, **task.kwargs)
+            except Exception:
+                self.settle(task, error=sys.exc_info())
+            else:
+                self.settle(task, result)
+
+    def settle(self, task, result=None, error=None):
+        """Completes a taken task with its result, or requeues it if error (an exc_info tuple) is worth retrying."""
+        task.attempts += 1
+        status = None
+        if error is not None and isinstance(error[1], apihelper.ApiException):
+            status = getattr(error[1].result, "status_code", None)
+        if task.taken_at is not None:
+            outcome = "ok" if error is None else str(status or "error")
+            metrics.outbound_seconds.observe(self.clock() - task.taken_at, task.method, outcome)
+        if error is None:
+            return self.__done(task, result, "sent")
+
+        retry_after = None
+        e = error[1]
+        if isinstance(e, apihelper.ApiException):
+            if status == 429:
+                retry_after = self.__retry_after(e)
+            elif status is None or status < 500:
+                return self.__done(task, error, "failed")  # The request itself is wrong, retrying won't help
+
+        if task.attempts > self.max_retries:
+            logging.error("Giving up on {} to {}: {}".format(task.method, task.chat_id, e))
+            return self.__done(task, error, "failed")
+        with self.cond:
+            now = self.clock()
+            if retry_after is not None:
+                self.counters["rate_limited"] += 1
+                if task.chat_id is not None:
+                    self.blocked_until[task.chat_id] = now + retry_after
+                else:
+                    task.not_before = now + retry_after
+            else:
+                task.not_before = now + self.backoff * 2 ** (task.attempts - 1)
+            self.counters["retried"] += 1
+            heapq.heappush(self.queues.setdefault(task.chat_id, []), task)  # Keeps its place in the order
+            self.in_flight.discard(task.chat_id)
+            self.cond.notify_all()
+        self.__wake()
+
+    @staticmethod
+    def __retry_after(e):
+        try:
+            return e.result.json()["parameters"]["retry_after"]
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return 1
+
+    def __done(self, task, result, counter):
+        with self.cond:
+            self.counters[counter] += 1
+            self.in_flight.discard(task.chat_id)
+            self.cond.notify_all()
+        task.finish(result)
+        self.__wake()
+
+    def __wake(self):
+        if self.wakeup is not None:
+            self.wakeup()
+
+
+def utf16_len(text):
+    """Length of text as Telegram counts it, in UTF-16 code units."""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def utf16_truncate(text, limit):
+    """Longest prefix of text within limit UTF-16 code units, without splitting a surrogate pair."""
+    if len(text) * 2 <= limit:
+        return text  # Fast path, no character takes more than two units
+    return text.encode("utf-16-le")[:limit * 2].decode("utf-16-le", errors="ignore")
+
+
+class Digest:
+    """Packs lines of text into as few messages to chat_id as possible, sent at background priority.
+
+    A digest goes out when the next line would take it past limit UTF-16 code units, or max_delay
+    seconds after its first line. While max_pending digests are still waiting in the outbound queue,
+    new lines are dropped and counted instead of piling up. On exit the buffered lines are flushed,
+    waiting up to shutdown_wait seconds for the pending digests to be sent.
+    """
+
+    def __init__(self, outbound, chat_id, limit=4096, max_delay=30, max_pending=5, shutdown_wait=5,
+                 clock=time.monotonic):
+        self.outbound = outbound
+        self.chat_id = chat_id
+        self.limit = limit
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.shutdown_wait = shutdown_wait
+        self.clock = clock
+        self.cond = threading.Condition()
+        self.lines = []
+        self.size = 0
+        self.first_at = None
+        self.pending = []  # digests submitted but not sent yet
+        self.counters = {"lines": 0, "digests": 0, "dropped": 0}
+        self.last_lag = 0  # seconds the oldest line of the last digest sent waited until it was sent
+        self.max_lag = 0
+        threading.Thread(target=self.__work, daemon=True).start()
+        atexit.register(self.close)
+
+    def add(self, line):
+        """Returns False if the line was dropped."""
+        line = utf16_truncate(line, self.limit)
+        size = utf16_len(line) + 1
+        with self.cond:
+            self.pending = [task for task in self.pending if not task.done.is_set()]
+            if len(self.pending) >= self.max_pending:
+                self.counters["dropped"] += 1
+                return False
+            if self.size + size > self.limit + 1:  # The last line has no newline
+                self.__flush()
+            if self.first_at is None:
+                self.first_at = self.clock()
+                self.cond.notify()
+            self.lines.append(line)
+            self.size += size
+            self.counters["lines"] += 1
+        return True
+
+    def flush(self):
+        with self.cond:
+            self.__flush()
+
+    def close(self):
+        """Flushes the buffered lines and waits up to shutdown_wait seconds for the digests to be sent."""
+        with self.cond:
+            self.__flush()
+            pending = list(self.pending)
+        deadline = time.monotonic() + self.shutdown_wait
+        for task in pending:
+            task.wait(max(deadline - time.monotonic(), 0))
+
+    def stats(self):
+        with self.cond:
+            return dict(self.counters, buffered=len(self.lines), pending=len(self.pending),
+                        last_lag=self.last_lag, max_lag=self.max_lag)
+
+    def __flush(self):
+        if len(self.lines) == 0:
+            return
+        task = self.outbound.send_message(self.chat_id, "\n".join(self.lines), priority=PRIORITY_BACKGROUND)
+        task.add_done_callback(functools.partial(self.__sent, self.first_at))
+        self.pending.append(task)
+        self.counters["digests"] += 1
+        self.lines = []
+        self.size = 0
+        self.first_at = None
+
+    def __sent(self, first_at, task):
+        if type(task.result) is tuple:
+            return  # Failed, the lag of a digest that never arrived is not measured
+        with self.cond:
+            self.last_lag = self.clock() - first_at
+            self.max_lag = max(self.max_lag, self.last_lag)
+
+    def __work(self):
+        with self.cond:
+            while True:
+                if self.first_at is None:
+                    self.cond.wait()
+                    continue
+                due = self.first_at + self.max_delay - self.clock()
+                if due > 0:
+                    self.cond.wait(due)
+                    continue
+                self.__flush()
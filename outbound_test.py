@@ -0,0 +1,184 @@
+import time
+import unittest
+
+import telebot
+
+import outbound as o
+from fakebotapi import FakeBotApi, use_api_url
+
+
+class TestOutbound(unittest.TestCase):
+    def setUp(self):
+        self.api = FakeBotApi().start()
+        use_api_url(self.api.url)
+        self.bot = telebot.TeleBot("TOKEN")
+
+    def tearDown(self):
+        self.api.stop()
+
+    def test_send(self):
+        out = o.Outbound(self.bot)
+        sent = out.send_message(-1, "hello").wait(5)
+        self.assertEqual(sent.message_id, 1)
+        self.assertEqual(self.api.calls_to("sendMessage")[0][2]["text"], "hello")
+        self.assertEqual(out.stats()["sent"], 1)
+
+    def test_priority(self):
+        out = o.Outbound(self.bot, workers=0)
+        tasks = [
+            out.delete_message(-1, 5),
+            out.send_message(-2, "reminder", priority=o.PRIORITY_REMINDER),
+            out.edit_message_text("pin", chat_id=-3, message_id=1, priority=o.PRIORITY_PIN),
+            out.send_message(-4, "reply"),
+            out.answer_callback_query("1", text="ok"),
+        ]
+        self.assertEqual(out.stats()["queued"], 5)
+        self.assertEqual(out.stats()["queued_by_priority"][o.PRIORITY_PIN], 1)
+        out.start(1)
+        for task in tasks:
+            task.wait(5)
+        methods = [c[1] for c in self.api.calls]
+        self.assertEqual(methods, ["answerCallbackQuery", "sendMessage", "sendMessage", "editMessageText", "deleteMessage"])
+        self.assertEqual([c[2]["text"] for c in self.api.calls_to("sendMessage")], ["reply", "reminder"])
+
+    def test_chat_rate_limit(self):
+        out = o.Outbound(self.bot, private_rate=10)
+        tasks = [out.send_message(1, str(i)) for i in range(3)]
+        for task in tasks:
+            task.wait(5)
+        calls = self.api.calls_to("sendMessage")
+        self.assertEqual([c[2]["text"] for c in calls], ["0", "1", "2"])
+        self.assertGreaterEqual(calls[2][0] - calls[0][0], 0.18)
+
+    def test_retry_after(self):
+        out = o.Outbound(self.bot)
+        self.api.fail("sendMessage", 429, retry_after=0.3)
+        sent = out.send_message(-1, "hello").wait(5)
+        self.assertEqual(sent.text, "hello")
+        calls = self.api.calls_to("sendMessage")
+        self.assertEqual(len(calls), 2)
+        self.assertGreaterEqual(calls[1][0] - calls[0][0], 0.3)
+        self.assertEqual(out.stats()["rate_limited"], 1)
+
+    def test_server_error_backoff(self):
+        out = o.Outbound(self.bot, backoff=0.05, max_retries=2)
+        self.api.fail("sendMessage", 502, times=3)
+        sent = out.send_message(-1, "hello").wait(5)
+        self.assertIs(type(sent), tuple)
+        self.assertEqual(len(self.api.calls_to("sendMessage")), 3)
+        self.assertEqual(out.stats()["failed"], 1)
+
+    def test_bad_request_not_retried(self):
+        out = o.Outbound(self.bot)
+        self.api.fail("sendMessage", 403)
+        sent = out.send_message(-1, "hello").wait(5)
+        self.assertIs(type(sent), tuple)
+        self.assertIn("Fake error", sent[1].result.text)
+        self.assertEqual(len(self.api.calls_to("sendMessage")), 1)
+
+
+    def test_string_chat_ids(self):
+        out = o.Outbound(self.bot, workers=0, group_rate=1, private_rate=1)
+        out.send_message("@channelname", "1")
+        out.send_message("@channelname", "2")
+        out.send_message("-1001", "1")
+        out.send_message("-1001", "2")
+        self.assertEqual(out.take()[0].chat_id, "@channelname")
+        self.assertEqual(out.take()[0].chat_id, "-1001")
+        self.assertEqual(out.buckets["@channelname"].capacity, 1)  # Not a group, no burst
+        self.assertEqual(out.buckets["-1001"].capacity, 60)
+
+    def test_edits_and_deletes_skip_chat_bucket(self):
+        out = o.Outbound(self.bot, workers=0, group_rate=1 / 60)
+        out.send_message(-1, "reply")
+        out.delete_message(-1, 10)
+        out.edit_message_text("pinned", chat_id=-1, message_id=11)
+        out.send_message(-1, "reply")
+        taken = []
+        for _ in range(4):
+            task, _ = out.take()
+            if task is None:
+                break
+            taken.append(task.method)
+            out.settle(task, True)
+        # The group's single token went to the first reply, the second one waits for a minute
+        self.assertEqual(taken, ["send_message", "edit_message_text", "delete_message"])
+
+
+class TestDigest(unittest.TestCase):
+    def setUp(self):
+        self.api = FakeBotApi().start()
+        use_api_url(self.api.url)
+        self.out = o.Outbound(telebot.TeleBot("TOKEN"))
+
+    def tearDown(self):
+        self.api.stop()
+
+    def wait_sent(self, n):
+        for _ in range(200):
+            if len(self.api.calls_to("sendMessage")) >= n:
+                break
+            time.sleep(0.01)
+        return [c[2]["text"] for c in self.api.calls_to("sendMessage")]
+
+    def test_packs_lines(self):
+        digest = o.Digest(self.out, -9, limit=20, max_delay=0.2)
+        for line in ["line1", "line2", "line3", "line4"]:
+            digest.add(line)
+        # The fourth line would take the first digest past 20 characters
+        self.assertEqual(self.wait_sent(1), ["line1\nline2\nline3"])
+        self.assertEqual(self.wait_sent(2), ["line1\nline2\nline3", "line4"])
+        self.assertEqual(digest.stats()["digests"], 2)
+        self.assertGreaterEqual(digest.stats()["max_lag"], 0.2)
+
+    def test_drops_when_backed_up(self):
+        out = o.Outbound(None, workers=0)
+        digest = o.Digest(out, -9, limit=10, max_pending=1, shutdown_wait=0)
+        self.assertTrue(digest.add("123456789"))
+        self.assertTrue(digest.add("123456789"))  # Flushes the first digest
+        self.assertFalse(digest.add("123456789"))
+        self.assertEqual(digest.stats()["dropped"], 1)
+        self.assertEqual(out.stats()["queued_by_priority"][o.PRIORITY_BACKGROUND], 1)
+
+    def test_counts_utf16_units(self):
+        out = o.Outbound(None, workers=0)
+        digest = o.Digest(out, -9, limit=10, shutdown_wait=0)
+        # Each emoji is two UTF-16 code units, the way Telegram counts message length
+        digest.add("\U0001F600" * 3)
+        digest.add("\U0001F600" * 3)
+        digest.add("\U0001F600" * 6)
+        digest.flush()
+        self.assertEqual([task.args[1] for task in digest.pending],
+                         ["\U0001F600" * 3, "\U0001F600" * 3, "\U0001F600" * 5])
+        self.assertEqual(o.utf16_len("a\U0001F600"), 3)
+        self.assertEqual(o.utf16_truncate("a\U0001F600", 2), "a")
+
+    def test_lag_measured_when_sent(self):
+        now = [0]
+        out = o.Outbound(None, workers=0)
+        digest = o.Digest(out, -9, max_delay=100, shutdown_wait=0, clock=lambda: now[0])
+        digest.add("line1")
+        now[0] = 1
+        digest.flush()
+        self.assertEqual(digest.stats()["last_lag"], 0)
+        now[0] = 3
+        digest.pending[0].finish(True)
+        self.assertEqual(digest.stats()["last_lag"], 3)
+
+        # A failed digest is not measured
+        digest.add("line2")
+        digest.flush()
+        now[0] = 10
+        digest.pending[-1].finish((Exception, Exception("failed"), None))
+        self.assertEqual(digest.stats()["last_lag"], 3)
+        self.assertEqual(digest.stats()["max_lag"], 3)
+
+    def test_close_flushes(self):
+        digest = o.Digest(self.out, -9, max_delay=100)
+        digest.add("line1")
+        digest.close()
+        self.assertEqual([c[2]["text"] for c in self.api.calls_to("sendMessage")], ["line1"])
+
+
+if __name__ == '__main__':
+    unittest.main()
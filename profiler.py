@@ -0,0 +1,205 @@
+import cProfile
+import datetime as dt
+import functools
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Phases a command's time is broken into by the slow command log, anything else counts as "other"
+PHASES = ["parse", "lock_wait", "mutation", "render", "storage", "telegram"]
+
+_local = threading.local()  # .trace of the command running on this thread
+
+
+class Trace:
+    def __init__(self, name, chat_id, started):
+        self.name = name
+        self.chat_id = chat_id
+        self.started = started
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.active = set()  # phases being timed, nested spans of the same phase are only counted once
+
+
+def add(phase, seconds):
+    """Adds seconds to a phase of the command running on this thread, if any."""
+    trace = getattr(_local, "trace", None)
+    if trace is not None:
+        trace.phases[phase] += seconds
+
+
+@contextmanager
+def span(phase):
+    """Times the block as a phase of the command running on this thread, if any."""
+    trace = getattr(_local, "trace", None)
+    if trace is None or phase in trace.active:
+        yield
+        return
+    trace.active.add(phase)
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        trace.phases[phase] += time.monotonic() - started
+        trace.active.discard(phase)
+
+
+def phase(name):
+    """Decorator form of span."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if getattr(_local, "trace", None) is None:
+                return fn(*args, **kwargs)
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class Capture:
+    """One profiling session: cProfile of each command, or stack samples of every thread."""
+
+    def __init__(self, mode, commands):
+        self.mode = mode
+        self.commands = commands  # stop after this many commands, or None
+        self.profiled = 0
+        self.stats = None  # pstats.Stats merged from the commands profiled so far
+        self.samples = {}  # folded stack -> count
+        self.done = threading.Event()
+
+
+class Profiler:
+    """Opt-in profiling of commands, and a log of commands slower than slow_ms.
+
+    start() captures either cProfile of the next `commands` commands or those within `seconds`, or
+    samples the stacks of all threads every `interval` seconds in that time. stop() writes the
+    capture to `directory`, as a .prof file for pstats/snakeviz or a .folded file for flamegraph.pl.
+    """
+
+    def __init__(self, directory="profiles", slow_ms=1000, interval=0.005, clock=time.monotonic):
+        self.directory = directory
+        self.slow_ms = slow_ms  # 0 turns the slow command log off
+        self.interval = interval
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.capture = None
+        self.slow = 0
+
+    def start(self, mode="cprofile", commands=None, seconds=None):
+        if mode not in ["cprofile", "sampling"]:
+            raise ValueError("Unknown profile mode {}".format(mode))
+        if commands is None and seconds is None:
+            raise ValueError("Profile needs a number of commands or seconds")
+        with self.lock:
+            if self.capture is not None:
+                raise ValueError("Already profiling")
+            self.capture = Capture(mode, commands)
+            capture = self.capture
+        if mode == "sampling":
+            threading.Thread(target=self.__sample, args=(capture,), daemon=True).start()
+        if seconds is not None:
+            timer = threading.Timer(seconds, self.stop, args=(capture,))
+            timer.daemon = True
+            timer.start()
+        logging.warning("Profiling with {} for {}".format(
+            mode, "{} commands".format(commands) if commands is not None else "{}s".format(seconds)))
+
+    def stop(self, capture=None):
+        """Ends the capture, or only `capture` if it is still the current one, and writes it out.
+        Returns the file written or None."""
+        with self.lock:
+            if self.capture is None or (capture is not None and self.capture is not capture):
+                return None
+            capture, self.capture = self.capture, None
+        capture.done.set()
+        return self.__write(capture)
+
+    def running(self):
+        return self.capture is not None
+
+    @contextmanager
+    def command(self, name, chat_id):
+        """Traces the command run in the block, and profiles it if a cProfile capture is on."""
+        if getattr(_local, "trace", None) is not None:
+            yield  # Already inside a traced command on this thread, its trace covers this block too
+            return
+        trace = _local.trace = Trace(name, chat_id, self.clock())
+        capture = self.capture
+        profile = None
+        if capture is not None and capture.mode == "cprofile":
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                profile = None  # Another thread's profile is active on interpreters with one global profiler
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            _local.trace = None
+            self.__finish(trace, capture, profile)
+
+    def __finish(self, trace, capture, profile):
+        elapsed = self.clock() - trace.started
+        if 0 < self.slow_ms <= elapsed * 1000:
+            self.slow += 1
+            other = elapsed - sum(trace.phases.values())
+            logging.warning("Slow command {} in {}: {:.0f}ms ({}, other {:.1f}ms)".format(
+                trace.name, trace.chat_id, elapsed * 1000,
+                ", ".join("{} {:.1f}ms".format(p, trace.phases[p] * 1000) for p in PHASES), max(other, 0) * 1000))
+        if capture is None:
+            return
+        with self.lock:
+            capture.profiled += 1
+            if profile is not None:
+                if capture.stats is None:
+                    capture.stats = pstats.Stats(profile)
+                else:
+                    capture.stats.add(profile)
+            finished = capture.commands is not None and capture.profiled >= capture.commands
+        if finished:
+            self.stop(capture)
+
+    def __sample(self, capture):
+        me = threading.get_ident()
+        while not capture.done.wait(self.interval):
+            stacks = []
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("{}:{}".format(os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                stacks.append(";".join(reversed(stack)))
+            with self.lock:
+                for folded in stacks:
+                    capture.samples[folded] = capture.samples.get(folded, 0) + 1
+
+    def __write(self, capture):
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = dt.datetime.now().strftime("%Y%m%d-%H%M%S")
+        if capture.mode == "cprofile":
+            if capture.stats is None:
+                logging.warning("Profile captured no commands")
+                return None
+            path = os.path.join(self.directory, "{}-cprofile.prof".format(stamp))
+            capture.stats.dump_stats(path)
+        else:
+            path = os.path.join(self.directory, "{}-sampling.folded".format(stamp))
+            with self.lock:
+                samples = sorted(capture.samples.items())
+            with open(path, "w") as f:
+                for stack, count in samples:
+                    f.write("{} {}\n".format(stack, count))
+        logging.warning("Profile of {} commands written to {}".format(capture.profiled, path))
+        return path
+
+
+profiler = Profiler(directory=os.getenv("PROFILE_DIR", "profiles"), slow_ms=int(os.getenv("SLOW_COMMAND_MS", 1000)))
@@ -0,0 +1,67 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import profiler
+
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.profiler = profiler.Profiler(directory=self.dir, slow_ms=10, interval=0.001)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_slow_command_breakdown(self):
+        @profiler.phase("render")
+        def render():
+            with profiler.span("render"):  # Nested spans of one phase count once
+                time.sleep(0.01)
+
+        with self.assertLogs(level="WARNING") as logs:
+            with self.profiler.command("exped.view", -1):
+                with profiler.span("parse"):
+                    pass
+                profiler.add("lock_wait", 0.005)
+                render()
+        self.assertEqual(self.profiler.slow, 1)
+        self.assertIn("Slow command exped.view in -1", logs.output[0])
+        self.assertIn("lock_wait 5.0ms", logs.output[0])
+        self.assertRegex(logs.output[0], r"render 1\d\.\dms")
+
+        with self.profiler.command("exped.view", -1):
+            pass  # Fast, not logged
+        self.assertEqual(self.profiler.slow, 1)
+
+    def test_cprofile_commands(self):
+        self.profiler.start("cprofile", commands=2)
+        with self.assertRaises(ValueError):
+            self.profiler.start("sampling", seconds=1)
+        for _ in range(2):
+            with self.profiler.command("fort.mark", -1):
+                sorted(range(1000))
+        self.assertFalse(self.profiler.running())
+        files = os.listdir(self.dir)
+        self.assertEqual(len(files), 1)
+        self.assertTrue(files[0].endswith("-cprofile.prof"))
+
+    def test_sampling_window(self):
+        self.profiler.start("sampling", seconds=0.1)
+        deadline = time.monotonic() + 0.1
+        while time.monotonic() < deadline:
+            pass
+        for _ in range(100):
+            if not self.profiler.running():
+                break
+            time.sleep(0.01)
+        self.assertFalse(self.profiler.running())
+        self.assertIsNone(self.profiler.stop())
+        with open(os.path.join(self.dir, os.listdir(self.dir)[0])) as f:
+            self.assertIn("profiler_test.py:test_sampling_window", f.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,44 @@
+import profiler
+import router
 import utils
 from telebot import types
+from collections import OrderedDict
+from threading import Lock
 import datetime as dt
+import functools
+
+
+class RenderCache:
+    """Rendered blocks of expeditions keyed by (kind, Expedition.version), least recently used dropped first.
+
+    Guild mutations bump the version of the expedition they change, so a cached block is never stale
+    and only changed expeditions are rendered again.
+    """
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.blocks = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, kind, expedition, render):
+        key = (kind, expedition.version)
+        with self.lock:
+            if key in self.blocks:
+                self.hits += 1
+                self.blocks.move_to_end(key)
+                return self.blocks[key]
+            self.misses += 1
+        block = render(expedition)
+        with self.lock:
+            self.blocks[key] = block
+            if len(self.blocks) > self.maxsize:
+                self.blocks.popitem(last=False)
+        return block
+
+
+render_cache = RenderCache()
 
 
 def escape_for_markdown(s):
@@ -9,8 +47,7 @@ def escape_for_markdown(s):
     return s
 
 
-def render_adv_text():
-    return """
+ADV_TEXT = """
 Advanced commands:
 Register alt:
 /exped reg <team> <alt>
@@ -21,6 +58,10 @@ Change time:
 """
 
 
+def render_adv_text():
+    return ADV_TEXT
+
+
 def render_expedition_member_line(i, p):
     return "{}. [{}](tg://user?id={}) {}\n".format(i,
                                                    escape_for_markdown(p.tg_handle),
@@ -28,27 +69,36 @@ def render_expedition_member_line(i, p):
                                                    escape_for_markdown(p.label if p.label is not None else ""))
 
 
+@profiler.phase("render")
 def render_expedition_reminder(expedition):
-    msg = "Expedition Reminder\n"
-    msg += render_expedition(expedition)
-    msg += "Ready (👥 {})\n".format(len(expedition.ready))
-    for i, p in enumerate(expedition.ready):
-        msg += render_expedition_member_line(i + 1, p)
-    return msg + "\n"
+    return render_cache.get("reminder", expedition, _render_expedition_reminder)
 
 
+def _render_expedition_reminder(expedition):
+    lines = ["Expedition Reminder\n", render_expedition(expedition), "Ready (👥 {})\n".format(len(expedition.ready))]
+    lines.extend(render_expedition_member_line(i + 1, p) for i, p in enumerate(expedition.ready))
+    lines.append("\n")
+    return "".join(lines)
+
+
+@profiler.phase("render")
 def render_expedition(expedition):
-    msg = "⚔️ {}    🕑 {}    👥 {}\n".format(escape_for_markdown(expedition.title),
-                                             render_human_time(expedition.get_time()),
-                                             len(expedition.members),
-                                             )
+    return render_cache.get("expedition", expedition, _render_expedition)
+
+
+def _render_expedition(expedition):
+    lines = ["⚔️ {}    🕑 {}    👥 {}\n".format(escape_for_markdown(expedition.title),
+                                                render_human_time(expedition.get_time()),
+                                                len(expedition.members),
+                                                )]
     if len(expedition.description) > 0:
-        msg += "📋 {}\n".format(escape_for_markdown(expedition.description))
-    for i, member in enumerate(expedition.members):
-        msg += render_expedition_member_line(i + 1, member)
-    return msg + "\n"
+        lines.append("📋 {}\n".format(escape_for_markdown(expedition.description)))
+    lines.extend(render_expedition_member_line(i + 1, member) for i, member in enumerate(expedition.members))
+    lines.append("\n")
+    return "".join(lines)
 
 
+@profiler.phase("render")
 def render_expedition_detail(expedition):
     msg = render_expedition(expedition)
     msg += "\nDaily sign ups:\n"
@@ -58,7 +108,7 @@ def render_expedition_detail(expedition):
 
 
 def sort_expeditions(expeds, daily_reset_time=0):
-    return sorted(expeds, key=lambda x: utils.time_shifted_back_hours(x.get_time(), daily_reset_time))
+    return sorted(expeds, key=lambda x: x.minutes_since_reset(daily_reset_time))
 
 
 def filter_expeditions(expeds, daily_reset_time=0):
@@ -66,63 +116,71 @@ def filter_expeditions(expeds, daily_reset_time=0):
     if 0 <= now.time().hour - daily_reset_time <= 2:  # if current time is within 2 hours after daily reset time, dont filter
         return expeds
     two_h_before = (now - dt.timedelta(hours=2)).time()
-    offset = daily_reset_time
-    expeds = [e for e in expeds if
-              utils.time_shifted_back_hours(e.get_time(), offset) > utils.time_shifted_back_hours(two_h_before, offset)]
+    cutoff = utils.minutes_since_reset(two_h_before, daily_reset_time)
+    expeds = [e for e in expeds if e.minutes_since_reset(daily_reset_time) > cutoff]
     return expeds
 
 
+@profiler.phase("render")
 def render_expeditions(expeds, guild_reset_time=0, sort=True, filter=True):
-    msg = ""
+    return "".join(_expedition_blocks(expeds, guild_reset_time, sort, filter))
+
+
+def _expedition_blocks(expeds, guild_reset_time=0, sort=True, filter=True):
     if sort:
         expeds = sort_expeditions(expeds, guild_reset_time)
     if filter:
         expeds = filter_expeditions(expeds, guild_reset_time)
-    for e in expeds:
-        msg += render_expedition(e)
-    if len(expeds) is 0:
-        msg += "No expeditions"
-    return msg
+    if len(expeds) == 0:
+        return ["No expeditions"]
+    return [render_expedition(e) for e in expeds]
 
 
+@profiler.phase("render")
 def render_guild_admin(guild):
     current_day = utils.get_singapore_time_now().date()
     expeds = list(guild.expeditions.values())
-    guild_msg = "Guild Admin {}/{}\n\n".format(current_day.month, current_day.day)
-    guild_msg += render_expeditions(expeds, guild_reset_time=guild.daily_reset_time)
-    guild_msg += "\n"
-    guild_msg += render_adv_text()
-    return guild_msg
+    lines = ["Guild Admin {}/{}\n\n".format(current_day.month, current_day.day)]
+    lines.extend(_expedition_blocks(expeds, guild_reset_time=guild.daily_reset_time))
+    lines.append("\n")
+    lines.append(ADV_TEXT)
+    return "".join(lines)
 
 
+@profiler.phase("render")
 def render_poll_markup(guild):
     markup = types.InlineKeyboardMarkup()
     expeds = list(guild.expeditions.values())
     expeds = sort_expeditions(expeds, guild.daily_reset_time)
     expeds = filter_expeditions(expeds, guild.daily_reset_time)
     for e in expeds:
-        markup.add(types.InlineKeyboardButton("Join {} ({})".format(e.title, render_human_time(e.get_time())),
-                                              callback_data="/exped reg {}".format(e.title)))
+        markup.add(render_cache.get("join_button", e, _render_join_button))
     # Render fort attendance poll
     # fort_mark_button = types.InlineKeyboardButton("Went fort today",
-    #                                               callback_data="/fort mark")
+    #                                               callback_data=router.callback_data("fort", "mark"))
     # fort_check_button = types.InlineKeyboardButton("My fort count",
-    #                                                callback_data="/fort check")
+    #                                                callback_data=router.callback_data("fort", "check"))
     # markup.row(fort_mark_button, fort_check_button)
     return markup
 
 
+def _render_join_button(e):
+    return types.InlineKeyboardButton("Join {} ({})".format(e.title, render_human_time(e.get_time())),
+                                      callback_data=router.callback_data("exped", "reg", e.callback_title()))
+
+
 def render_ready_markup(e):
     ready_markup = types.InlineKeyboardMarkup()
     ready_markup.add(
         types.InlineKeyboardButton(
             "Im ready!",
-            callback_data="/exped ready {}".format(e.title)
+            callback_data=router.callback_data("exped", "ready", e.callback_title())
         )
     )
     return ready_markup
 
 
+@functools.lru_cache(maxsize=24 * 60)
 def render_human_time(time_obj):
     if time_obj.minute > 0:
         return time_obj.strftime("%I.%M%p").lstrip("0").lower()
@@ -130,6 +188,7 @@ def render_human_time(time_obj):
         return time_obj.strftime("%I%p").lstrip("0").lower()
 
 
+@profiler.phase("render")
 def render_fort_roster(roster):
     def get_name(p):
         return escape_for_markdown(p["telegram"] if p["telegram"] != "" else p["name"])
@@ -156,7 +215,7 @@ def render_fort_roster_markup():
     markup.add(
         types.InlineKeyboardButton(
             "I can't today.",
-            callback_data="/fort reassign"
+            callback_data=router.callback_data("fort", "reassign")
         )
     )
     return markup
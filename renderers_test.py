@@ -0,0 +1,67 @@
+import datetime as dt
+import unittest
+from unittest import mock
+
+import renderers
+from models import *
+from renderers import *
+
+
+class TestRenderCache(unittest.TestCase):
+    def test_follows_mutations(self):
+        g = Guild(title="guild1", chat_id=1)
+        e = g.new_expedition("team1", "1300", "desc")
+        text = render_expeditions([e], filter=False)
+        self.assertEqual(text, "⚔️ team1    🕑 1pm    👥 0\n📋 desc\n\n")
+
+        misses = render_cache.misses
+        self.assertEqual(render_expeditions([e], filter=False), text)
+        self.assertEqual(render_cache.misses, misses)
+
+        g.checkin_expedition("team1", "id1", "han_1")
+        self.assertEqual(render_expeditions([e], filter=False),
+                         "⚔️ team1    🕑 1pm    👥 1\n📋 desc\n1. [han\\_1](tg://user?id=id1) \n\n")
+        g.set_expedition_time("team1", "1330")
+        self.assertIn("🕑 1.30pm", render_expedition(e))
+        g.ready_expedition("team1", "id1", "han_1")
+        self.assertTrue(render_expedition_reminder(e).endswith("Ready (👥 1)\n1. [han\\_1](tg://user?id=id1) \n\n"))
+
+    def test_only_changed_blocks_rendered(self):
+        g = Guild(title="guild1", chat_id=1)
+        g.new_expedition("team1", "1300")
+        g.new_expedition("team2", "1400")
+        expeds = list(g.expeditions.values())
+        render_expeditions(expeds, filter=False)
+        misses = render_cache.misses
+        g.checkin_expedition("team2", "id1", "han1")
+        render_expeditions(expeds, filter=False)
+        self.assertEqual(render_cache.misses, misses + 1)
+
+    def test_poll_markup(self):
+        g = Guild(title="guild1", chat_id=1)
+        g.new_expedition("team1", "1300")
+        g.set_expedition_title("team1", "team2")
+        e = g.get_expedition("team2")
+        # Expeditions long past are filtered out depending on the time of day
+        with mock.patch("utils.get_singapore_time_now", return_value=dt.datetime(2020, 1, 1, 12, 0)):
+            markup = render_poll_markup(g)
+        self.assertEqual(len(markup.keyboard), 1)
+        self.assertEqual(markup.keyboard[0][0]["callback_data"], "r team2")
+        button = render_cache.get("join_button", e, renderers._render_join_button)
+        self.assertEqual(button.text, "Join team2 (1pm)")
+        self.assertIs(render_cache.get("join_button", e, None), button)
+
+    def test_legacy_long_title(self):
+        g = Guild(title="guild1", chat_id=1)
+        title = "t" * 70  # Stored before titles were limited
+        g.expeditions[title] = Expedition(title, "1300")
+        with mock.patch("utils.get_singapore_time_now", return_value=dt.datetime(2020, 1, 1, 12, 0)):
+            markup = render_poll_markup(g)
+        self.assertEqual(markup.keyboard[0][0]["callback_data"], "r " + "t" * 62)
+        ready = render_ready_markup(g.get_expedition(title))
+        self.assertEqual(ready.keyboard[0][0]["callback_data"], "y " + "t" * 62)
+        self.assertIs(g.get_expedition("t" * 62), g.get_expedition(title))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+from collections import OrderedDict, namedtuple
+
+from custom_errors import WrongCommandError
+
+# Buttons call commands with callback_data "<code> <arguments>" instead of the command text, Telegram
+# only allows 64 bytes of callback_data. Codes are part of every button already sent, never reuse one.
+CALLBACK_CODES = OrderedDict([
+    (("exped", "reg"), "r"),
+    (("exped", "ready"), "y"),
+    (("fort", "mark"), "m"),
+    (("fort", "check"), "c"),
+    (("fort", "reassign"), "a"),
+])
+CALLBACK_DATA_LIMIT = 64
+
+REQUIRED = object()
+
+
+def callback_data(group, name, *args):
+    """Compact callback_data calling `/<group> <name> <args...>`."""
+    data = " ".join([CALLBACK_CODES[(group, name)]] + [str(a) for a in args])
+    if len(data.encode("utf-8")) > CALLBACK_DATA_LIMIT:
+        raise ValueError("callback_data of {}.{} is over {} bytes: {}".format(group, name, CALLBACK_DATA_LIMIT, data))
+    return data
+
+
+class Arg:
+    """One positional argument. `rest` takes the remaining text, spaces included, so it must come last."""
+
+    def __init__(self, name, type=str, default=REQUIRED, rest=False):
+        self.name = name
+        self.type = type
+        self.default = default
+        self.rest = rest
+
+
+class Command:
+    def __init__(self, group, name, handler, args, doc, text, callback):
+        self.group = group
+        self.name = name
+        self.key = "{}.{}".format(group, name)
+        self.handler = handler  # called with (message, args)
+        self.args = args
+        self.doc = doc
+        self.text = text  # can be typed as a command
+        self.callback = callback  # can be called from a button
+        self.required = sum(1 for a in args if a.default is REQUIRED)
+        self.maxsplit = len(args) - 1 if len(args) > 0 and args[-1].rest else -1
+        self.Args = namedtuple("Args", [a.name for a in args])
+
+    def parse(self, argtext):
+        """Returns the typed Args of the text after the command name, or raises WrongCommandError."""
+        tokens = [] if argtext is None else argtext.split(' ', self.maxsplit)
+        if not self.required <= len(tokens) <= len(self.args):
+            raise WrongCommandError(self.doc)
+        values = []
+        for i, arg in enumerate(self.args):
+            if i >= len(tokens):
+                values.append(arg.default)
+                continue
+            try:
+                values.append(arg.type(tokens[i]))
+            except ValueError:
+                raise WrongCommandError(self.doc)
+        return self.Args(*values)
+
+
+class Route(namedtuple("Route", ["group", "command", "argtext"])):
+    """A message or callback matched to a command, or to None if its group has no such command."""
+
+    @property
+    def key(self):
+        return self.command.key if self.command is not None else "{}.unknown".format(self.group)
+
+
+class Router:
+    """Registry of /<group> <name> commands, each declaring its arguments once."""
+
+    def __init__(self):
+        self.groups = OrderedDict()  # group -> {name: Command}
+        self.callbacks = {}  # callback code -> Command
+        self.usages = {}
+
+    def command(self, group, name, args=(), doc="", text=True, callback=False):
+        """Decorator registering handler(message, args) as /<group> <name>, the Command is set as handler.command."""
+        def register(handler):
+            c = Command(group, name, handler, list(args), doc, text, callback)
+            self.groups.setdefault(group, OrderedDict())[name] = c
+            if callback:
+                self.callbacks[CALLBACK_CODES[(group, name)]] = c
+            self.usages.pop(group, None)
+            handler.command = c
+            return handler
+        return register
+
+    def usage(self, group):
+        if group not in self.usages:
+            self.usages[group] = """
+/{} command [arguments...]
+Available commands are : {}
+    """.format(group, [name for name, c in self.groups.get(group, {}).items() if c.text])
+        return self.usages[group]
+
+    def __route(self, text):
+        parts = (text or "").split(' ', 2)
+        group = parts[0].lstrip("/").split("@")[0]
+        command = self.groups.get(group, {}).get(parts[1]) if len(parts) >= 2 else None
+        return Route(group, command, parts[2] if len(parts) == 3 else None)
+
+    def match(self, text):
+        """Routes command text like "/exped reg team1" or "/exped@bot reg team1"."""
+        route = self.__route(text)
+        if route.command is not None and not route.command.text:
+            return route._replace(command=None)
+        return route
+
+    def decode(self, data):
+        """Routes callback_data made by callback_data(), or the command text older buttons carry."""
+        if data.startswith("/"):
+            route = self.__route(data)
+        else:
+            parts = data.split(' ', 1)
+            command = self.callbacks.get(parts[0])
+            route = Route(command.group if command is not None else "callback", command,
+                          parts[1] if len(parts) == 2 else None)
+        if route.command is not None and not route.command.callback:
+            return route._replace(command=None)
+        return route
@@ -0,0 +1,67 @@
+import unittest
+
+import router
+from custom_errors import WrongCommandError
+from router import Arg, Router
+
+
+class TestRouter(unittest.TestCase):
+    def setUp(self):
+        self.router = Router()
+
+        @self.router.command("exped", "new", [Arg("title"), Arg("time"), Arg("description", default="", rest=True)],
+                             doc="new doc")
+        def new(message, args):
+            return args
+
+        @self.router.command("exped", "reg", [Arg("title"), Arg("label", default="")], callback=True, doc="reg doc")
+        def reg(message, args):
+            return args
+
+        @self.router.command("exped", "ready", [Arg("title")], text=False, callback=True)
+        def ready(message, args):
+            return args
+
+        @self.router.command("fort", "count", [Arg("n", type=int)], doc="count doc")
+        def count(message, args):
+            return args
+
+    def parse(self, route):
+        return route.command.parse(route.argtext)
+
+    def test_text(self):
+        route = self.router.match("/exped@ascentbot new team1 1500 meet at the gate")
+        self.assertEqual(route.key, "exped.new")
+        args = self.parse(route)
+        self.assertEqual((args.title, args.time, args.description), ("team1", "1500", "meet at the gate"))
+        self.assertEqual(self.parse(self.router.match("/exped new team1 1500")).description, "")
+        self.assertEqual(self.parse(self.router.match("/exped reg team1")), ("team1", ""))
+        self.assertEqual(self.parse(self.router.match("/fort count 3")).n, 3)
+
+    def test_wrong_arguments(self):
+        for text, doc in [("/exped new team1", "new doc"), ("/exped reg a b c", "reg doc"), ("/fort count x", "count doc")]:
+            with self.assertRaises(WrongCommandError) as e:
+                self.parse(self.router.match(text))
+            self.assertIn(doc, e.exception.message)
+
+    def test_unknown(self):
+        self.assertEqual(self.router.match("/exped nope").key, "exped.unknown")
+        self.assertIsNone(self.router.match("/exped").command)
+        self.assertIsNone(self.router.match("/exped ready team1").command)  # Only a button calls it
+        self.assertIn("['new', 'reg']", self.router.usage("exped"))
+
+    def test_callbacks(self):
+        data = router.callback_data("exped", "reg", "team1")
+        self.assertEqual(data, "r team1")
+        self.assertEqual(self.parse(self.router.decode(data)), ("team1", ""))
+        self.assertEqual(self.parse(self.router.decode("y team1")).title, "team1")
+        # Buttons sent before compact callback_data carry the command text
+        self.assertEqual(self.parse(self.router.decode("/exped reg team1 alt")), ("team1", "alt"))
+        self.assertIsNone(self.router.decode("/exped new team1 1500").command)
+        self.assertIsNone(self.router.decode("zz").command)
+        with self.assertRaises(ValueError):
+            router.callback_data("exped", "reg", "x" * 64)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,390 @@
+import abc
+import asyncio
+import datetime as dt
+import functools
+import heapq
+import logging
+import os
+import threading
+from collections import OrderedDict, deque
+
+import metrics
+import utils
+from custom_errors import GuildError
+
+
+class DeadlineScheduler(abc.ABC):
+    """Min-heap of (fire_at, key) entries drained by a worker that sleeps until the earliest one is due.
+
+    Every key has at most one valid entry. Pushing a key again or cancelling it bumps its version,
+    and entries with an old version are dropped when they come up instead of being searched for.
+    """
+
+    def __init__(self, clock=utils.get_singapore_time_now):
+        self.clock = clock
+        self.heap = []  # (fire_at, seq, key, version)
+        self.versions = {}  # key -> version of its only valid heap entry
+        self.seq = 0
+        self.cond = threading.Condition()
+        self.wakeup = None  # set by run_async to wake the event loop from other threads
+
+    def push(self, key, fire_at):
+        with self.cond:
+            version = self.versions.get(key, 0) + 1
+            self.versions[key] = version
+            self.seq += 1
+            heapq.heappush(self.heap, (fire_at, self.seq, key, version))
+            self.cond.notify()
+        if self.wakeup is not None:
+            self.wakeup()
+
+    def cancel(self, key):
+        with self.cond:
+            self.versions.pop(key, None)
+
+    def pending(self):
+        with self.cond:
+            return sum(1 for entry in self.heap if self.versions.get(entry[2]) == entry[3])
+
+    def run(self):
+        while True:
+            with self.cond:
+                now = self.clock()
+                while len(self.heap) == 0 or self.heap[0][0] > now:
+                    timeout = None if len(self.heap) == 0 else (self.heap[0][0] - now).total_seconds()
+                    self.cond.wait(timeout)
+                    now = self.clock()
+            self.run_due(now)
+
+    async def run_async(self, executor=None):
+        """Same as run as an asyncio task, due entries are fired in executor as they may block."""
+        loop = asyncio.get_event_loop()
+        wake = asyncio.Event()
+        self.wakeup = lambda: loop.call_soon_threadsafe(wake.set)
+        while True:
+            wake.clear()
+            with self.cond:
+                now = self.clock()
+                timeout = None if len(self.heap) == 0 else (self.heap[0][0] - now).total_seconds()
+            if timeout is None or timeout > 0:
+                try:
+                    await asyncio.wait_for(wake.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await loop.run_in_executor(executor, self.run_due, now)
+
+    def run_due(self, now):
+        while True:
+            with self.cond:
+                if len(self.heap) == 0 or self.heap[0][0] > now:
+                    return
+                fire_at, _, key, version = heapq.heappop(self.heap)
+                if self.versions.get(key) != version:
+                    continue  # Rescheduled or cancelled since
+                del self.versions[key]
+            metrics.scheduler_lag.observe((now - fire_at).total_seconds(), type(self).__name__)
+            try:
+                self.fire(key, fire_at, now)
+            except Exception as e:
+                logging.exception(e)
+
+    @abc.abstractmethod
+    def fire(self, key, fire_at, now):
+        """Runs the entry of key that was due at fire_at, now is the time it is run."""
+
+
+class ReminderScheduler(DeadlineScheduler):
+    """Fires a reminder `lead` before every expedition of every active guild.
+
+    Guild mutations push new entries as they happen, so the worker never scans all expeditions.
+    Reminders are prepared `ahead` of their target and handed to remind together, taking turns
+    between guilds, so popular times are sent out fairly once the target comes. How late each one
+    was sent is kept in `lateness`.
+    """
+
+    def __init__(self, guilds, remind, lead=dt.timedelta(minutes=2), grace=dt.timedelta(minutes=1),
+                 ahead=dt.timedelta(seconds=10), clock=utils.get_singapore_time_now):
+        super().__init__(clock)
+        self.guilds = guilds
+        self.remind = remind  # called with (guild, expedition, seconds until the target), may return an OutboundTask
+        self.lead = lead
+        self.grace = grace  # reminders later than this are skipped instead of sent late
+        self.ahead = ahead
+        self.batch = []
+        self.lateness = deque(maxlen=1000)  # (chat_id, title, target, seconds late or None if it failed)
+
+    def watch(self):
+        """Schedules every active guild from the guilds index and keeps the heap updated from guild mutations.
+        Guilds are only hydrated when one of their reminders comes due."""
+        self.guilds.listeners.add(self.on_change)
+        now = self.clock()
+        for chat_id, entry in self.guilds.active_index():
+            for slug, time in entry["expeditions"].items():
+                self.push((chat_id, slug), self.next_fire(dt.datetime.strptime(time, "%H%M").time(), now))
+
+    def unwatch(self):
+        self.guilds.listeners.remove(self.on_change)
+
+    def on_change(self, guild, op, args):
+        if op in ["new_expedition", "set_expedition_time"]:
+            self.schedule(guild.chat_id, guild.get_expedition(args[0]))
+        elif op == "set_expedition_title":
+            self.unschedule(guild.chat_id, args[0])
+            self.schedule(guild.chat_id, guild.get_expedition(args[1]))
+        elif op == "delete_expedition":
+            self.unschedule(guild.chat_id, args[0])
+        elif op == "start" or (op == "set" and not guild.stopped):
+            self.schedule_guild(guild)
+
+    def schedule_guild(self, guild):
+        for e in list(guild.expeditions.values()):
+            self.schedule(guild.chat_id, e)
+
+    def next_fire(self, t, now):
+        fire_at = now.replace(hour=t.hour, minute=t.minute, second=0, microsecond=0) - self.lead - self.ahead
+        while fire_at <= now:
+            fire_at += dt.timedelta(days=1)
+        return fire_at
+
+    def schedule(self, chat_id, expedition, now=None):
+        self.push((chat_id, expedition.title.lower()), self.next_fire(expedition.get_time(), now or self.clock()))
+
+    def unschedule(self, chat_id, title):
+        self.cancel((chat_id, title.lower()))
+
+    def fire(self, key, fire_at, now):
+        chat_id, slug = key
+        try:
+            guild = self.guilds.get(chat_id, record_use=False)
+            e = guild.get_expedition(slug)
+        except GuildError:
+            return  # Stopped or removed, a later start or new_expedition schedules it again
+        self.schedule(chat_id, e, now)  # Same time tomorrow
+        if now - fire_at > self.grace:
+            logging.warning("Skipped reminder for {} in {}, {} late".format(slug, chat_id, now - fire_at))
+            return
+        with self.cond:
+            self.batch.append((guild, e, fire_at + self.ahead))
+
+    def run_due(self, now):
+        super().run_due(now)
+        with self.cond:
+            batch, self.batch = self.batch, []
+        for guild, e, target in self.fan_out(batch):
+            # One reminder failing must not stop the others, nor the worker that sends them
+            try:
+                task = self.remind(guild, e, max((target - now).total_seconds(), 0))
+            except Exception as ex:
+                logging.exception(ex)
+                self.lateness.append((guild.chat_id, e.title, target, None))
+                continue
+            if task is not None:
+                task.add_done_callback(functools.partial(self.sent, guild.chat_id, e.title, target))
+
+    @staticmethod
+    def fan_out(batch):
+        """Orders reminders so that guilds take turns, one reminder each."""
+        by_chat = OrderedDict()
+        for entry in batch:
+            by_chat.setdefault(entry[0].chat_id, deque()).append(entry)
+        ordered = []
+        while len(by_chat) > 0:
+            for chat_id in list(by_chat):
+                ordered.append(by_chat[chat_id].popleft())
+                if len(by_chat[chat_id]) == 0:
+                    del by_chat[chat_id]
+        return ordered
+
+    def sent(self, chat_id, title, target, task):
+        late = None if type(task.result) is tuple else (self.clock() - target).total_seconds()
+        self.lateness.append((chat_id, title, target, late))
+
+    def stats(self):
+        """Lateness of the reminders sent recently, in seconds."""
+        late = sorted(entry[3] for entry in list(self.lateness) if entry[3] is not None)
+        if len(late) == 0:
+            return {"sent": 0, "failed": len(self.lateness)}
+        return {"sent": len(late), "failed": len(self.lateness) - len(late),
+                "p50": late[len(late) // 2], "p99": late[min(len(late) - 1, len(late) * 99 // 100)],
+                "max": late[-1], "skew": late[-1] - late[0]}
+
+
+class ResetScheduler(DeadlineScheduler):
+    """Runs the daily reset of every active guild at its own daily_reset_time o'clock.
+
+    The day of the last reset is stored on the guild, so a reset runs exactly once per day even
+    across restarts, and one missed while the bot was down runs as soon as it starts again.
+    """
+
+    def __init__(self, guilds, on_reset, clock=utils.get_singapore_time_now):
+        super().__init__(clock)
+        self.guilds = guilds
+        self.on_reset = on_reset  # called with the guild after it was reset
+
+    def watch(self):
+        """Schedules every active guild from the guilds index, without hydrating them."""
+        self.guilds.listeners.add(self.on_change)
+        now = self.clock()
+        for chat_id, entry in self.guilds.active_index():
+            self.schedule(chat_id, entry["daily_reset_time"], entry["last_reset"], now)
+
+    def unwatch(self):
+        self.guilds.listeners.remove(self.on_change)
+
+    def on_change(self, guild, op, args):
+        if op in ["set_reset_time", "start"] or (op == "set" and not guild.stopped):
+            self.schedule(guild.chat_id, guild.daily_reset_time, guild.last_reset)
+
+    @staticmethod
+    def last_boundary(daily_reset_time, now):
+        boundary = now.replace(hour=daily_reset_time, minute=0, second=0, microsecond=0)
+        if boundary > now:
+            boundary -= dt.timedelta(days=1)
+        return boundary
+
+    def schedule(self, chat_id, daily_reset_time, last_reset, now=None):
+        now = now or self.clock()
+        boundary = self.last_boundary(daily_reset_time, now)
+        if last_reset is not None and last_reset < boundary.date().isoformat():
+            fire_at = now  # Missed while the bot was down
+        else:
+            fire_at = boundary + dt.timedelta(days=1)
+        self.push(chat_id, fire_at)
+
+    def fire(self, chat_id, fire_at, now):
+        try:
+            # Counts as a use so the guild is not evicted while it is reset, once a day does not keep it resident
+            guild = self.guilds.get(chat_id)
+        except GuildError:
+            return  # Stopped or removed, start schedules it again
+        day = self.last_boundary(guild.daily_reset_time, now).date().isoformat()
+        if guild.last_reset == day:
+            self.schedule(chat_id, guild.daily_reset_time, guild.last_reset, now)
+            return
+        guild.daily_reset(day)
+        # Rescheduled before on_reset, a failure to announce the reset must not drop the guild from the heap
+        self.schedule(chat_id, guild.daily_reset_time, guild.last_reset, now)
+        try:
+            self.on_reset(guild)
+        except Exception as e:
+            logging.exception(e)
+
+
+class PinnedEditCoalescer(DeadlineScheduler):
+    """Edits the pinned message of a guild at most once per window, with whatever state it has by then.
+
+    The first update after a quiet window goes out right away, later ones within the window are
+    folded into a single edit at its end. An edit is skipped when the rendered text and markup are
+    the same as the last ones sent for that message.
+    """
+
+    def __init__(self, guilds, render, edit, window=dt.timedelta(seconds=1), clock=utils.get_singapore_time_now):
+        super().__init__(clock)
+        self.guilds = guilds
+        self.render = render  # called with the guild, returns (text, reply_markup)
+        self.edit = edit  # called with (guild, text, reply_markup), returns the OutboundTask of the edit
+        self.window = window
+        self.last_edit = {}  # chat_id -> time of the last edit
+        self.sent = {}  # chat_id -> (pinned_message_id, hash of text and markup) of the last successful edit
+        self.skipped = 0
+
+    def request(self, chat_id):
+        with self.cond:
+            if chat_id in self.versions:
+                return  # Already due, it renders the latest state when it fires
+            now = self.clock()
+            last = self.last_edit.get(chat_id)
+            self.push(chat_id, now if last is None else max(now, last + self.window))
+
+    def fire(self, chat_id, fire_at, now):
+        try:
+            guild = self.guilds.get(chat_id, record_use=False)
+        except GuildError:
+            return
+        if guild.pinned_message_id is None:
+            return
+        self.last_edit[chat_id] = now
+        text, markup = self.render(guild)
+        sent = (guild.pinned_message_id, hash((text, None if markup is None else markup.to_json())))
+        if self.sent.get(chat_id) == sent:
+            self.skipped += 1
+            return
+        # Recorded once the edit went through, a failed one is sent again with the next update
+        self.edit(guild, text, markup).add_done_callback(functools.partial(self.edited, chat_id, sent))
+
+    def edited(self, chat_id, sent, task):
+        if type(task.result) is not tuple:
+            with self.cond:
+                self.sent[chat_id] = sent
+
+
+class DeletionScheduler(DeadlineScheduler):
+    """Deletes messages a delay after they were scheduled, from a single worker.
+
+    Deletions that come due together are handed to delete in one batch. Pending deletions are saved
+    as they change, at most once per save_interval, and loaded again on start, overdue ones are
+    deleted right away.
+    """
+    savefile = "deletions.{}.json".format(os.getenv("MODE", "dev"))
+    SAVE = "save"  # key of the coalesced save, kept in the heap next to the deletions
+
+    def __init__(self, storage, delete, delay=dt.timedelta(seconds=5), save_interval=dt.timedelta(seconds=1),
+                 clock=utils.get_singapore_time_now):
+        super().__init__(clock)
+        self.storage = storage
+        self.delete = delete  # called with [(chat_id, message_id)] of the messages due
+        self.delay = delay
+        self.save_interval = save_interval
+        self.batch = []
+        self.save_due = False
+
+    def schedule(self, chat_id, message_id, now=None):
+        now = now or self.clock()
+        self.push((chat_id, message_id), now + self.delay)
+        self.request_save(now)
+
+    def request_save(self, now=None):
+        """Saves pending deletions save_interval from now, later requests until then share that save."""
+        if self.save_interval <= dt.timedelta(0):
+            return self.save()
+        with self.cond:
+            if self.SAVE not in self.versions:
+                self.push(self.SAVE, (now or self.clock()) + self.save_interval)
+
+    def pending(self):
+        with self.cond:
+            return super().pending() - (self.SAVE in self.versions)
+
+    def run_due(self, now):
+        super().run_due(now)
+        with self.cond:
+            batch, self.batch = self.batch, []
+            save_due, self.save_due = self.save_due, False
+        try:
+            if len(batch) > 0:
+                self.delete(batch)
+            if save_due:
+                self.save()
+            elif len(batch) > 0:
+                self.request_save(now)
+        except Exception as e:
+            logging.exception(e)
+
+    def fire(self, key, fire_at, now):
+        with self.cond:
+            if key == self.SAVE:
+                self.save_due = True
+            else:
+                self.batch.append(key)
+
+    def save(self):
+        with self.cond:
+            entries = [[key[0], key[1], fire_at.isoformat()]
+                       for fire_at, _, key, version in sorted(self.heap)
+                       if key != self.SAVE and self.versions.get(key) == version]
+        self.storage.savefile(entries, self.savefile, "json")
+
+    def load(self):
+        for chat_id, message_id, fire_at in self.storage.loadfile(self.savefile, "json") or []:
+            self.push((chat_id, message_id), dt.datetime.fromisoformat(fire_at))
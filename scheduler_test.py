@@ -0,0 +1,390 @@
+import datetime as dt
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import database
+from models import *
+from outbound import OutboundTask
+from scheduler import DeletionScheduler, PinnedEditCoalescer, ReminderScheduler, ResetScheduler
+
+
+class TestReminderScheduler(unittest.TestCase):
+    def setUp(self):
+        self.now = dt.datetime(2020, 1, 1, 12, 0)
+        self.sent = []
+        self.guilds = Guilds(storage=database.Storage(storage_type="local"))
+        self.guilds.set(1, Guild(title="guild1", chat_id=1))
+        self.scheduler = ReminderScheduler(self.guilds, lambda g, e, delay: self.sent.append((g.chat_id, e.title)),
+                                           clock=lambda: self.now)
+        self.scheduler.watch()
+
+    def tearDown(self):
+        self.scheduler.unwatch()
+
+    def run_at(self, hour, minute):
+        self.now = self.now.replace(hour=hour, minute=minute)
+        self.scheduler.run_due(self.now)
+
+    def test_fires_once_before_expedition(self):
+        g = self.guilds.get(1)
+        g.new_expedition("team1", "1300")
+        self.run_at(12, 57)
+        self.assertEqual(self.sent, [])
+        self.run_at(12, 58)
+        self.run_at(12, 59)
+        self.assertEqual(self.sent, [(1, "team1")])
+        self.assertEqual(self.scheduler.pending(), 1)  # Rescheduled for tomorrow
+
+    def test_follows_changes(self):
+        g = self.guilds.get(1)
+        g.new_expedition("team1", "1300")
+        g.new_expedition("team2", "1300")
+        g.set_expedition_time("team1", "1400")
+        g.set_expedition_title("team2", "team3")
+        g.new_expedition("team4", "1300")
+        g.delete_expedition("team4")
+        self.run_at(12, 58)
+        self.assertEqual(self.sent, [(1, "team3")])
+        self.run_at(13, 58)
+        self.assertEqual(self.sent, [(1, "team3"), (1, "team1")])
+
+    def test_failing_reminder_does_not_stop_others(self):
+        def remind(g, e, delay):
+            if e.title == "team1":
+                raise ValueError("callback_data too long")
+            self.sent.append((g.chat_id, e.title))
+        self.scheduler.remind = remind
+        g = self.guilds.get(1)
+        g.new_expedition("team1", "1300")
+        g.new_expedition("team2", "1300")
+        with self.assertLogs(level="ERROR"):
+            self.run_at(12, 58)
+        self.assertEqual(self.sent, [(1, "team2")])
+        self.assertEqual(self.scheduler.pending(), 2)
+
+    def test_skips_stopped_guilds(self):
+        g = self.guilds.get(1)
+        g.new_expedition("team1", "1300")
+        g.stop()
+        self.run_at(12, 58)
+        self.assertEqual(self.sent, [])
+        self.assertEqual(self.scheduler.pending(), 0)
+        g.start()
+        self.assertEqual(self.scheduler.pending(), 1)
+
+    def test_does_not_keep_guilds_resident(self):
+        storage = database.Storage(storage_type="local")
+        with mock.patch.multiple(Guilds, sharddir=os.path.join(tempfile.mkdtemp(), "guilds/"), persistence="sharded",
+                                 max_resident=1, evict_after=600), mock.patch("models.time") as clock:
+            clock.monotonic.return_value = 0
+            gs = Guilds(storage=storage)
+            gs.set(1, Guild(title="guild1", chat_id=1))
+            gs.set(2, Guild(title="guild2", chat_id=2))
+            gs.get(1).new_expedition("team1", "1300")
+            gs.save()
+            gs = Guilds.load(storage)
+            self.scheduler.unwatch()
+            self.scheduler.guilds = gs
+            self.scheduler.watch()
+            gs.get(1)  # Used by a command
+
+            # Reminders read the guild long after it was last used by a command
+            clock.monotonic.return_value = 700
+            self.run_at(12, 58)
+            self.assertEqual(self.sent, [(1, "team1")])
+            gs.get(2)
+            self.assertEqual(list(gs.guilds), [2])
+
+    def test_watch_does_not_hydrate(self):
+        g = self.guilds.get(1)
+        g.new_expedition("team1", "1300")
+        g.new_expedition("team2", "1400")
+        self.guilds.set(2, Guild(title="guild2", chat_id=2))
+        self.guilds.get(2).new_expedition("team3", "1300")
+        self.guilds.get(2).stop()
+        with mock.patch.object(Guilds, "savefile", os.path.join(tempfile.mkdtemp(), "guilds.json")):
+            self.guilds.save()
+            gs = Guilds.load(self.guilds.storage)
+        scheduler = ReminderScheduler(gs, lambda g, e, delay: self.sent.append((g.chat_id, e.title)),
+                                      clock=lambda: self.now)
+        scheduler.watch()
+        self.assertEqual(sorted(gs.unhydrated), [1, 2])
+        self.assertEqual(len(gs.guilds), 0)
+        self.assertEqual(scheduler.pending(), 2)  # Stopped guild 2 is not scheduled
+
+        self.now = self.now.replace(hour=12, minute=58)
+        scheduler.run_due(self.now)
+        self.assertEqual(self.sent, [(1, "team1")])
+        self.assertEqual(list(gs.guilds), [1])
+
+        # Listeners belong to their Guilds, mutations of self.guilds do not reach this scheduler
+        self.guilds.get(1).new_expedition("team4", "1500")
+        self.assertEqual(scheduler.pending(), 2)
+        gs.get(1).new_expedition("team4", "1500")
+        self.assertEqual(scheduler.pending(), 3)
+        scheduler.unwatch()
+
+    def test_fan_out(self):
+        tasks = []
+
+        def remind(g, e, delay):
+            self.sent.append((g.chat_id, e.title, delay))
+            tasks.append(OutboundTask(0, len(tasks), g.chat_id, "send_message", (), {}))
+            return tasks[-1]
+
+        self.scheduler.remind = remind
+        self.guilds.set(2, Guild(title="guild2", chat_id=2))
+        for chat_id, title in [(1, "team1"), (1, "team2"), (1, "team3"), (2, "team4")]:
+            self.guilds.get(chat_id).new_expedition(title, "2100")
+        self.now = dt.datetime(2020, 1, 1, 20, 57, 55)
+        self.scheduler.run_due(self.now)
+        # Prepared ahead to go out at 20:58, guilds taking turns
+        self.assertEqual(self.sent, [(1, "team1", 5), (2, "team4", 5), (1, "team2", 5), (1, "team3", 5)])
+
+        self.now = dt.datetime(2020, 1, 1, 20, 58, 2)
+        tasks[0].finish("sent")
+        tasks[1].finish((None, None, None))
+        self.assertEqual(list(self.scheduler.lateness),
+                         [(1, "team1", dt.datetime(2020, 1, 1, 20, 58), 2.0), (2, "team4", dt.datetime(2020, 1, 1, 20, 58), None)])
+        self.assertEqual(self.scheduler.stats()["sent"], 1)
+        self.assertEqual(self.scheduler.stats()["max"], 2.0)
+
+
+class TestResetScheduler(unittest.TestCase):
+    def setUp(self):
+        self.now = dt.datetime(2020, 1, 1, 12, 0)
+        self.reset = []
+        self.guilds = Guilds(storage=database.Storage(storage_type="local"))
+        self.guilds.set(1, Guild(title="guild1", chat_id=1, daily_reset_time=3))
+        g = self.guilds.get(1)
+        g.new_expedition("team1", "1300")
+        g.daily_expedition("team1", "mem1", "han1")
+        self.scheduler = ResetScheduler(self.guilds, self.reset.append, clock=lambda: self.now)
+
+    def tearDown(self):
+        if self.scheduler.on_change in self.guilds.listeners.callbacks:
+            self.scheduler.unwatch()
+
+    def run_at(self, day, hour, minute=0):
+        self.now = dt.datetime(2020, 1, day, hour, minute)
+        self.scheduler.run_due(self.now)
+
+    def test_resets_once_per_day(self):
+        self.scheduler.watch()
+        self.run_at(2, 2, 59)
+        self.assertEqual(self.reset, [])
+        g = self.guilds.get(1)
+        g.changes.drain()
+        self.run_at(2, 3)
+        self.run_at(2, 4)
+        self.assertEqual(self.reset, [g])
+        # Journaled as a single mutation, a crash can not replay half of a reset
+        self.assertEqual(g.changes.drain(), [{"op": "daily_reset", "args": ["2020-01-02"]}])
+        self.assertEqual(g.last_reset, "2020-01-02")
+        self.assertEqual(len(g.get_expedition("team1").members), 1)
+        self.run_at(3, 3)
+        self.assertEqual(len(self.reset), 2)
+
+    def test_schedules_new_guild(self):
+        self.scheduler.watch()
+        self.assertEqual(self.scheduler.pending(), 1)
+        # /start adds new guilds with Guilds.set
+        self.guilds.set(2, Guild(title="guild2", chat_id=2, daily_reset_time=5))
+        self.guilds.set(3, Guild(title="guild3", chat_id=3, stopped=True))
+        self.assertEqual(self.scheduler.pending(), 2)
+        self.run_at(2, 5)
+        self.assertEqual([g.chat_id for g in self.reset], [1, 2])
+
+    def test_reschedules_when_on_reset_fails(self):
+        def fail(guild):
+            raise RuntimeError("telegram is down")
+        self.scheduler.on_reset = fail
+        self.scheduler.watch()
+        with self.assertLogs(level="ERROR"):
+            self.run_at(2, 3)
+        self.assertEqual(self.guilds.get(1).last_reset, "2020-01-02")
+        self.assertEqual(self.scheduler.pending(), 1)
+        self.scheduler.on_reset = self.reset.append
+        self.run_at(3, 3)
+        self.assertEqual(self.reset, [self.guilds.get(1)])
+
+    def test_catches_up_after_restart(self):
+        self.guilds.get(1).set_last_reset("2019-12-31")
+        self.scheduler.watch()
+        self.run_at(1, 12)
+        self.assertEqual(self.guilds.get(1).last_reset, "2020-01-01")
+
+        # Restarting after today's reset ran does not reset again
+        self.scheduler.unwatch()
+        self.scheduler = ResetScheduler(self.guilds, self.reset.append, clock=lambda: self.now)
+        self.scheduler.watch()
+        self.run_at(1, 13)
+        self.assertEqual(len(self.reset), 1)
+
+    def test_watch_does_not_hydrate(self):
+        self.guilds.get(1).set_last_reset("2019-12-31")
+        self.guilds.set(2, Guild(title="guild2", chat_id=2, daily_reset_time=5))
+        with mock.patch.object(Guilds, "savefile", os.path.join(tempfile.mkdtemp(), "guilds.json")):
+            self.guilds.save()
+            gs = Guilds.load(self.guilds.storage)
+        self.scheduler = ResetScheduler(gs, self.reset.append, clock=lambda: self.now)
+        self.scheduler.watch()
+        self.assertEqual(sorted(gs.unhydrated), [1, 2])
+        self.assertEqual(len(gs.guilds), 0)
+        self.assertEqual(sorted(self.scheduler.heap)[0][0], self.now)  # Guild 1 missed a reset
+
+        self.run_at(1, 12)
+        self.assertEqual(list(gs.guilds), [1])
+        self.run_at(2, 5)
+        self.assertEqual([g.chat_id for g in self.reset], [1, 1, 2])
+
+    def test_follows_reset_time(self):
+        self.scheduler.watch()
+        self.guilds.get(1).set_reset_time(5)
+        self.run_at(2, 3)
+        self.assertEqual(self.reset, [])
+        self.run_at(2, 5)
+        self.assertEqual(len(self.reset), 1)
+
+
+class TestPinnedEditCoalescer(unittest.TestCase):
+    def setUp(self):
+        self.now = dt.datetime(2020, 1, 1, 12, 0)
+        self.edits = []
+        self.fail = False
+        self.guilds = Guilds(storage=database.Storage(storage_type="local"))
+        self.guilds.set(1, Guild(title="guild1", chat_id=1, pinned_message_id=10))
+        self.coalescer = PinnedEditCoalescer(self.guilds,
+                                             lambda g: (",".join(sorted(g.expeditions)), None),
+                                             self.edit,
+                                             clock=lambda: self.now)
+
+    def edit(self, g, text, markup):
+        self.edits.append(text)
+        task = OutboundTask(0, len(self.edits), g.chat_id, "edit_message_text", (text,), {})
+        task.finish((Exception, Exception("edit failed"), None) if self.fail else True)
+        return task
+
+    def run_at(self, second):
+        self.now = self.now.replace(second=second)
+        self.coalescer.run_due(self.now)
+
+    def test_coalesces_within_window(self):
+        g = self.guilds.get(1)
+        g.new_expedition("team1", "1300")
+        self.coalescer.request(1)
+        self.run_at(0)
+        self.assertEqual(self.edits, ["team1"])
+
+        # Updates within the window go out together at its end, with the latest state
+        g.new_expedition("team2", "1300")
+        self.coalescer.request(1)
+        g.new_expedition("team3", "1300")
+        self.coalescer.request(1)
+        self.assertEqual(self.coalescer.pending(), 1)
+        self.run_at(0)
+        self.assertEqual(self.edits, ["team1"])
+        self.run_at(1)
+        self.assertEqual(self.edits, ["team1", "team1,team2,team3"])
+
+    def test_skips_unchanged(self):
+        self.coalescer.request(1)
+        self.run_at(0)
+        self.coalescer.request(1)
+        self.run_at(1)
+        self.assertEqual(self.edits, [""])
+        self.assertEqual(self.coalescer.skipped, 1)
+
+        # A new pinned message is edited even if its content is the same
+        self.guilds.get(1).set_pinned_message(11)
+        self.coalescer.request(1)
+        self.run_at(2)
+        self.assertEqual(self.edits, ["", ""])
+
+    def test_retries_failed_edit(self):
+        self.fail = True
+        self.coalescer.request(1)
+        self.run_at(0)
+        self.assertEqual(self.edits, [""])
+
+        # The failed edit was not recorded, the same content goes out again
+        self.fail = False
+        self.coalescer.request(1)
+        self.run_at(1)
+        self.assertEqual(self.edits, ["", ""])
+        self.assertEqual(self.coalescer.skipped, 0)
+        self.coalescer.request(1)
+        self.run_at(2)
+        self.assertEqual(self.edits, ["", ""])
+        self.assertEqual(self.coalescer.skipped, 1)
+
+
+class TestDeletionScheduler(unittest.TestCase):
+    def setUp(self):
+        self.now = dt.datetime(2020, 1, 1, 12, 0)
+        self.deleted = []
+        self.storage = database.Storage(storage_type="local")
+        savefile = mock.patch.object(DeletionScheduler, "savefile", os.path.join(tempfile.mkdtemp(), "deletions.json"))
+        savefile.start()
+        self.addCleanup(savefile.stop)
+        self.scheduler = DeletionScheduler(self.storage, self.deleted.append, clock=lambda: self.now)
+
+    def run_at(self, second):
+        self.now = self.now.replace(second=second)
+        self.scheduler.run_due(self.now)
+
+    def test_batches_due_deletions(self):
+        self.scheduler.schedule(1, 10)
+        self.scheduler.schedule(1, 11)
+        self.run_at(1)
+        self.scheduler.schedule(2, 12)
+        self.assertEqual(self.scheduler.pending(), 3)
+        self.run_at(4)
+        self.assertEqual(self.deleted, [])
+        self.run_at(5)
+        self.assertEqual(self.deleted, [[(1, 10), (1, 11)]])
+        self.run_at(6)
+        self.assertEqual(self.deleted, [[(1, 10), (1, 11)], [(2, 12)]])
+        self.assertEqual(self.scheduler.pending(), 0)
+
+    def test_survives_restart(self):
+        self.scheduler.schedule(1, 10)
+        self.scheduler.schedule(1, 11)
+        self.assertIsNone(self.storage.loadfile(DeletionScheduler.savefile, "json"))
+        # Both schedules are saved together once the save interval is over
+        self.run_at(1)
+        self.assertEqual(len(self.storage.loadfile(DeletionScheduler.savefile, "json")), 2)
+        self.scheduler = DeletionScheduler(self.storage, self.deleted.append, clock=lambda: self.now)
+        self.scheduler.load()
+        self.assertEqual(self.scheduler.pending(), 2)
+        self.run_at(30)
+        self.assertEqual(self.deleted, [[(1, 10), (1, 11)]])
+
+    def test_failing_delete_is_logged(self):
+        def delete(batch):
+            raise RuntimeError("telegram is down")
+        self.scheduler.delete = delete
+        self.scheduler.schedule(1, 10)
+        self.scheduler.schedule(1, 11, now=self.now.replace(second=10))
+        with self.assertLogs(level="ERROR"):
+            self.run_at(5)
+        self.scheduler.delete = self.deleted.append
+        self.run_at(15)
+        self.assertEqual(self.deleted, [[(1, 11)]])
+
+    def test_saves_after_deleting(self):
+        self.scheduler.schedule(1, 10)
+        self.run_at(1)
+        self.assertEqual(len(self.storage.loadfile(DeletionScheduler.savefile, "json")), 1)
+        self.run_at(5)
+        self.assertEqual(self.deleted, [[(1, 10)]])
+        self.assertEqual(len(self.storage.loadfile(DeletionScheduler.savefile, "json")), 1)
+        self.run_at(6)
+        self.assertEqual(self.storage.loadfile(DeletionScheduler.savefile, "json"), [])
+        self.assertEqual(self.scheduler.pending(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
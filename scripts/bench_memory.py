@@ -0,0 +1,117 @@
+import argparse
+import gc
+import json
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import models  # noqa: E402
+
+
+def synthetic_guild(chat_id, expeditions, members, history):
+    g = models.Guild(title="guild{}".format(chat_id), chat_id=chat_id)
+    for i in range(expeditions):
+        title = "team{}".format(i)
+        g.new_expedition(title, "{:02d}00".format(i % 24), "description of {}".format(title))
+        for j in range(members):
+            g.checkin_expedition(title, 100000 + j, "player{}".format(j), "")
+            g.daily_expedition(title, 100000 + j, "player{}".format(j), "")
+    # Fort history with distinct players, half of them with an alt label
+    for j in range(history):
+        g.fort_mark(200000 + j // 2, "fortplayer{}".format(j // 2), "alt" if j % 2 else "")
+    g.update_fort_history()
+    for j in range(min(history, 20)):
+        g.fort_mark(200000 + j, "fortplayer{}".format(j), "")
+    g.changes.drain()
+    return g
+
+
+# The representation before Player, Expedition and Fort were slotted: every object has a __dict__,
+# handles and labels are not interned, and fort history is keyed by the player's full json.
+class LegacyPlayer:
+    def __init__(self, tg_id, tg_handle, label):
+        self.tg_handle = tg_handle
+        self.tg_id = tg_id
+        self.label = label
+        self.key = (tg_id, label)
+
+    def __str__(self):
+        return json.dumps({"tg_handle": self.tg_handle, "tg_id": self.tg_id, "label": self.label}, sort_keys=True)
+
+
+class LegacyExpedition:
+    def __init__(self, title, time, description):
+        self.time = time
+        self.title = title
+        self.members = models.Roster()
+        self.ready = models.Roster()
+        self.description = description
+        self.daily = models.Roster()
+
+
+class LegacyFort:
+    def __init__(self):
+        self.roster = []
+        self.attendance = models.Roster()
+        self.history = {}
+
+
+def legacy_guild(chat_id, expeditions, members, history):
+    """Same content as synthetic_guild in the legacy representation."""
+    g = models.Guild(title="guild{}".format(chat_id), chat_id=chat_id, fort=LegacyFort())
+    for i in range(expeditions):
+        title = "team{}".format(i)
+        e = g.expeditions[title] = LegacyExpedition(title, "{:02d}00".format(i % 24), "description of {}".format(title))
+        for j in range(members):
+            e.members.append(LegacyPlayer(100000 + j, "player{}".format(j), ""))
+            e.daily.append(LegacyPlayer(100000 + j, "player{}".format(j), ""))
+    for j in range(history):
+        p = LegacyPlayer(200000 + j // 2, "fortplayer{}".format(j // 2), "alt" if j % 2 else "")
+        g.fort.history[str(p)] = g.fort.history.get(str(p), 0) + 1
+    for j in range(min(history, 20)):
+        g.fort.attendance.append(LegacyPlayer(200000 + j, "fortplayer{}".format(j), ""))
+    return g
+
+
+REPRESENTATIONS = {"legacy": legacy_guild, "current": synthetic_guild}
+
+
+def footprint(build, args):
+    """Bytes allocated for a fleet of args.guilds guilds made by build."""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    fleet = {i: build(i, args.expeditions, args.members, args.history) for i in range(args.guilds)}
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    total = sum(s.size_diff for s in after.compare_to(before, "filename"))
+    del fleet
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory footprint of a synthetic fleet of guilds")
+    parser.add_argument("--guilds", type=int, default=500)
+    parser.add_argument("--expeditions", type=int, default=5)
+    parser.add_argument("--members", type=int, default=10)
+    parser.add_argument("--history", type=int, default=200)
+    parser.add_argument("--representation", choices=list(REPRESENTATIONS) + ["both"], default="both",
+                        help="legacy is the dict based models with json fort history keys, for before/after")
+    args = parser.parse_args()
+
+    names = list(REPRESENTATIONS) if args.representation == "both" else [args.representation]
+    print("guilds={} expeditions={} members={} history={}".format(
+        args.guilds, args.expeditions, args.members, args.history))
+    per_guild = {}
+    for name in names:
+        total = footprint(REPRESENTATIONS[name], args)
+        per_guild[name] = total / 1024 / args.guilds
+        print("{:8} total={:.1f}KiB per_guild={:.1f}KiB".format(name, total / 1024, per_guild[name]))
+    if len(per_guild) == 2:
+        print("per guild change {:+.1%}".format(per_guild["current"] / per_guild["legacy"] - 1))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""Micro-benchmarks of the models and renderers hot paths on synthetic guilds.
+
+    python scripts/bench_micro.py --baseline   # compare against scripts/bench_baseline.json, exits 1 on a regression
+    python scripts/bench_micro.py --save       # record a new scripts/bench_baseline.json
+    python scripts/bench_micro.py --baseline other.json --save mine.json   # or any other file
+
+Results are seconds per call, the best of --repeat runs. Timings only compare on the same machine:
+check the python and machine recorded in the baseline, and save a new one before changing code
+when they differ from yours, then compare against it after.
+"""
+import argparse
+import datetime as dt
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import models  # noqa: E402
+import renderers  # noqa: E402
+from bench_memory import synthetic_guild  # noqa: E402
+from custom_errors import ExpeditionFullError, ExpedMemberAlreadyExists  # noqa: E402
+
+FLEET_SIZES = [10, 100, 1000]
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+
+
+def bench_player():
+    a = models.Player(100001, "player1", "alt")
+    b = models.Player(100001, "renamed", "alt")
+    yield "player_eq", lambda: a == b
+    yield "player_hash", lambda: hash(a)
+
+
+def bench_checkin():
+    g = synthetic_guild(1, expeditions=5, members=9, history=0)
+
+    def checkin_checkout():
+        g.checkin_expedition("team0", 300000, "newcomer", "")
+        g.checkout_expedition("team0", 300000, "newcomer", "")
+        g.changes.drain()
+    yield "checkin_checkout_9_members", checkin_checkout
+
+    g.checkin_expedition("team1", 300000, "newcomer", "")
+
+    def checkin_full():
+        try:
+            g.checkin_expedition("team1", 300001, "latecomer", "")
+        except ExpeditionFullError:
+            pass
+    yield "checkin_full", checkin_full
+
+    def checkin_existing():
+        try:
+            g.checkin_expedition("team1", 100000, "player0", "")
+        except ExpedMemberAlreadyExists:
+            pass
+    yield "checkin_existing", checkin_existing
+
+
+def bench_fort_history():
+    g = synthetic_guild(1, expeditions=0, members=0, history=400)
+    g.update_fort_history()  # Clears the attendance synthetic_guild leaves behind
+    yield "get_history_all_400", g.get_history_all
+
+    def mark_and_update():
+        for j in range(50):
+            g.fort_mark(400000 + j, "marker{}".format(j), "")
+        g.update_fort_history()
+        g.changes.drain()
+    yield "update_fort_history_50_marks", mark_and_update
+
+
+def bench_renderers():
+    g = synthetic_guild(1, expeditions=24, members=10, history=0)
+    expeds = list(g.expeditions.values())
+    yield "sort_expeditions_24", lambda: renderers.sort_expeditions(expeds, g.daily_reset_time)
+    yield "filter_expeditions_24", lambda: renderers.filter_expeditions(expeds, g.daily_reset_time)
+    yield "render_guild_admin_24", lambda: renderers.render_guild_admin(g)
+
+    def one_changed():
+        expeds[0].touch()
+        return renderers.render_guild_admin(g)
+    yield "render_guild_admin_24_one_changed", one_changed
+
+    def all_changed():
+        for e in expeds:
+            e.touch()
+        return renderers.render_guild_admin(g)
+    yield "render_guild_admin_24_all_changed", all_changed
+    yield "render_poll_markup_24", lambda: renderers.render_poll_markup(g)
+
+
+def bench_persistence():
+    storage = models.database.Storage(storage_type="local")
+    for n in FLEET_SIZES:
+        fleet = models.Guilds(storage=storage)
+        for i in range(n):
+            fleet.set(i, synthetic_guild(i, expeditions=5, members=10, history=50))
+        yield "guilds_save_{}".format(n), fleet.save
+        fleet.save()
+        yield "guilds_load_{}".format(n), lambda: models.Guilds.load(storage)
+        yield "guilds_load_hydrate_{}".format(n), lambda: models.Guilds.load(storage).values()
+
+
+def measure(fn, repeat, min_time):
+    timer = timeit.Timer(fn)
+    number, elapsed = timer.autorange()
+    number = max(1, int(number * min_time / max(elapsed, 1e-9)))
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def run(repeat, min_time, only=None):
+    workdir = tempfile.mkdtemp(prefix="ascentbot-bench-")
+    cwd = os.getcwd()
+    os.chdir(workdir)  # Guilds.save writes its savefile to the working directory
+    results = {}
+    try:
+        for benchmarks in [bench_player(), bench_checkin(), bench_fort_history(), bench_renderers(),
+                           bench_persistence()]:
+            for name, fn in benchmarks:
+                if only and not any(o in name for o in only):
+                    continue
+                results[name] = measure(fn, repeat, min_time)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Prints each benchmark against the baseline, returns the names that got slower by more than threshold."""
+    regressions = []
+    for name, seconds in results.items():
+        before = baseline.get(name)
+        if before is None:
+            print("{:40} {:>12}  (new)".format(name, format_time(seconds)))
+            continue
+        change = seconds / before - 1
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print("{:40} {:>12} {:>12} {:+7.1%}{}".format(name, format_time(before), format_time(seconds), change, flag))
+    return regressions
+
+
+def format_time(seconds):
+    for unit, scale in [("s", 1), ("ms", 1e-3), ("us", 1e-6)]:
+        if seconds >= scale:
+            return "{:.2f}{}".format(seconds / scale, unit)
+    return "{:.0f}ns".format(seconds / 1e-9)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of models and renderers")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds per timing run")
+    parser.add_argument("--only", nargs="*", help="run benchmarks whose name contains any of these")
+    parser.add_argument("--baseline", nargs="?", const=BASELINE,
+                        help="json results to compare against, scripts/bench_baseline.json if no file is given")
+    parser.add_argument("--threshold", type=float, default=0.2, help="slowdown that counts as a regression")
+    parser.add_argument("--save", nargs="?", const=BASELINE,
+                        help="write the results as json to this file, scripts/bench_baseline.json if none is given")
+    parser.add_argument("--json", action="store_true", help="print results as json")
+    args = parser.parse_args()
+
+    results = run(args.repeat, args.min_time, args.only)
+    output = {
+        "date": dt.datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+    if args.json:
+        print(json.dumps(output, indent=2, sort_keys=True))
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)["results"], args.threshold)
+    elif not args.json:
+        for name, seconds in results.items():
+            print("{:40} {:>12}".format(name, format_time(seconds)))
+    if regressions:
+        print("{} regression(s) over {:.0%}: {}".format(len(regressions), args.threshold, ", ".join(regressions)))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,15 @@
+import database
+import os
+import sys
+
+# Usage: STORAGE=<source storage> python scripts/import_to_sqlite.py [guilds.<MODE>.json]
+FILENAME = sys.argv[1] if len(sys.argv) > 1 else "guilds.{}.json".format(os.getenv("MODE", "dev"))
+
+source = database.Storage()
+data = source.loadfile(FILENAME, "json")
+if data is None:
+    sys.exit("{} not found".format(FILENAME))
+
+target = database.Storage(storage_type="sqlite")
+target.import_guilds(data)
+print("Imported {} guilds into {}".format(len(data["guilds"]), target.SQLITE_PATH))
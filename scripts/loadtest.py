@@ -0,0 +1,240 @@
+"""End to end load test: boots main.py in webhook mode against a local fake Bot API and replays
+synthetic updates into the webhook route.
+
+    python scripts/loadtest.py --guilds 50 --updates 2000
+"""
+import argparse
+import datetime as dt
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+os.environ["MODE"] = "loadtest"  # Before models is imported, it names the savefile
+import models  # noqa: E402
+import router  # noqa: E402
+from fakebotapi import FakeBotApi  # noqa: E402
+
+TOKEN = "LOADTEST"
+EXPEDITIONS = 5
+USERS = 8  # per guild, below the 10 member limit of an expedition
+# Runs main.py (argv[2]) with telebot pointed at the fake Bot API (argv[1])
+BOOTSTRAP = ("import runpy, sys, fakebotapi; fakebotapi.use_api_url(sys.argv[1]); sys.argv = sys.argv[2:]; "
+             "runpy.run_path(sys.argv[0], run_name='__main__')")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if len(values) == 0:
+        return None
+    return values[min(len(values) - 1, len(values) * p // 100)]
+
+
+def chat_id(i):
+    return -1000000000 - i
+
+
+def user(i):
+    return {"id": 500000 + i, "is_bot": False, "first_name": "player{}".format(i), "username": "player{}".format(i)}
+
+
+def write_fixtures(workdir, guilds):
+    """Savefile with `guilds` guilds whose last daily reset was long ago, so they all reset on start."""
+    with open(os.path.join(workdir, "feature_whitelist.json"), "w") as f:
+        json.dump({"fort": [chat_id(i) for i in range(guilds)]}, f)
+    with open(os.path.join(workdir, "sauron.json"), "w") as f:
+        json.dump({"target": [], "out": 0}, f)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        fleet = models.Guilds(storage=models.database.Storage(storage_type="local"))
+        for i in range(guilds):
+            g = models.Guild(title="guild{}".format(i), chat_id=chat_id(i), pinned_message_id=1,
+                             last_reset="2000-01-01")
+            for j in range(EXPEDITIONS):
+                g.new_expedition("team{}".format(j), "{:02d}00".format((12 + j * 2) % 24))
+            fleet.set(g.chat_id, g)
+        fleet.save()
+    finally:
+        os.chdir(cwd)
+
+
+class Replay:
+    """Builds synthetic updates and posts them to the webhook from `concurrency` connections."""
+
+    def __init__(self, port, concurrency):
+        self.url = "http://127.0.0.1:{}/{}".format(port, TOKEN)
+        self.pool = ThreadPoolExecutor(max_workers=concurrency)
+        self.update_id = 0
+        self.message_id = 1000
+        self.acks = []
+
+    def post(self, update):
+        started = time.monotonic()
+        request = urllib.request.Request(self.url, data=json.dumps(update).encode("utf-8"), method="POST")
+        with urllib.request.urlopen(request) as r:
+            r.read()
+        return time.monotonic() - started
+
+    def post_all(self, updates):
+        self.acks.extend(self.pool.map(self.post, updates))
+        return len(updates)
+
+    def message(self, chat, sender, text):
+        self.update_id += 1
+        self.message_id += 1
+        return {"update_id": self.update_id, "message": {
+            "message_id": self.message_id, "date": int(time.time()), "text": text,
+            "chat": {"id": chat, "type": "supergroup", "title": "guild"}, "from": sender,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text.split(" ")[0])}],
+        }}
+
+    def callback(self, chat, sender, data):
+        self.update_id += 1
+        return {"update_id": self.update_id, "callback_query": {
+            "id": "cb{}".format(self.update_id), "from": sender, "chat_instance": "1", "data": data,
+            "message": {"message_id": 1, "date": int(time.time()), "text": "pinned",
+                        "chat": {"id": chat, "type": "supergroup", "title": "guild"}},
+        }}
+
+
+def stats(port):
+    with urllib.request.urlopen("http://127.0.0.1:{}/{}/stats".format(port, TOKEN)) as r:
+        return json.loads(r.read().decode("utf-8"))
+
+
+def wait_for(predicate, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def run_phase(name, api, port, replay, updates, expected_calls, timeout):
+    """Replays updates and waits until the bot made the calls in expected_calls {method: count}."""
+    before = {method: len(api.calls_to(method)) for method in expected_calls}
+    calls_before = len(api.calls)
+    stats_before = stats(port)
+    acks_before = len(replay.acks)
+    started = time.monotonic()
+    updates = replay.post_all(updates)
+    finished = wait_for(lambda: all(len(api.calls_to(method)) - before[method] >= count
+                                    for method, count in expected_calls.items()), timeout)
+    elapsed = time.monotonic() - started
+    wait_for(lambda: stats(port)["updates"]["pending"] == 0, timeout)
+    stats_after = stats(port)
+    calls = {}
+    for _, method, _ in api.calls[calls_before:]:
+        calls[method] = calls.get(method, 0) + 1
+    written = stats_after["storage_bytes_written"] - stats_before["storage_bytes_written"]
+    acks = replay.acks[acks_before:]
+    return {
+        "phase": name,
+        "updates": updates,
+        "complete": finished,
+        "seconds": round(elapsed, 3),
+        "updates_per_second": round(updates / elapsed, 1) if updates else None,
+        "ack_p50_ms": round(percentile(acks, 50) * 1000, 2) if acks else None,
+        "ack_p99_ms": round(percentile(acks, 99) * 1000, 2) if acks else None,
+        "handler_p50_ms": round(stats_after["updates"].get("p50", 0) * 1000, 2),
+        "handler_p99_ms": round(stats_after["updates"].get("p99", 0) * 1000, 2),
+        "outbound_calls": calls,
+        "storage_bytes_per_update": round(written / updates) if updates else written,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End to end load test of main.py in webhook mode")
+    parser.add_argument("--guilds", type=int, default=20)
+    parser.add_argument("--updates", type=int, default=500, help="updates per phase")
+    parser.add_argument("--concurrency", type=int, default=8, help="webhook requests in flight")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="seconds the fake Bot API takes per call")
+    parser.add_argument("--real-limits", action="store_true", help="keep Telegram's rate limits")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--json", action="store_true", help="print results as json")
+    parser.add_argument("--keep", action="store_true", help="keep the working directory")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="ascentbot-loadtest-")
+    write_fixtures(workdir, args.guilds)
+    api = FakeBotApi(latency=args.api_latency).start()
+    port = free_port()
+    env = dict(os.environ, LISTEN_MODE="webhook", TG_TOKEN=TOKEN, PORT=str(port), PYTHONPATH=ROOT,
+               MODE="loadtest", PERSISTENCE=os.getenv("PERSISTENCE", "snapshot"))
+    if not args.real_limits:
+        env.update(OUTBOUND_GLOBAL_RATE="100000", OUTBOUND_GROUP_RATE="100000", OUTBOUND_PRIVATE_RATE="100000")
+    log = open(os.path.join(workdir, "main.log"), "w")
+    bot = subprocess.Popen([sys.executable, "-c", BOOTSTRAP, api.url, os.path.join(ROOT, "main.py")],
+                           cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    results = []
+    try:
+        started = time.monotonic()
+
+        def up():
+            try:
+                stats(port)
+                return True
+            except OSError:
+                return False
+        if not wait_for(up, 30):
+            raise SystemExit("main.py did not start, see {}".format(os.path.join(workdir, "main.log")))
+        replay = Replay(port, args.concurrency)
+
+        # Every guild is overdue for its daily reset, so they all reset and pin a new message on start
+        reset_done = wait_for(lambda: len(api.calls_to("pinChatMessage")) >= args.guilds, args.timeout)
+        results.append({"phase": "daily reset fan-out", "updates": 0, "complete": reset_done,
+                        "seconds": round(time.monotonic() - started, 3),
+                        "outbound_calls": {m: len(api.calls_to(m)) for m in ["sendMessage", "pinChatMessage"]}})
+
+        n = args.updates
+        reg_storm = [replay.callback(chat_id(i % args.guilds), user(i // args.guilds % USERS),
+                                     router.callback_data("exped", "reg", "team{}".format(i % EXPEDITIONS)))
+                     for i in range(n)]
+        results.append(run_phase("exped reg callbacks", api, port, replay, reg_storm,
+                                 {"answerCallbackQuery": n}, args.timeout))
+        view = [replay.message(chat_id(i % args.guilds), user(i % USERS), "/exped view") for i in range(n)]
+        results.append(run_phase("exped view", api, port, replay, view, {"sendMessage": n}, args.timeout))
+        fort_mark = [replay.message(chat_id(i % args.guilds), user(i // args.guilds % USERS), "/fort mark")
+                     for i in range(n)]
+        results.append(run_phase("fort mark", api, port, replay, fort_mark, {"sendMessage": n}, args.timeout))
+        final = stats(port)
+    finally:
+        bot.terminate()
+        bot.wait()
+        api.stop()
+        log.close()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps({"date": dt.datetime.now().isoformat(), "guilds": args.guilds, "phases": results,
+                          "outbound": final["outbound"]}, indent=2))
+        return
+    for r in results:
+        print("{}: {} updates in {}s{}".format(r["phase"], r["updates"], r["seconds"],
+                                               "" if r["complete"] else " (timed out)"))
+        if r["updates"]:
+            print("  {updates_per_second} updates/s, ack p50 {ack_p50_ms}ms p99 {ack_p99_ms}ms, "
+                  "handler p50 {handler_p50_ms}ms p99 {handler_p99_ms}ms, "
+                  "{storage_bytes_per_update} storage bytes/update".format(**r))
+        print("  outbound calls: {}".format(r["outbound_calls"]))
+
+
+if __name__ == "__main__":
+    main()
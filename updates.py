@@ -0,0 +1,110 @@
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+
+
+def update_chat_id(update):
+    for message in [update.message, update.edited_message]:
+        if message is not None:
+            return message.chat.id
+    if update.callback_query is not None and update.callback_query.message is not None:
+        return update.callback_query.message.chat.id
+    return None
+
+
+class RecentUpdates:
+    """The last `size` update ids seen, to drop updates Telegram delivers again."""
+
+    def __init__(self, size=10000):
+        self.size = size
+        self.ids = OrderedDict()
+        self.lock = threading.Lock()
+        self.duplicates = 0
+
+    def seen(self, update_id):
+        """Returns True if update_id was seen before, and remembers it otherwise."""
+        with self.lock:
+            if update_id in self.ids:
+                self.duplicates += 1
+                return True
+            self.ids[update_id] = None
+            if len(self.ids) > self.size:
+                self.ids.popitem(last=False)
+            return False
+
+    def forget(self, update_id):
+        with self.lock:
+            self.ids.pop(update_id, None)
+
+
+class UpdateQueue:
+    """Processes webhook updates on a fixed pool of worker threads.
+
+    Updates of one chat are processed one at a time in the order they came in, different chats run in
+    parallel. Chats with pending updates take turns, one update each, so a busy guild can't hold up the
+    others. put() never blocks: it drops duplicates, and refuses updates once `backlog` are pending.
+    """
+
+    def __init__(self, process, workers=8, backlog=10000, recent=None):
+        self.process = process  # called with one update at a time
+        self.backlog = backlog
+        self.recent = recent or RecentUpdates()
+        self.cond = threading.Condition()
+        self.pending = {}  # chat_id -> deque of updates
+        self.ready = deque()  # chats with pending updates that no worker is processing
+        self.size = 0
+        self.counters = {"processed": 0, "failed": 0, "dropped": 0}
+        self.latencies = deque(maxlen=10000)  # seconds from put() until processed, of the latest updates
+        for _ in range(workers):
+            threading.Thread(target=self.__work, daemon=True).start()
+
+    def put(self, update):
+        """Returns False if the update was refused because the backlog is full."""
+        if self.recent.seen(update.update_id):
+            return True
+        chat_id = update_chat_id(update)
+        with self.cond:
+            if self.size >= self.backlog:
+                self.counters["dropped"] += 1
+                self.recent.forget(update.update_id)  # Accept it when Telegram delivers it again
+                return False
+            if chat_id not in self.pending:
+                self.pending[chat_id] = deque()
+                self.ready.append(chat_id)
+            self.pending[chat_id].append((time.monotonic(), update))
+            self.size += 1
+            self.cond.notify()
+        return True
+
+    def stats(self):
+        with self.cond:
+            latencies = sorted(self.latencies)
+            stats = dict(self.counters, pending=self.size, chats=len(self.pending), duplicates=self.recent.duplicates)
+        if len(latencies) > 0:
+            stats["p50"] = latencies[len(latencies) // 2]
+            stats["p99"] = latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)]
+        return stats
+
+    def __work(self):
+        while True:
+            with self.cond:
+                while len(self.ready) == 0:
+                    self.cond.wait()
+                chat_id = self.ready.popleft()
+                queued_at, update = self.pending[chat_id].popleft()
+            try:
+                self.process(update)
+                counter = "processed"
+            except Exception as e:
+                logging.exception(e)
+                counter = "failed"
+            with self.cond:
+                self.counters[counter] += 1
+                self.latencies.append(time.monotonic() - queued_at)
+                self.size -= 1
+                if len(self.pending[chat_id]) == 0:
+                    del self.pending[chat_id]
+                else:
+                    self.ready.append(chat_id)  # Back of the line, behind the other chats
+                    self.cond.notify()
@@ -0,0 +1,64 @@
+import threading
+import unittest
+
+from telebot import types
+
+from updates import UpdateQueue
+
+
+def make_update(update_id, chat_id):
+    return types.Update.de_json({"update_id": update_id, "message": {
+        "message_id": update_id, "date": 0, "text": str(update_id),
+        "chat": {"id": chat_id, "type": "group"}, "from": {"id": 1, "is_bot": False, "first_name": "a"}}})
+
+
+class TestUpdateQueue(unittest.TestCase):
+    def test_chat_order_and_dedupe(self):
+        processed = []
+        done = threading.Semaphore(0)
+
+        def process(update):
+            processed.append((update.message.chat.id, update.update_id))
+            done.release()
+
+        queue = UpdateQueue(process, workers=4)
+        for i in range(40):
+            queue.put(make_update(i, -(i % 4)))
+        queue.put(make_update(5, -1))  # Delivered again
+        for _ in range(40):
+            self.assertTrue(done.acquire(timeout=5))
+        self.assertEqual(len(processed), 40)
+        for chat_id in range(4):
+            ids = [u for c, u in processed if c == -chat_id]
+            self.assertEqual(ids, sorted(ids))
+        self.assertEqual(queue.stats()["duplicates"], 1)
+
+    def test_chats_run_in_parallel(self):
+        blocked = threading.Event()
+        other = threading.Event()
+
+        def process(update):
+            if update.message.chat.id == -1:
+                blocked.wait(5)  # A slow guild
+            else:
+                other.set()
+
+        queue = UpdateQueue(process, workers=2)
+        queue.put(make_update(1, -1))
+        queue.put(make_update(2, -1))
+        queue.put(make_update(3, -2))
+        self.assertTrue(other.wait(5))
+        blocked.set()
+
+    def test_backlog(self):
+        release = threading.Event()
+        queue = UpdateQueue(lambda update: release.wait(5), workers=1, backlog=2)
+        self.assertTrue(queue.put(make_update(1, -1)))
+        self.assertTrue(queue.put(make_update(2, -1)))
+        self.assertFalse(queue.put(make_update(3, -1)))
+        self.assertEqual(queue.stats()["dropped"], 1)
+        release.set()
+
+
+if __name__ == '__main__':
+    unittest.main()
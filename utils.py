@@ -17,4 +17,9 @@ def time_shifted_back_hours(t, hour_offset):
     new_hour = t.hour - hour_offset
     if new_hour < 0:
         new_hour = 24 + new_hour
-    return t.replace(hour=new_hour)
\ No newline at end of file
+    return t.replace(hour=new_hour)
+
+
+def minutes_since_reset(t, daily_reset_time):
+    """Whole minutes from daily_reset_time o'clock to t, wrapping around midnight."""
+    return ((t.hour - daily_reset_time) % 24) * 60 + t.minute